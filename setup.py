@@ -19,5 +19,10 @@ setup(
     author_email='dzmitry.makatun@absa.africa',
     url='https://github.com/AbsaOSS/spot',
     license=license,
-    packages=find_packages(exclude=('tests', 'docs'))
+    packages=find_packages(exclude=('tests', 'docs')),
+    entry_points={
+        'console_scripts': [
+            'spot-reaggregate=spot.crawler.reaggregate:main'
+        ]
+    }
 )
@@ -0,0 +1,256 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import logging
+import math
+from datetime import datetime, timezone
+
+import numpy as np
+
+from spot.crawler.aggregator import _cast_sparkProperties_dict
+from spot.crawler.commons import get_attribute
+from spot.crawler.crawler_args import datetime_format
+from spot.crawler.elastic import Elastic
+from spot.regression.features import input_bytes as get_input_bytes
+from spot.utils.config import SpotConfig
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+GB = 1e9
+_source_fields = [
+    'id',
+    'attempt.duration',
+    'attempt.aggs.summary.core_cost',
+    'app_specific_data.classification',
+    'attempt.aggs.stages.inputBytes.max',
+    'attempt.app_specific_data.enceladus_run.controlMeasure.metadata.additionalInfo.std_input_data_size',
+    'attempt.app_specific_data.enceladus_run.controlMeasure.metadata.additionalInfo.conform_input_data_size'
+]
+# metric -> field path, metrics are normalized by input size as in the regression models (see input_bytes)
+_metric_paths = {
+    'duration': ['attempt', 'duration'],
+    'core_cost': ['attempt', 'aggs', 'summary', 'core_cost']
+}
+
+
+def cohort_query(tag=None, app_version=None, spark_properties=None, end_time_min=None, end_time_max=None):
+    """Builds a query selecting final attempt aggregations of a cohort.
+
+    :param tag: app_specific_data.tag
+    :param app_version: app_specific_data.classification.app_version, e.g. Enceladus version
+    :param spark_properties: dict of Spark property values, e.g. {'spark.executor.memory': '8g'}.
+        The values are cast in the same way as the stored properties.
+    """
+    filters = [{'term': {'isFinalAttempt': True}}]
+    if tag is not None:
+        filters.append({'term': {'app_specific_data.tag.keyword': tag}})
+    if app_version is not None:
+        filters.append({'term': {'app_specific_data.classification.app_version.keyword': app_version}})
+    for key, value in (spark_properties or {}).items():
+        key = key.replace('.', '_')
+        if key in _cast_sparkProperties_dict:
+            value = _cast_sparkProperties_dict[key](value)
+        field = f'attempt.environment.sparkProperties.{key}'
+        if isinstance(value, str):
+            field += '.keyword'
+        filters.append({'term': {field: value}})
+    if end_time_min is not None or end_time_max is not None:
+        end_time_range = {}
+        if end_time_min is not None:
+            end_time_range['gte'] = end_time_min
+        if end_time_max is not None:
+            end_time_range['lte'] = end_time_max
+        filters.append({'range': {'attempt.endTime': end_time_range}})
+    return {'bool': {'filter': filters}}
+
+
+def cohort_arrays(aggs):
+    """Extracts metrics per GB of input from aggregations into numpy arrays.
+
+    Runs without input or metrics are dropped.
+    :return: dict {metric: array of values per GB}, number of dropped runs
+    """
+    values = {metric: [] for metric in _metric_paths}
+    dropped = 0
+    for agg in aggs:
+        input_bytes = get_input_bytes(agg)
+        metrics = {metric: get_attribute(agg, list(path)) for metric, path in _metric_paths.items()}
+        if not input_bytes or any(value is None for value in metrics.values()):
+            dropped += 1
+            continue
+        for metric, value in metrics.items():
+            values[metric].append(value * GB / input_bytes)
+    return {metric: np.asarray(v, dtype=float) for metric, v in values.items()}, dropped
+
+
+def bootstrap_quantiles(x, resamples=1000, q=0.5, rng=None):
+    """Quantile q of each of the bootstrap resamples of x (with linear interpolation, as numpy.quantile).
+
+    Instead of materializing the resamples, the order statistics of each resample are drawn directly:
+    the m-th smallest of n uniform draws follows Beta(m, n - m + 1) and the next one follows
+    from it by Beta(1, n - m). The m-th smallest resampled index is floor(n * uniform),
+    so the cost is O(n log n) for sorting plus O(resamples), regardless of the cohort size.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    x = np.sort(x)
+    n = len(x)
+    h = (n - 1) * q
+    m = int(math.floor(h)) + 1  # 1-based rank of the lower order statistic
+    fraction = h - (m - 1)
+    u_lower = rng.beta(m, n - m + 1, size=resamples)
+    if m < n:
+        u_upper = u_lower + (1 - u_lower) * rng.beta(1, n - m, size=resamples)
+    else:
+        u_upper = u_lower
+    lower = x[np.minimum((n * u_lower).astype(int), n - 1)]
+    upper = x[np.minimum((n * u_upper).astype(int), n - 1)]
+    return lower + fraction * (upper - lower)
+
+
+def bootstrap_ratio_ci(a, b, resamples=1000, confidence=0.95, q=0.5, rng=None):
+    """Bootstrap confidence interval of quantile(b, q) / quantile(a, q), the median by default."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = bootstrap_quantiles(b, resamples, q, rng) / bootstrap_quantiles(a, resamples, q, rng)
+    alpha = (1 - confidence) / 2
+    low, high = np.nanquantile(ratios, [alpha, 1 - alpha])
+    return float(low), float(high)
+
+
+def mann_whitney(a, b):
+    """Two-sided Mann-Whitney U test with the normal approximation and tie correction.
+
+    :return: U statistic of b, p-value, probability that a value of b is lower than a value of a
+    """
+    n_a, n_b = len(a), len(b)
+    values = np.concatenate([a, b])
+    order = np.argsort(values, kind='mergesort')
+    sorted_values = values[order]
+    # average ranks of ties
+    _, first_index, counts = np.unique(sorted_values, return_index=True, return_counts=True)
+    average_ranks = first_index + (counts + 1) / 2.0
+    ranks = np.empty(len(values))
+    ranks[order] = np.repeat(average_ranks, counts)
+
+    u_b = ranks[n_a:].sum() - n_b * (n_b + 1) / 2.0
+    n = n_a + n_b
+    tie_term = (counts ** 3 - counts).sum() / (n * (n - 1)) if n > 1 else 0.0
+    sigma = math.sqrt(n_a * n_b / 12.0 * ((n + 1) - tie_term))
+    mean_u = n_a * n_b / 2.0
+    if sigma == 0:
+        p_value = 1.0
+    else:
+        z = (abs(u_b - mean_u) - 0.5) / sigma  # with continuity correction
+        p_value = min(1.0, math.erfc(max(z, 0.0) / math.sqrt(2)))
+    prob_b_lower = 1.0 - u_b / (n_a * n_b)
+    return float(u_b), p_value, float(prob_b_lower)
+
+
+def compare_cohorts(cohort_a, cohort_b, resamples=1000, confidence=0.95, seed=None):
+    """Compares metrics per GB of input of two cohorts (B relative to A).
+
+    :param cohort_a: dict {metric: array}, see cohort_arrays
+    :return: dict {metric: results}
+    """
+    rng = np.random.default_rng(seed)
+    report = {}
+    for metric in _metric_paths:
+        a = cohort_a[metric]
+        b = cohort_b[metric]
+        result = {'n_a': len(a), 'n_b': len(b)}
+        if len(a) > 0 and len(b) > 0:
+            median_a = float(np.median(a))
+            median_b = float(np.median(b))
+            result['median_per_gb_a'] = median_a
+            result['median_per_gb_b'] = median_b
+            if median_a != 0:
+                result['median_ratio'] = median_b / median_a
+                result['ratio_ci'] = bootstrap_ratio_ci(a, b, resamples, confidence, rng=rng)
+            u, p_value, prob_b_lower = mann_whitney(a, b)
+            result['mann_whitney_u'] = u
+            result['p_value'] = p_value
+            result['prob_b_lower'] = prob_b_lower
+        report[metric] = result
+    return report
+
+
+def format_report(report, confidence=0.95):
+    lines = []
+    for metric, r in report.items():
+        lines.append(f"{metric} per GB of input: A {r['n_a']} runs, B {r['n_b']} runs")
+        if 'median_ratio' not in r:
+            lines.append("  not enough data")
+            continue
+        low, high = r['ratio_ci']
+        lines.append(f"  median A: {r['median_per_gb_a']:.4g}  median B: {r['median_per_gb_b']:.4g}  "
+                     f"B/A: {r['median_ratio']:.3f} ({confidence:.0%} CI {low:.3f} - {high:.3f})")
+        lines.append(f"  Mann-Whitney p-value: {r['p_value']:.3g}  P(B < A): {r['prob_b_lower']:.3f}")
+    return '\n'.join(lines)
+
+
+def parse_cohort(spec):
+    """Parses a cohort specification 'tag=...,app_version=...,spark.executor.memory=8g'
+    into keyword arguments of cohort_query."""
+    kwargs = {'spark_properties': {}}
+    for item in filter(None, spec.split(',')):
+        key, value = item.split('=', 1)
+        key = key.strip()
+        if key in ['tag', 'app_version']:
+            kwargs[key] = value.strip()
+        else:
+            kwargs['spark_properties'][key] = value.strip()
+    return kwargs
+
+
+def _parse_date(s):
+    return datetime.strptime(s, datetime_format).replace(tzinfo=timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares duration and core cost per GB of input of two cohorts of runs')
+    parser.add_argument('cohort_a', help="baseline cohort, e.g. 'tag=my_tag,app_version=2.1.0'")
+    parser.add_argument('cohort_b', help="compared cohort, e.g. 'tag=my_tag,spark.executor.memory=8g'")
+    parser.add_argument("--config_path",
+                        help="Absolute path to config.ini configuration file, e.g. '/opt/config.ini'")
+    parser.add_argument("--min_end_date", type=_parse_date,
+                        help=f"Only runs completed after {datetime_format.replace('%', '%%')}")
+    parser.add_argument("--max_end_date", type=_parse_date,
+                        help=f"Only runs completed before {datetime_format.replace('%', '%%')}")
+    parser.add_argument("--resamples", type=int, default=1000, help="Number of bootstrap resamples")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of the intervals")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible intervals")
+    parser.add_argument("--json", action='store_true', help="Print the report as JSON")
+    args = parser.parse_args()
+
+    conf = SpotConfig(args.config_path) if args.config_path else SpotConfig()
+    elastic = Elastic(conf)
+    cohorts = []
+    for spec in [args.cohort_a, args.cohort_b]:
+        query = cohort_query(end_time_min=args.min_end_date, end_time_max=args.max_end_date, **parse_cohort(spec))
+        arrays, dropped = cohort_arrays(elastic.get_aggs(query=query, source=_source_fields))
+        logger.info(f"cohort {spec}: {len(arrays['duration'])} runs, {dropped} runs without input or metrics")
+        cohorts.append(arrays)
+
+    report = compare_cohorts(cohorts[0], cohorts[1], resamples=args.resamples,
+                             confidence=args.confidence, seed=args.seed)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(format_report(report, confidence=args.confidence))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@
 # limitations under the License.
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 import spot.crawler.history_api as history_api
@@ -35,6 +36,13 @@ _time_keys_dict = {
         'submissionTime',
         'firstTaskLaunchedTime',
         'completionTime'
+    ],
+    'job': [
+        'submissionTime',
+        'completionTime'
+    ],
+    'sql': [
+        'submissionTime'
     ]
 }
 
@@ -154,6 +162,8 @@ def _parse_datetime(str_datetime, format=_dt_format):
 
 
 class HistoryAggregator:
+    # field of stored aggregations holding the completion time by which apps are listed
+    listing_time_field = 'attempt.endTime'
 
     def __init__(self,
                  spark_history_base_url,
@@ -161,13 +171,35 @@ class HistoryAggregator:
                  remove_keys_dict=_remove_keys_dict,
                  time_keys_dict=_time_keys_dict,
                  cast_sparkProperties_dict=_cast_sparkProperties_dict,
-                 last_attempt_only=False):
+                 last_attempt_only=False,
+                 fetch_jobs=False,
+                 fetch_sql=False,
+                 rate_limiter=None,
+                 circuit_breaker=None):
+        """
+        fetch_jobs -- also fetch jobs of each attempt
+        fetch_sql -- also fetch SQL executions of each attempt (and jobs, which link them to stages)
+        rate_limiter -- AdaptiveRateLimiter of requests to Spark History
+        circuit_breaker -- CircuitBreaker of requests to Spark History
+        """
         logger.debug(f"Initializing hist aggregator. base URL: {spark_history_base_url} cert: {ssl_path}")
-        self._hist = history_api.SparkHistory(spark_history_base_url, ssl_path=ssl_path)
+        self._hist = history_api.SparkHistory(spark_history_base_url, ssl_path=ssl_path,
+                                              rate_limiter=rate_limiter, circuit_breaker=circuit_breaker)
         self._remove_keys_dict = remove_keys_dict
         self._time_keys_dict = time_keys_dict
         self.cast_sparkProperties_dict = cast_sparkProperties_dict
         self.last_attempt_only = last_attempt_only
+        self.fetch_jobs = fetch_jobs or fetch_sql
+        self.fetch_sql = fetch_sql
+        self._executor = None
+
+    @property
+    def rate_limiter(self):
+        return self._hist.rate_limiter if self._hist is not None else None
+
+    @property
+    def circuit_breaker(self):
+        return self._hist.circuit_breaker if self._hist is not None else None
 
     def _remove_keys(self, doc, doc_type):
         key_list = self._remove_keys_dict.get(doc_type)
@@ -221,6 +253,20 @@ class HistoryAggregator:
             self._remove_keys(stage, 'stage')
         return stages
 
+    def get_jobs(self, app_id, attempt_id):
+        jobs = self._hist.get_jobs(app_id, attempt_id)
+        for job in jobs:
+            self._cast_datetime_values(job, 'job')
+            self._remove_keys(job, 'job')
+        return jobs
+
+    def get_sql(self, app_id, attempt_id):
+        executions = self._hist.get_sql(app_id, attempt_id)
+        for execution in executions:
+            self._cast_datetime_values(execution, 'sql')
+            self._remove_keys(execution, 'sql')
+        return executions
+
     def get_environment(self, app_id, attempt_id):
         environment = self._hist.get_environment(app_id,
                                                  attempt_id)
@@ -271,13 +317,20 @@ class HistoryAggregator:
     def add_app_data(self, app, stage_status=None,):
         app_id = app.get('id')
         logger.debug(f'fetching app details: {app_id}')
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=5, thread_name_prefix='history')
         for attempt in app.get('attempts'):
             attempt_id = attempt.get('attemptId')
-            attempt['allexecutors'] = self.get_all_executors(app_id,
-                                                             attempt_id)
-            attempt['stages'] = self.get_stages(app_id,
-                                                attempt_id,
-                                                status=stage_status)
-            attempt['environment'] = self.get_environment(app_id,
-                                                          attempt_id)
+            # the endpoints of an attempt are requested concurrently
+            futures = {
+                'allexecutors': self._executor.submit(self.get_all_executors, app_id, attempt_id),
+                'stages': self._executor.submit(self.get_stages, app_id, attempt_id, status=stage_status),
+                'environment': self._executor.submit(self.get_environment, app_id, attempt_id)
+            }
+            if self.fetch_jobs:
+                futures['jobs'] = self._executor.submit(self.get_jobs, app_id, attempt_id)
+            if self.fetch_sql:
+                futures['sql'] = self._executor.submit(self.get_sql, app_id, attempt_id)
+            for key, future in futures.items():
+                attempt[key] = future.result()
         return app
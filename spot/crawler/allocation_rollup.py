@@ -0,0 +1,166 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+
+from spot.crawler.commons import datetime_to_utc_timestamp_ms, utc_from_timestamp_ms
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+# YARN default: max(384 MiB, 10% of executor memory)
+_min_memory_overhead = 384 * 1024 * 1024
+_memory_overhead_factor = 0.1
+
+
+def executor_memory_bytes(attempt, ex):
+    """Memory allocated to an executor container: spark.executor.memory + overhead.
+    Falls back to the storage memory reported by Spark (maxMemory) when the property is not set."""
+    props = attempt.get('environment', {}).get('sparkProperties', {})
+    memory = props.get('spark_executor_memory')
+    if memory is None:
+        return ex.get('maxMemory', 0)
+    overhead = props.get('spark_executor_memoryOverhead',
+                         props.get('spark_yarn_executor_memoryOverhead'))
+    if overhead is None:
+        overhead = max(_min_memory_overhead, _memory_overhead_factor * memory)
+    return memory + overhead
+
+
+def allocation_steps(intervals):
+    """Sweep-line over allocation intervals.
+
+    :param intervals: iterable of (start_ms, stop_ms, cores, memory_bytes)
+    :return: list of (start_ms, stop_ms, cores, memory_bytes) with constant total allocation, in time order
+    """
+    events = []
+    for start, stop, cores, memory in intervals:
+        if stop > start:
+            events.append((start, cores, memory))
+            events.append((stop, -cores, -memory))
+    events.sort(key=lambda e: e[0])
+
+    steps = []
+    cores = 0
+    memory = 0
+    previous = None
+    for time, d_cores, d_memory in events:
+        if previous is not None and time > previous and cores > 0:
+            steps.append((previous, time, cores, memory))
+        cores += d_cores
+        memory += d_memory
+        previous = time
+    return steps
+
+
+class AllocationRollup:
+    """Accumulates executor allocation (cores and memory over time) of apps in fixed time buckets
+    by user, queue and app tag.
+
+    Each bucket holds core_ms and memory_byte_ms, i.e. the integral of the allocation over the bucket,
+    summed over the apps, and app_ids of the apps included. The buckets of different apps are merged
+    by summation, skipping apps already included, so an app processed again is not counted twice.
+    The average allocation within a bucket is the integral divided by bucket length.
+
+    Buckets of an app are pending until confirm is called for it, i.e. its aggregations are saved.
+    """
+
+    def __init__(self, bucket_seconds=60, history_host=None):
+        self.bucket_ms = bucket_seconds * 1000
+        self.history_host = history_host
+        self._pending = {}  # app_id -> {(bucket_start_ms, user, queue, tag): [core_ms, memory_byte_ms]}
+        self._ready = {}  # app_id -> buckets confirmed for saving
+
+    def __len__(self):
+        return len({key for buckets in self._ready.values() for key in buckets})
+
+    def _add_step(self, buckets, dims, start, stop, cores, memory):
+        bucket_start = start - start % self.bucket_ms
+        while bucket_start < stop:
+            bucket_stop = bucket_start + self.bucket_ms
+            overlap = min(stop, bucket_stop) - max(start, bucket_start)
+            values = buckets.setdefault((bucket_start,) + dims, [0, 0])
+            values[0] += cores * overlap
+            values[1] += memory * overlap
+            bucket_start = bucket_stop
+
+    def add_app(self, app):
+        """Calculates allocation of all executors (driver excluded) of all attempts of the app.
+        Replaces the buckets of a previous call for the same app."""
+        tag = app.get('app_specific_data', {}).get('tag')
+        buckets = {}
+        for attempt in app.get('attempts', []):
+            props = attempt.get('environment', {}).get('sparkProperties', {})
+            dims = (attempt.get('sparkUser'), props.get('spark_yarn_queue'), tag)
+            intervals = []
+            for ex in attempt.get('allexecutors', []):
+                if ex.get('id') == 'driver':
+                    continue
+                start = ex.get('x_startTime', ex.get('addTime', attempt.get('startTime')))
+                stop = ex.get('x_stopTime', ex.get('removeTime', attempt.get('endTime')))
+                if start is None or stop is None:
+                    continue
+                intervals.append((datetime_to_utc_timestamp_ms(start),
+                                  datetime_to_utc_timestamp_ms(stop),
+                                  ex.get('totalCores', 0),
+                                  executor_memory_bytes(attempt, ex)))
+            for step in allocation_steps(intervals):
+                self._add_step(buckets, dims, *step)
+        self._ready.pop(app.get('id'), None)
+        self._pending[app.get('id')] = buckets
+
+    def confirm(self, app_id):
+        """Marks the buckets of the app to be saved by the next pop_docs. No-op for apps not added."""
+        buckets = self._pending.pop(app_id, None)
+        if buckets is not None:
+            self._ready[app_id] = buckets
+
+    def discard(self, app_id):
+        self._pending.pop(app_id, None)
+
+    def _doc_id(self, bucket_start, user, queue, tag):
+        key = f'{self.history_host}|{bucket_start}|{user}|{queue}|{tag}'
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def pop_docs(self):
+        """Returns rollup docs for all confirmed buckets and clears them.
+        Each doc has the allocation of each of its apps in 'apps': {app_id: [core_ms, memory_byte_ms]}.
+
+        :return: list of (doc_id, doc)
+        """
+        by_bucket = {}
+        for app_id, buckets in self._ready.items():
+            for key, values in buckets.items():
+                by_bucket.setdefault(key, {})[app_id] = values
+        docs = []
+        for (bucket_start, user, queue, tag), apps in by_bucket.items():
+            core_ms = sum(values[0] for values in apps.values())
+            memory_byte_ms = sum(values[1] for values in apps.values())
+            doc = {
+                'timestamp': utc_from_timestamp_ms(bucket_start),
+                'bucket_ms': self.bucket_ms,
+                'history_host': self.history_host,
+                'user': user,
+                'queue': queue,
+                'tag': tag,
+                'core_ms': core_ms,
+                'memory_byte_ms': memory_byte_ms,
+                'cores': core_ms / self.bucket_ms,
+                'memory_bytes': memory_byte_ms / self.bucket_ms,
+                'apps': apps
+            }
+            docs.append((self._doc_id(bucket_start, user, queue, tag), doc))
+        self._ready = {}
+        logger.debug(f"{len(docs)} allocation rollup buckets popped, {len(self._pending)} apps pending")
+        return docs
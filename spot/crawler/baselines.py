@@ -0,0 +1,221 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import json
+import logging
+import math
+import os
+from collections import OrderedDict
+
+from spot.crawler.commons import get_attribute
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+# metric -> (path in aggregation, direction: 1 if higher values are worse, -1 if lower values are worse)
+BASELINE_METRICS = {
+    'duration': (['attempt', 'duration'], 1),
+    'core_cost': (['attempt', 'aggs', 'summary', 'core_cost'], 1),
+    'estimated_core_efficiency': (['attempt', 'aggs', 'summary', 'estimated_core_efficiency'], -1)
+}
+
+# number of recently counted runs per tag remembered with their scores, to skip runs processed again
+RECENT_RUNS = 1000
+
+
+def _run_id(agg):
+    attempt_id = (agg.get('attempt') or {}).get('attemptId', 0)
+    return f"{agg.get('id')}-{attempt_id}"
+
+
+class RunningStats:
+    """Mean and variance of all values (Welford) and exponentially weighted mean and variance of recent values,
+    updated in O(1) per value."""
+
+    def __init__(self, n=0, mean=0.0, m2=0.0, ewm_mean=None, ewm_var=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        self.ewm_mean = ewm_mean
+        self.ewm_var = ewm_var
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else None
+
+    @property
+    def ewm_std(self):
+        return math.sqrt(self.ewm_var) if self.n > 1 else None
+
+    def update(self, x, alpha):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        if self.ewm_mean is None:
+            self.ewm_mean = x
+        else:
+            diff = x - self.ewm_mean
+            increment = alpha * diff
+            self.ewm_mean += increment
+            self.ewm_var = (1 - alpha) * (self.ewm_var + diff * increment)
+
+    @staticmethod
+    def _z(x, mean, std):
+        if mean is None or not std:
+            return None
+        return (x - mean) / std
+
+    def zscore(self, x):
+        return self._z(x, self.mean, self.std)
+
+    def ewm_zscore(self, x):
+        return self._z(x, self.ewm_mean, self.ewm_std)
+
+    def to_dict(self):
+        return self.__dict__.copy()
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+
+class TagBaselines:
+    """Per-tag baselines of duration, core cost and efficiency, kept in a local JSON file.
+
+    Each final attempt aggregation of a tagged app is scored against the baseline of its tag (score)
+    and is added to the baseline after the aggregation is saved (update). Ids and scores of the last RECENT_RUNS
+    runs counted per tag are kept, so that a run processed again is not counted twice and gets its original scores.
+    The scores are added to attempt.aggs.summary.baseline: z-scores against all previous runs
+    and against the exponentially weighted recent runs, and a 'regressed' flag when a metric is worse
+    than the recent runs by more than z_threshold standard deviations (after at least min_runs runs of the tag).
+    """
+
+    def __init__(self, path=None, ewm_alpha=0.1, z_threshold=3.0, min_runs=5):
+        self.path = path
+        self.ewm_alpha = ewm_alpha
+        self.z_threshold = z_threshold
+        self.min_runs = min_runs
+        self.regressed = 0
+        self._tags = {}  # tag -> {'counted': OrderedDict run id -> scores, 'metrics': {metric: RunningStats}}
+        self._load()
+
+    def __len__(self):
+        return len(self._tags)
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable baselines {self.path}: {e}")
+            return
+        for tag, entry in data.items():
+            self._tags[tag] = {
+                # ids without scores were stored by earlier versions
+                'counted': OrderedDict((run, None) if isinstance(run, str) else run
+                                       for run in entry.get('counted', [])),
+                'metrics': {metric: RunningStats.from_dict(stats) for metric, stats in entry['metrics'].items()}
+            }
+        logger.debug(f"loaded baselines of {len(self._tags)} tags from {self.path}")
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {
+            tag: {
+                'counted': list(entry['counted'].items()),
+                'metrics': {metric: stats.to_dict() for metric, stats in entry['metrics'].items()}
+            } for tag, entry in self._tags.items()
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def get_stats(self, tag, metric):
+        entry = self._tags.get(tag)
+        if entry is None:
+            return None
+        return entry['metrics'].get(metric)
+
+    def _entry(self, agg):
+        """Returns the entry of the tag of a final attempt aggregation, None if it is not scored."""
+        tag = get_attribute(agg, ['app_specific_data', 'tag'])
+        if tag is None or agg.get('isFinalAttempt') is False:
+            return None
+        return self._tags.setdefault(tag, {'counted': OrderedDict(), 'metrics': {}})
+
+    def score(self, agg):
+        """Adds scores against the baseline of its tag to a final attempt aggregation.
+        A run counted before gets the scores it got before it was counted."""
+        entry = self._entry(agg)
+        if entry is None:
+            return agg
+        baseline = entry['counted'].get(_run_id(agg))
+        if baseline is None:
+            baseline = self._score(agg, entry)
+        summary = get_attribute(agg, ['attempt', 'aggs', 'summary'])
+        if summary is not None:
+            summary['baseline'] = copy.deepcopy(baseline)
+        return agg
+
+    def _score(self, agg, entry):
+        tag = get_attribute(agg, ['app_specific_data', 'tag'])
+        baseline = {}
+        regressed_metrics = []
+        for metric, (path, direction) in BASELINE_METRICS.items():
+            value = get_attribute(agg, list(path))  # get_attribute consumes the path
+            if value is None:
+                continue
+            stats = entry['metrics'].setdefault(metric, RunningStats())
+            scores = {'n': stats.n}
+            z = stats.zscore(value)
+            ewm_z = stats.ewm_zscore(value)
+            if z is not None:
+                scores['mean'] = stats.mean
+                scores['z'] = z
+            if ewm_z is not None:
+                scores['ewm_mean'] = stats.ewm_mean
+                scores['ewm_z'] = ewm_z
+                if stats.n >= self.min_runs and direction * ewm_z > self.z_threshold:
+                    regressed_metrics.append(metric)
+            baseline[metric] = scores
+
+        baseline['regressed'] = len(regressed_metrics) > 0
+        baseline['regressed_metrics'] = regressed_metrics
+        if baseline['regressed']:
+            self.regressed += 1
+            logger.info(f"Run {agg.get('id')} of {tag} regressed in {regressed_metrics}")
+        return baseline
+
+    def update(self, agg):
+        """Adds a saved final attempt aggregation to the baseline of its tag, unless it was counted before."""
+        entry = self._entry(agg)
+        if entry is None:
+            return
+        run_id = _run_id(agg)
+        counted = entry['counted']
+        if run_id in counted:
+            return
+        for metric, (path, _) in BASELINE_METRICS.items():
+            value = get_attribute(agg, list(path))
+            if value is None:
+                continue
+            entry['metrics'].setdefault(metric, RunningStats()).update(value, self.ewm_alpha)
+        counted[run_id] = get_attribute(agg, ['attempt', 'aggs', 'summary', 'baseline'])
+        if len(counted) > RECENT_RUNS:
+            counted.popitem(last=False)
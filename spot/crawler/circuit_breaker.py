@@ -0,0 +1,167 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from json.decoder import JSONDecodeError
+
+import requests
+
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to a server which is known to be in a bad state."""
+    pass
+
+
+def is_unavailable_error(e):
+    """True if the exception means that the server is in a bad state (rather than that the data are wrong),
+    so that the request should be retried later."""
+    if isinstance(e, (CircuitOpenError, JSONDecodeError, requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(e, requests.HTTPError):
+        return e.response is None or e.response.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """Stops requests to a server after failure_threshold consecutive failures.
+
+    While open, requests fail fast with CircuitOpenError. After a backoff starting at probe_min_seconds
+    (doubled after each failed probe up to probe_max_seconds), a single caller is allowed to send
+    a cheap health probe. A successful probe closes the breaker.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+
+    # decisions of allow_request
+    ALLOW = 'allow'
+    PROBE = 'probe'
+    REJECT = 'reject'
+
+    def __init__(self, name, failure_threshold=3, probe_min_seconds=30, probe_max_seconds=900, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.probe_min_seconds = probe_min_seconds
+        self.probe_max_seconds = probe_max_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._probe_delay = probe_min_seconds
+        self._next_probe = None
+        self._probing = False
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def is_open(self):
+        return self.state == self.OPEN
+
+    def seconds_to_probe(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0
+            return max(0.0, self._next_probe - self._clock())
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return self.ALLOW
+            if not self._probing and self._clock() >= self._next_probe:
+                self._probing = True
+                return self.PROBE
+            self.rejected += 1
+            return self.REJECT
+
+    def record_success(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                logger.info(f"{self.name} is available again, circuit closed")
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+            self._probe_delay = self.probe_min_seconds
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if self._probing:  # failed probe, back off
+                    self._probing = False
+                    self._probe_delay = min(self.probe_max_seconds, self._probe_delay * 2)
+                    self._next_probe = self._clock() + self._probe_delay
+                    logger.warning(f"{self.name} is still unavailable, next probe in {self._probe_delay} s")
+                return
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened += 1
+                self._next_probe = self._clock() + self._probe_delay
+                logger.error(f"{self.name} failed {self._failures} times in a row, circuit opened. "
+                             f"Next probe in {self._probe_delay} s")
+
+
+class RetryQueue:
+    """Apps whose processing failed because a server was unavailable, to be retried later.
+
+    Each app is retried after retry_seconds, at most max_attempts times.
+    Rejections by an open circuit breaker are not counted as attempts.
+    """
+
+    def __init__(self, retry_seconds=900, max_attempts=10, clock=time.monotonic):
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+        self._clock = clock
+        self._apps = OrderedDict()  # app id -> (app, due time)
+        self._attempts = {}  # app id -> failed attempts, kept until the app succeeds or is given up
+
+    def __len__(self):
+        return len(self._apps)
+
+    def __contains__(self, app_id):
+        return app_id in self._apps
+
+    def park(self, app, e):
+        """Adds an app to the queue. Returns False if it has no attempts left."""
+        app_id = app.get('id')
+        self._apps.pop(app_id, None)
+        attempts = self._attempts.get(app_id, 0)
+        if not isinstance(e, CircuitOpenError):
+            attempts += 1
+        if attempts >= self.max_attempts:
+            self._attempts.pop(app_id, None)
+            return False
+        self._attempts[app_id] = attempts
+        self._apps[app_id] = (app, self._clock() + self.retry_seconds)
+        logger.info(f"App {app_id} parked for retry ({attempts} failed attempts): {e.__class__.__name__}")
+        return True
+
+    def remove(self, app_id):
+        """Removes a parked app, e.g. when it is listed and processed again."""
+        self._apps.pop(app_id, None)
+
+    def done(self, app_id):
+        """Forgets failed attempts of an app after it was processed."""
+        self._apps.pop(app_id, None)
+        self._attempts.pop(app_id, None)
+
+    def pop_due(self):
+        """Removes and returns apps due for a retry, in the order they were parked."""
+        now = self._clock()
+        due = [app_id for app_id, (_, due_time) in self._apps.items() if due_time <= now]
+        return [self._apps.pop(app_id)[0] for app_id in due]
@@ -23,6 +23,12 @@ logger = logging.getLogger(__name__)
 
 HDFS_block_size = (128 * 1024 * 1024)
 
+# defaults of the flattener, kept here so that they can be used without importing pandas
+# number of the most expensive jobs and SQL executions kept in aggregations of an attempt
+DEFAULT_TOP_N = 10
+# executors or stages of an attempt above which they are aggregated online, without a DataFrame
+ONLINE_AGGREGATION_THRESHOLD = 20000
+
 size_units = {
     'k': 1024,
     'm': 1024 ** 2,
@@ -0,0 +1,119 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+_create_table = """
+CREATE TABLE IF NOT EXISTS content_hashes (
+    doc_index TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    stored_at REAL NOT NULL,
+    PRIMARY KEY (doc_index, uid)
+)"""
+
+# fields which change with each processing of the same data
+_volatile_spot_fields = ['time_processed']
+
+
+def fingerprint(doc):
+    """Returns (digest, size in bytes) of the JSON of a doc without the volatile fields."""
+    spot = doc.get('spot')
+    if isinstance(spot, dict):
+        doc = dict(doc)
+        doc['spot'] = {key: value for key, value in spot.items() if key not in _volatile_spot_fields}
+    data = json.dumps(doc, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(data).hexdigest(), len(data)
+
+
+class ContentHashStore:
+    """Local store of the fingerprints of docs written to Elasticsearch, keyed by index and doc id,
+    used to skip writes of docs whose content did not change (e.g. apps reprocessed after a restart
+    or in overlapping time windows). Fingerprints not written or confirmed for retention_hours are removed,
+    the store is pruned once an hour.
+
+    The store does not see deletions in Elasticsearch: fingerprints of apps which are missing there
+    have to be removed with forget_apps before the apps are written again.
+    """
+
+    def __init__(self, path, retention_hours=336):
+        self._path = path
+        self._retention_seconds = retention_hours * 3600
+        self._conn = None
+        self._next_prune = None
+        self.written = 0
+        self.skipped = 0
+        self.skipped_bytes = 0
+
+    def _connection(self):
+        if self._conn is None:
+            logger.debug(f"opening content hash store {self._path}")
+            self._conn = sqlite3.connect(self._path, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(_create_table)
+            self._conn.commit()
+        return self._conn
+
+    def _maybe_prune(self, conn):
+        now = time.time()
+        if self._next_prune is not None and now < self._next_prune:
+            return
+        deleted = conn.execute('DELETE FROM content_hashes WHERE stored_at < ?',
+                               (now - self._retention_seconds,)).rowcount
+        logger.debug(f"{deleted} expired content hashes removed")
+        self._next_prune = now + 3600
+
+    def is_unchanged(self, index, uid, digest, size):
+        """True if the doc was written with the same digest before. The write is counted as skipped
+        and the fingerprint is kept for another retention period."""
+        conn = self._connection()
+        row = conn.execute('SELECT digest FROM content_hashes WHERE doc_index = ? AND uid = ?',
+                           (index, uid)).fetchone()
+        if row is None or row[0] != digest:
+            return False
+        conn.execute('UPDATE content_hashes SET stored_at = ? WHERE doc_index = ? AND uid = ?',
+                     (time.time(), index, uid))
+        conn.commit()
+        self.skipped += 1
+        self.skipped_bytes += size
+        return True
+
+    def put(self, index, uid, digest):
+        """Records the digest of a written doc."""
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO content_hashes (doc_index, uid, digest, stored_at) VALUES (?, ?, ?, ?)',
+                     (index, uid, digest, time.time()))
+        self._maybe_prune(conn)
+        conn.commit()
+        self.written += 1
+
+    def forget_apps(self, app_ids):
+        """Removes fingerprints of raw docs (uid: app id) and aggregations (uid: app id-attempt id) of the apps,
+        so that their next writes are not skipped."""
+        conn = self._connection()
+        for app_id in app_ids:
+            prefix = f'{app_id}-'
+            conn.execute('DELETE FROM content_hashes WHERE uid = ? OR substr(uid, 1, ?) = ?',
+                         (app_id, len(prefix), prefix))
+        conn.commit()
+
+    def get_stats(self):
+        return {'written': self.written, 'skipped': self.skipped, 'skipped_bytes': self.skipped_bytes}
@@ -12,6 +12,8 @@
 # limitations under the License.
 
 import logging
+import os
+import socket
 import time
 import sys
 
@@ -22,16 +24,22 @@ from json.decoder import JSONDecodeError
 from urllib.parse import urlparse
 
 from spot.utils.config import SpotConfig
-from spot.crawler.flattener import flatten_app
 from spot.crawler.aggregator import HistoryAggregator
+from spot.crawler.event_log import EventLogAggregator
 from spot.crawler.elastic import Elastic
 from spot.crawler.crawler_args import CrawlerArgs
-from spot.crawler.commons import default_enrich
-from spot.utils.auth import auth_config
+from spot.crawler.commons import default_enrich, sizeof_fmt, DEFAULT_TOP_N, ONLINE_AGGREGATION_THRESHOLD
+from spot.crawler.allocation_rollup import AllocationRollup
+from spot.crawler.rate_limiter import AdaptiveRateLimiter
+from spot.crawler.dead_letters import DeadLetterStore
+from spot.crawler.content_hash import ContentHashStore
+from spot.crawler.profiler import AppProfiler, NullProfiler
+from spot.crawler.circuit_breaker import CircuitBreaker, RetryQueue, is_unavailable_error
+from spot.crawler.baselines import TagBaselines
+from spot.crawler.sharding import ShardMembership
+from spot.yarn.join_cache import YarnJoinCache, YarnJoinBuffer
 import spot.utils.setup_logger
 
-from spot.enceladus.menas_aggregator import MenasAggregator
-
 logger = logging.getLogger(__name__)
 
 
@@ -39,6 +47,13 @@ def _include_all_filter(app_name):
     return True
 
 
+def get_history_host(spark_history_url):
+    """Host recorded with the apps: Spark History host, or the local host when reading event logs only."""
+    if spark_history_url:
+        return urlparse(spark_history_url).hostname
+    return socket.gethostname()
+
+
 class DefaultSaver:
 
     def __init__(self):
@@ -56,10 +71,22 @@ class DefaultSaver:
     def save_err(app):
         pprint(app)
 
+    @staticmethod
+    def save_allocation_rollup(docs):
+        pprint(docs)
+
     @staticmethod
     def log_indexes_stats():
         pass
 
+    @staticmethod
+    def forget_written(app_ids):
+        pass
+
+    @staticmethod
+    def get_write_stats():
+        return None
+
 
 class Crawler:
 
@@ -76,12 +103,33 @@ class Crawler:
                  time_step_seconds=3600,
                  skip_exceptions=False,
                  retry_attempts=24,
-                 retry_sleep_seconds=900):
-        self._agg = HistoryAggregator(spark_history_url, ssl_path=ssl_path)
-        self._history_host = urlparse(spark_history_url).hostname
+                 retry_sleep_seconds=900,
+                 rollup_obj=None,
+                 yarn_join_obj=None,
+                 aggregator=None,
+                 quantile_sketches=False,
+                 baselines_obj=None,
+                 top_n=DEFAULT_TOP_N,
+                 dead_letters_obj=None,
+                 online_threshold=ONLINE_AGGREGATION_THRESHOLD,
+                 profiler=None,
+                 shard_obj=None):
+        # aggregator replaces Spark History as the source of apps, e.g. EventLogAggregator
+        self._agg = aggregator or HistoryAggregator(spark_history_url, ssl_path=ssl_path)
+        self._history_host = get_history_host(spark_history_url)
         self._name_filter_func = name_filter_func
         self._save_obj = save_obj
         self._app_specific_obj = app_specific_obj
+        self._rollup_obj = rollup_obj
+        self._yarn_join_obj = yarn_join_obj
+        self._quantile_sketches = quantile_sketches
+        self._top_n = top_n
+        self._online_threshold = online_threshold
+        self._profiler = profiler or NullProfiler()
+        self._baselines_obj = baselines_obj
+        self._dead_letters_obj = dead_letters_obj
+        # processes only the apps assigned to this replica, e.g. ShardMembership
+        self._shard_obj = shard_obj
         self.skip_exceptions = skip_exceptions
         self.completion_timeout_seconds = completion_timeout_seconds
 
@@ -99,7 +147,8 @@ class Crawler:
         self.time_step_seconds = time_step_seconds
         self.retry_sleep_seconds = retry_sleep_seconds
         self.retry_attempts = retry_attempts
-        self.retry_attempts_remained = self.retry_attempts
+        # apps which failed while Spark History was unavailable
+        self._retry_queue = RetryQueue(retry_seconds=retry_sleep_seconds, max_attempts=retry_attempts)
 
         self._latest_seen_date = last_date
         # list of apps with the same last date, seen in the previous iteration
@@ -107,7 +156,8 @@ class Crawler:
         # tabu list being constructed for the next iteration
         self._new_tabu_set = set()
 
-    def _handle_processing_exception_(self, e, stage_name, id='unknown'):
+    def _handle_processing_exception_(self, e, stage_name, id='unknown', payload=None):
+        """Saves the error. With a dead letter store, the payload needed to repeat the stage is kept for a retry."""
         error_msg = str(e)
         logger.warning(
             f"Failed to process {stage_name} for app: {id} error: {error_msg}")
@@ -124,102 +174,230 @@ class Crawler:
             }
         }
         self._save_obj.save_err(err)
+        if self._dead_letters_obj is not None and payload is not None:
+            try:
+                self._dead_letters_obj.put(id, stage_name, e, payload)
+            except Exception as store_error:
+                logger.error(f"Failed to store dead letter of {stage_name} for app: {id} error: {store_error}")
         if not self.skip_exceptions:
             logger.warning('Skipping malformed metadata is disabled')
             raise e
 
-    def _process_raw(self, app):
+    def _process_raw(self, app, fetched=False):
+        """
+        :param fetched: the app data were already fetched, e.g. before a failure of enrichment
+        """
         # add data
         try:
-            self._agg.add_app_data(app)
-            app = default_enrich(app)
-            if self._app_specific_obj:
-                if self._app_specific_obj.is_matching_app(app):
-                    app = self._app_specific_obj.enrich(app)
+            if not fetched:
+                with self._profiler.phase('fetch'):
+                    self._agg.add_app_data(app)
+                fetched = True
+            with self._profiler.phase('enrich'):
+                app = default_enrich(app)
+                if self._app_specific_obj:
+                    if self._app_specific_obj.is_matching_app(app):
+                        app = self._app_specific_obj.enrich(app)
 
             # save
-            self._save_obj.save_app(app)
-            self.retry_attempts_remained = self.retry_attempts  # reset retries after successful attempt
+            with self._profiler.phase('save'):
+                self._save_obj.save_app(app)
+            self._retry_queue.done(app.get('id'))
+            if self._dead_letters_obj is not None:
+                self._dead_letters_obj.remove(app.get('id'), 'raw')
             return True
 
         except Exception as e:
-            self._handle_processing_exception_(e, 'raw', app.get('id', 'unknown'))
+            if is_unavailable_error(e):
+                if isinstance(e, JSONDecodeError):
+                    logger.error(f"Spark history responded with a wrong format. "
+                                 f"Please, reboot Spark History server.")
+                # park the app instead of waiting, other apps and steps continue
+                if self._retry_queue.park(app, e):
+                    return False
+                logger.error(f"No retry attempts left for app: {app.get('id', 'unknown')}")
+            self._handle_processing_exception_(e, 'raw', app.get('id', 'unknown'),
+                                               payload={'app': app, 'fetched': fetched})
             # if skip_exceptions is set to False, the code will exit by this point
-            if isinstance(e, JSONDecodeError) and str(e).startswith("Expecting value:"):
-                # Error due to Spark History is in a bad state
-                logger.error(f"Spark history responded with a wrong format. "
-                             f"Please, reboot Spark History server.")
-                if self.retry_attempts_remained > 0:
-                    # wait and retry
-                    logger.warning(f" Will retry in {self.retry_sleep_seconds} s. "
-                                   f"{self.retry_attempts_remained} retries remained")
-                    time.sleep(self.retry_sleep_seconds)
-                    self.retry_attempts_remained -= 1
-                    return self._process_raw(app)
-                else:
-                    # no retry attempts left
-                    logger.error("No retry attempts left")
-                    raise e
-
             return False
 
     def _process_aggs(self, app):
+        # the flattener imports pandas, it is loaded with the first app to be aggregated
+        from spot.crawler.flattener import flatten_app
         # get aggregations
         try:
-            if self._app_specific_obj:
-                if self._app_specific_obj.is_matching_app(app):
-                    app = self._app_specific_obj.aggregate(app)
-
-            aggs = flatten_app(app)
-
-            # save aggregations
-            for agg in aggs:
+            with self._profiler.phase('flatten'):
                 if self._app_specific_obj:
                     if self._app_specific_obj.is_matching_app(app):
-                        agg = self._app_specific_obj.post_aggregate(agg)
-                self._save_obj.save_agg(agg)
+                        app = self._app_specific_obj.aggregate(app)
+
+                aggs = []
+                for agg in flatten_app(app, sketches=self._quantile_sketches, top_n=self._top_n,
+                                       online_threshold=self._online_threshold):
+                    if self._app_specific_obj:
+                        if self._app_specific_obj.is_matching_app(app):
+                            agg = self._app_specific_obj.post_aggregate(agg)
+                    if self._baselines_obj is not None:
+                        agg = self._baselines_obj.score(agg)
+                    aggs.append(agg)
+
+            # executors times are available after flattening,
+            # the allocation is saved with the aggregations, which may be parked in the YARN join buffer
+            if self._rollup_obj is not None:
+                self._rollup_obj.add_app(app)
+
+            # save aggregations
+            with self._profiler.phase('save'):
+                for agg in aggs:
+                    self._save_agg(agg)
+
+            if self._dead_letters_obj is not None:
+                self._dead_letters_obj.remove(app.get('id'), 'aggregations')
             return True
         except Exception as e:
-            self._handle_processing_exception_(e, 'aggregations', app.get('id', 'unknown'))
+            if self._rollup_obj is not None:
+                self._rollup_obj.discard(app.get('id'))
+            self._handle_processing_exception_(e, 'aggregations', app.get('id', 'unknown'), payload={'app': app})
             return False
 
-    def _process_app(self, app):
+    def _store_agg(self, agg):
+        # aggregations parked in the YARN join buffer or retried are saved later than their app was processed,
+        # readers of new aggregations (e.g. the regression trainer) rely on the time of the save
+        agg['spot'] = dict(agg.get('spot') or {}, time_processed=datetime.now(tz=timezone.utc))
+        self._save_obj.save_agg(agg)
+        if self._baselines_obj is not None:
+            self._baselines_obj.update(agg)
+        if self._rollup_obj is not None:
+            self._rollup_obj.confirm(agg.get('id'))
+
+    def _save_agg(self, agg):
+        if self._yarn_join_obj is None:
+            self._store_agg(agg)
+            return
+        for ready_agg in self._yarn_join_obj.join(agg):
+            self._store_agg(ready_agg)
+
+    def flush(self, final=False):
+        """Saves the accumulated allocation rollup, the aggregations released from the YARN join buffer
+        and the per-tag baselines.
+
+        :param final: release all aggregations pending in the YARN join buffer
+        """
+        if self._yarn_join_obj is not None:
+            for agg in self._yarn_join_obj.pop_ready(release_all=final):
+                try:
+                    self._store_agg(agg)
+                except Exception as e:
+                    self._handle_processing_exception_(e, 'aggregations', agg.get('id', 'unknown'))
+        if self._rollup_obj is not None and len(self._rollup_obj) > 0:
+            try:
+                self._save_obj.save_allocation_rollup(self._rollup_obj.pop_docs())
+            except Exception as e:
+                self._handle_processing_exception_(e, 'allocation_rollup', 'n/a')
+        if self._baselines_obj is not None:
+            self._baselines_obj.save()
+        self._profiler.write_report()
+
+    def _get_pending_ids(self):
+        if self._yarn_join_obj is None:
+            return set()
+        return self._yarn_join_obj.pending_app_ids()
+
+    def _get_dead_letter_ids(self):
+        if self._dead_letters_obj is None:
+            return set()
+        return self._dead_letters_obj.app_ids()
+
+    def _owns(self, app_id):
+        return self._shard_obj is None or self._shard_obj.owns(app_id)
+
+    def process_retry_queue(self):
+        """Processes apps parked while Spark History was unavailable, which are due for a retry.
+
+        :return: number of retried apps
+        """
+        apps = self._retry_queue.pop_due()
+        if not apps:
+            return 0
+        logger.info(f"Retrying {len(apps)} parked apps, {len(self._retry_queue)} remain parked")
+        for app in apps:
+            if not self._owns(app.get('id')):
+                # the app is not stored, its owner processes it when it lists the app
+                logger.debug(f"dropping parked app of another replica: {app.get('id')}")
+                continue
+            self._process_app(app)
+        self.flush()
+        return len(apps)
+
+    def process_dead_letters(self, limit=100):
+        """Repeats the failed stages of apps from the dead letter store which are due for a retry.
+
+        Raw data are not fetched again if they were fetched before the failure
+        and aggregations are rebuilt from the stored raw app.
+        :return: number of retried entries
+        """
+        if self._dead_letters_obj is None:
+            return 0
+        letters = self._dead_letters_obj.due(limit=limit)
+        if not letters:
+            return 0
+        logger.info(f"Retrying {len(letters)} failed stages from the dead letter store")
+        for app_id, stage, attempts, payload in letters:
+            if stage in ('raw', 'aggregations') and not self._owns(app_id):
+                # the failed app is not stored, its owner processes it when it lists the app
+                logger.info(f"removing dead letter {stage} of app {app_id} owned by another replica")
+                self._dead_letters_obj.remove(app_id, stage)
+                continue
+            logger.debug(f"retrying {stage} of app {app_id}, attempt {attempts + 1}")
+            if stage == 'raw':
+                self._process_app(payload['app'], fetched=payload['fetched'])
+            elif stage == 'aggregations':
+                self._process_aggs(payload['app'])
+            elif stage == 'listing':
+                try:
+                    self.process_runs_within_time_step(payload['min_end_date'], payload['max_end_date'])
+                except Exception as e:
+                    # the failure is stored again by the listing
+                    logger.warning(f"Retry of {app_id} failed: {e}")
+            else:
+                logger.warning(f"Unknown stage {stage} of dead letter {app_id}, removing")
+                self._dead_letters_obj.remove(app_id, stage)
+        self.flush()
+        return len(letters)
+
+    def _process_app(self, app, fetched=False):
+        self._retry_queue.remove(app.get('id'))  # a parked app could be listed again
         app['history_host'] = self._history_host
         app['spot'] = {
             'time_processed': datetime.now(tz=timezone.utc),
             'history_host': self._history_host
         }
-        success = self._process_raw(app)
-        if success:  # if no exceptions while getting data
-            self._process_aggs(app)
+        with self._profiler.app(app.get('id')):
+            success = self._process_raw(app, fetched=fetched)
+            if success:  # if no exceptions while getting data
+                self._process_aggs(app)
 
     def _get_next_completed_app(self, min_end_date=None, max_end_date=None):
+        listing_id = f"listing {min_end_date} - {max_end_date}"
         try:
             apps = self._agg.next_app(min_end_date=min_end_date,
                                       max_end_date=max_end_date,
                                       app_status='completed')
             for app in apps:
-                self.retry_attempts_remained = self.retry_attempts  # reset retries after successful attempt
                 yield app
+            if self._dead_letters_obj is not None:
+                self._dead_letters_obj.remove(listing_id, 'listing')
         except Exception as e:
-            self._handle_processing_exception_(e, 'listing', 'n/a')
+            if is_unavailable_error(e):
+                # the interval is listed again in the next pass, as its apps are not stored
+                logger.warning(f"Spark History unavailable, skipping apps completed "
+                               f"from {min_end_date} to {max_end_date}: {e}")
+                return
+            payload = None
+            if min_end_date is not None and max_end_date is not None:
+                payload = {'min_end_date': min_end_date, 'max_end_date': max_end_date}
+            self._handle_processing_exception_(e, 'listing', listing_id, payload=payload)
             # if skip_exceptions is set to False, the code will exit by this point
-            if isinstance(e, JSONDecodeError) and str(e).startswith("Expecting value:"):
-                # Error due to Spark History is in a bad state
-                logger.error(f"Spark history responded with a wrong format. "
-                             f"Please, reboot Spark History server.")
-                if self.retry_attempts_remained > 0:
-                    # wait and retry
-                    logger.warning(f" Will retry in {self.retry_sleep_seconds} s. "
-                                   f"{self.retry_attempts_remained} retries remaining")
-                    time.sleep(self.retry_sleep_seconds)
-                    self.retry_attempts_remained -= 1
-                    return self._get_next_completed_app(min_end_date=min_end_date, max_end_date=max_end_date)
-                else:
-                    logger.error("No retry attempts left")
-                    raise e
-
-            # other unknown exception
             raise e
 
     def process_runs_within_time_step(self, start_time, finish_time):
@@ -240,26 +418,44 @@ class Crawler:
             f"Processing completed apps within the time step from {start_time} to {finish_time}")
         apps = self._get_next_completed_app(min_end_date=start_time,
                                   max_end_date=finish_time)
-        tabu_ids = self._save_obj.get_set_of_processed_ids(start_time, finish_time)
+        tabu_ids = self._save_obj.get_set_of_processed_ids(start_time, finish_time,
+                                                           time_field=self._agg.listing_time_field)
+        # processed apps waiting for YARN fields are not stored yet
+        tabu_ids |= self._get_pending_ids()
+        # failed apps are retried only by process_dead_letters, with its backoff and max_attempts
+        tabu_ids |= self._get_dead_letter_ids()
 
         apps_counter = 0
         matched_counter = 0
         new_counter = 0
 
+        new_apps = []
         for app in apps:
             apps_counter += 1
             app_id = app.get('id')
             app_name = app.get('name')
             if self._name_filter_func(app_name):
                 matched_counter += 1
-                if app_id not in tabu_ids:
-                    new_counter += 1
-                    self._process_app(app)
-                    if new_counter % 20 == 0:
-                        self.log_processing_stats(processing_start, new_counter)
-                else:
+                if app_id in tabu_ids:
                     logger.debug(f"skipping app already processed before: {app_id} ")
-
+                elif not self._owns(app_id):
+                    logger.debug(f"skipping app of another replica: {app_id} ")
+                else:
+                    new_apps.append(app)
+
+        if new_apps:
+            # the apps are missing in the database, previous writes of their docs must not be skipped
+            self._save_obj.forget_written([app.get('id') for app in new_apps])
+        if hasattr(self._agg, 'prefetch'):
+            # the aggregator can load data of the next apps in parallel
+            self._agg.prefetch(new_apps)
+        for app in new_apps:
+            new_counter += 1
+            self._process_app(app)
+            if new_counter % 20 == 0:
+                self.log_processing_stats(processing_start, new_counter)
+
+        self.flush()
         logger.debug(f"Time step {start_time} to {finish_time} processed. "
                     f"Applications total:{apps_counter}, matched: {matched_counter}, new: {new_counter}")
         if new_counter > 0:
@@ -309,6 +505,10 @@ class Crawler:
 
         :return: number of new processed runs
         """
+        if self._shard_obj is not None:
+            self._shard_obj.maybe_refresh()
+        self.process_retry_queue()
+        self.process_dead_letters()
         time_now = datetime.now(tz=timezone.utc)
         # interval to look back
         min_completion_time = time_now - self.lookback_delta
@@ -332,6 +532,10 @@ class Crawler:
 
         :return: list of new runs
         """
+        if self._shard_obj is not None:
+            self._shard_obj.maybe_refresh()
+        self.process_retry_queue()
+        self.process_dead_letters()
         processing_start = datetime.now(tz=timezone.utc)
         max_end_date = processing_start - timedelta(seconds=self.completion_timeout_seconds)
 
@@ -351,13 +555,14 @@ class Crawler:
                 new_counter += 1
                 app_name = app.get('name')
                 # filter apps of interest
-                if self._name_filter_func(app_name):
+                if self._name_filter_func(app_name) and self._owns(app_id):
                     matched_counter += 1
                     self._process_app(app)
                     if matched_counter % 20 == 0:
                         self.log_processing_stats(processing_start, matched_counter)
 
         self._previous_tabu_set = self._new_tabu_set
+        self.flush()
 
         logger.info(f"Iteration finished. New apps: {new_counter} "
                     f"matching apps : {matched_counter}")
@@ -397,30 +602,132 @@ class Crawler:
         logger.info(f"processed {runs_number} runs "
                     f"in {delta_seconds} seconds "
                     f"average rate: {per_hour} runs/hour")
+        rate_limiter = getattr(self._agg, 'rate_limiter', None)
+        if rate_limiter is not None:
+            stats = rate_limiter.get_stats()
+            logger.info(f"Spark History requests: {stats['requests']}, "
+                        f"current limits: {stats['rate']:.2f} requests/s, "
+                        f"{stats['concurrency_limit']} concurrent, "
+                        f"throttled: {stats['throttled']} times for {stats['throttled_seconds']:.1f} s, "
+                        f"limit decreases: {stats['decreases']}")
+        circuit_breaker = getattr(self._agg, 'circuit_breaker', None)
+        if circuit_breaker is not None and (circuit_breaker.is_open or len(self._retry_queue) > 0):
+            logger.info(f"Spark History circuit: {circuit_breaker.state}, "
+                        f"opened {circuit_breaker.opened} times, rejected requests: {circuit_breaker.rejected}, "
+                        f"parked apps: {len(self._retry_queue)}")
+        write_stats = self._save_obj.get_write_stats()
+        if write_stats is not None and write_stats['skipped'] > 0:
+            logger.info(f"unchanged docs not written: {write_stats['skipped']} "
+                        f"({sizeof_fmt(write_stats['skipped_bytes'])}), written: {write_stats['written']}")
+        if self._shard_obj is not None:
+            logger.info(f"replica {self._shard_obj.member} of {len(self._shard_obj.members)}, "
+                        f"apps owned: {self._shard_obj.owned}, "
+                        f"skipped apps of other replicas: {self._shard_obj.skipped}")
+        if self._dead_letters_obj is not None and len(self._dead_letters_obj) > 0:
+            stats = self._dead_letters_obj.get_stats()
+            logger.info(f"dead letters pending retry: {stats['pending']}, given up: {stats['exhausted']}")
         self._save_obj.log_indexes_stats()
 
 
+def menas_aggregator_from_config(conf):
+    if conf.menas_api_url is None:
+        logger.info(
+            'Menas integration disabled as api url not provided in config')
+        return None
+    logger.info(f"adding Menas aggregator, api url {conf.menas_api_url}")
+    from spot.enceladus.menas_aggregator import MenasAggregator
+    menas_default_tzinfo = tz.gettz(name=conf.menas_default_timezone)
+    if menas_default_tzinfo is None:
+        menas_default_tzinfo = tz.tzutc()
+    return MenasAggregator(conf.menas_api_url,
+                           conf.menas_username,
+                           conf.menas_password,
+                           ssl_path=conf.menas_ssl_path,
+                           default_tzinfo=menas_default_tzinfo)
+
+
 def main():
     logger.info(f'Starting crawler')
     cmd_args = CrawlerArgs().parse_args()
     conf = SpotConfig()
 
-    if conf.menas_api_url is not None:
-        logger.info(f"adding Menas aggregator, api url {conf.menas_api_url}")
-        menas_default_tzinfo = tz.gettz(name=conf.menas_default_timezone)
-        if menas_default_tzinfo is None:
-            menas_default_tzinfo = tz.tzutc()
-        menas_ag = MenasAggregator(conf.menas_api_url,
-                                   conf.menas_username,
-                                   conf.menas_password,
-                                   ssl_path=conf.menas_ssl_path,
-                                   default_tzinfo=menas_default_tzinfo)
-    else:
-        menas_ag = None
-        logger.info(
-            'Menas integration disabled as api url not provided in config')
+    menas_ag = menas_aggregator_from_config(conf)
+
+    content_hashes = None
+    if conf.content_hash_path is not None:
+        logger.info(f"Writes of unchanged docs are skipped, content hashes: {conf.content_hash_path}")
+        content_hashes = ContentHashStore(conf.content_hash_path, retention_hours=conf.content_hash_retention_hours)
 
-    elastic = Elastic(conf)
+    elastic = Elastic(conf, content_hashes=content_hashes)
+    history_host = get_history_host(conf.spark_history_url)
+
+    if conf.event_log_dir is not None:
+        logger.info(f"Reading Spark event logs from {conf.event_log_dir} instead of Spark History")
+        history_agg = EventLogAggregator(conf.event_log_dir, parse_workers=conf.event_log_parse_workers)
+    else:
+        rate_limiter = None
+        if conf.history_max_requests_per_second is not None:
+            rate_limiter = AdaptiveRateLimiter(max_rate=conf.history_max_requests_per_second,
+                                               max_concurrency=conf.history_max_concurrent_requests,
+                                               latency_target_seconds=conf.history_latency_target_seconds)
+        circuit_breaker = CircuitBreaker(f"Spark History {history_host}",
+                                         failure_threshold=conf.history_circuit_failure_threshold,
+                                         probe_min_seconds=conf.history_circuit_probe_min_seconds,
+                                         probe_max_seconds=conf.history_circuit_probe_max_seconds)
+        history_agg = HistoryAggregator(conf.spark_history_url,
+                                        ssl_path=conf.history_ssl_path,
+                                        fetch_jobs=conf.history_fetch_jobs,
+                                        fetch_sql=conf.history_fetch_sql,
+                                        rate_limiter=rate_limiter,
+                                        circuit_breaker=circuit_breaker)
+
+    rollup = None
+    if conf.elastic_rollup_index is not None:
+        logger.info(f"Allocation rollup enabled, index: {conf.elastic_rollup_index}")
+        rollup = AllocationRollup(bucket_seconds=conf.rollup_bucket_seconds,
+                                  history_host=history_host)
+
+    yarn_join = None
+    if conf.yarn_join_cache_path is not None:
+        logger.info(f"Enrichment with YARN fields enabled, join cache: {conf.yarn_join_cache_path}")
+        yarn_join = YarnJoinBuffer(YarnJoinCache(conf.yarn_join_cache_path,
+                                                 retention_hours=conf.yarn_join_cache_retention_hours),
+                                   max_pending=conf.yarn_join_pending_max,
+                                   pending_seconds=conf.yarn_join_pending_seconds)
+
+    dead_letters = None
+    if conf.dead_letter_path is not None:
+        logger.info(f"Dead letter store of failed apps enabled: {conf.dead_letter_path}")
+        dead_letters = DeadLetterStore(conf.dead_letter_path,
+                                       max_attempts=conf.dead_letter_max_attempts,
+                                       backoff_seconds=conf.dead_letter_backoff_seconds)
+
+    profiler = None
+    if conf.profiling_dir is not None:
+        logger.info(f"Profiling of apps enabled, profiles and report: {conf.profiling_dir}")
+        profiler = AppProfiler(conf.profiling_dir,
+                               sample_every=conf.profiling_sample_every,
+                               time_budget_seconds=conf.profiling_time_budget_seconds,
+                               keep_files=conf.profiling_keep_files,
+                               trace_memory=conf.profiling_trace_memory)
+
+    baselines = None
+    if conf.baselines_path is not None:
+        logger.info(f"Per-tag baselines enabled, state: {conf.baselines_path}")
+        baselines = TagBaselines(conf.baselines_path,
+                                 ewm_alpha=conf.baselines_ewm_alpha,
+                                 z_threshold=conf.baselines_z_threshold,
+                                 min_runs=conf.baselines_min_runs)
+
+    shard = None
+    if conf.crawler_sharding:
+        replica_id = conf.crawler_replica_id or f"{socket.gethostname()}-{os.getpid()}"
+        logger.info(f"Sharding of apps enabled, replica {replica_id}, leases: {conf.elastic_lease_index}")
+        if conf.crawler_method != 'all':
+            logger.warning(f"Apps of stopped replicas are taken over only with crawler_method 'all'")
+        shard = ShardMembership(elastic, f"crawler {history_host}", replica_id,
+                                lease_seconds=conf.crawler_lease_seconds)
+        shard.start()
 
     # find starting end date and list of seen apps
     last_seen_end_date, seen_ids = elastic.get_latest_time_ids()
@@ -449,7 +756,17 @@ def main():
                       lookback_hours=conf.lookback_hours,
                       time_step_seconds=conf.time_step_seconds,
                       retry_sleep_seconds=conf.retry_sleep_seconds,
-                      retry_attempts=conf.retry_attempts
+                      retry_attempts=conf.retry_attempts,
+                      rollup_obj=rollup,
+                      yarn_join_obj=yarn_join,
+                      aggregator=history_agg,
+                      quantile_sketches=conf.crawler_quantile_sketches,
+                      baselines_obj=baselines,
+                      top_n=conf.crawler_top_n,
+                      dead_letters_obj=dead_letters,
+                      online_threshold=conf.crawler_online_aggregation_threshold,
+                      profiler=profiler,
+                      shard_obj=shard
                       )
 
     sleep_seconds = conf.crawler_sleep_seconds
@@ -461,6 +778,11 @@ def main():
         crawler.process_new_runs()
         elastic.log_indexes_stats()
         if batch:
+            crawler.flush(final=True)
+            if shard is not None:
+                shard.stop()
+            if hasattr(history_agg, 'close'):
+                history_agg.close()
             break
         time.sleep(sleep_seconds)
 
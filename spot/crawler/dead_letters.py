@@ -0,0 +1,114 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import pickle
+import sqlite3
+import time
+
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+_create_table = """
+CREATE TABLE IF NOT EXISTS dead_letters (
+    app_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    failed_at REAL NOT NULL,
+    next_retry REAL,
+    error_type TEXT,
+    error_message TEXT,
+    payload BLOB NOT NULL,
+    PRIMARY KEY (app_id, stage)
+)"""
+
+
+class DeadLetterStore:
+    """Local store of failed processing stages of apps, keyed by app id and stage (raw, aggregations, listing).
+
+    Each entry keeps the error and the pickled payload needed to repeat the stage
+    (e.g. the fetched raw app), so that only the failed stage is reprocessed.
+    Retries are scheduled with exponential backoff from backoff_seconds up to max_backoff_seconds.
+    After max_attempts failures the entry is kept for inspection but no longer retried.
+    """
+
+    def __init__(self, path, max_attempts=5, backoff_seconds=600, max_backoff_seconds=86400):
+        self._path = path
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self._conn = None
+        self._keys = None  # (app id, stage) of stored entries, to avoid queries for apps which did not fail
+
+    def _connection(self):
+        if self._conn is None:
+            logger.debug(f"opening dead letter store {self._path}")
+            self._conn = sqlite3.connect(self._path, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(_create_table)
+            self._conn.commit()
+            self._keys = set(self._conn.execute('SELECT app_id, stage FROM dead_letters'))
+        return self._conn
+
+    def __len__(self):
+        self._connection()
+        return len(self._keys)
+
+    def put(self, app_id, stage, error, payload):
+        """Stores or updates a failed stage. Returns False if it has no retry attempts left."""
+        conn = self._connection()
+        row = conn.execute('SELECT attempts FROM dead_letters WHERE app_id = ? AND stage = ?',
+                           (app_id, stage)).fetchone()
+        attempts = (row[0] if row is not None else 0) + 1
+        now = time.time()
+        if attempts < self.max_attempts:
+            next_retry = now + min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (attempts - 1))
+        else:
+            next_retry = None
+            logger.error(f"Giving up {stage} of app {app_id} after {attempts} attempts")
+        conn.execute('INSERT OR REPLACE INTO dead_letters '
+                     '(app_id, stage, attempts, failed_at, next_retry, error_type, error_message, payload) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (app_id, stage, attempts, now, next_retry, error.__class__.__name__, str(error),
+                      pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)))
+        conn.commit()
+        self._keys.add((app_id, stage))
+        return next_retry is not None
+
+    def remove(self, app_id, stage):
+        conn = self._connection()
+        if (app_id, stage) not in self._keys:
+            return
+        conn.execute('DELETE FROM dead_letters WHERE app_id = ? AND stage = ?', (app_id, stage))
+        conn.commit()
+        self._keys.discard((app_id, stage))
+
+    def app_ids(self, stages=('raw', 'aggregations')):
+        """Returns ids of apps with stored entries of the given stages, pending or exhausted."""
+        self._connection()
+        return {app_id for app_id, stage in self._keys if stage in stages}
+
+    def due(self, limit=100):
+        """Returns up to limit entries due for a retry as (app id, stage, attempts, payload), the oldest first."""
+        conn = self._connection()
+        rows = conn.execute('SELECT app_id, stage, attempts, payload FROM dead_letters '
+                            'WHERE next_retry IS NOT NULL AND next_retry <= ? ORDER BY next_retry LIMIT ?',
+                            (time.time(), limit)).fetchall()
+        return [(app_id, stage, attempts, pickle.loads(payload)) for app_id, stage, attempts, payload in rows]
+
+    def get_stats(self):
+        conn = self._connection()
+        pending, exhausted = conn.execute('SELECT COUNT(next_retry), COUNT(*) - COUNT(next_retry) '
+                                          'FROM dead_letters').fetchone()
+        return {'pending': pending, 'exhausted': exhausted}
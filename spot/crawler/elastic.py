@@ -12,28 +12,37 @@
 # limitations under the License.
 
 import logging
+from datetime import datetime, timedelta, timezone
 import elasticsearch
 from elasticsearch.helpers import bulk
-from elasticsearch.exceptions import AuthorizationException, RequestError
+from elasticsearch.exceptions import AuthorizationException, ConflictError, RequestError, TransportError
 import re
 
 from spot.crawler.commons import sizeof_fmt, num_elements, utc_from_timestamp_ms
+from spot.crawler.content_hash import fingerprint
 from spot.utils.config import SpotConfig
 from spot.utils.auth import auth_config
+from spot.yarn.scheduler_delta import reconstruct_state
 import spot.utils.setup_logger
 
 
 logger = logging.getLogger(__name__)
 REQUEST_TIMEOUT = 30
+PAGE_SIZE = 1000
 
 
 class Elastic:
 
-    def __init__(self, conf):
+    def __init__(self, conf, content_hashes=None):
+        """
+        :param content_hashes: ContentHashStore, raw and agg docs whose content did not change are not written again
+        """
         self._conf = conf
+        self._content_hashes = content_hashes
         connection = self._conf.elasticsearch_url
         logger.debug(f'Setting Elasticsearch: {connection}')
-        http_auth = auth_config(self._conf)
+        # cognito auth is shared by all instances and refreshes its credentials before they expire
+        self._http_auth = auth_config(self._conf)
 
         self._es = elasticsearch.Elasticsearch([connection],
                                                sniff_on_start=False,
@@ -42,7 +51,7 @@ class Elastic:
                                                sniff_on_connection_fail=False,
                                                timeout=REQUEST_TIMEOUT,
                                                retry_on_timeout=True,
-                                               http_auth=http_auth,
+                                               http_auth=self._http_auth,
                                                verify_certs=False,
                                                connection_class=elasticsearch.RequestsHttpConnection)
         # Spark indexes
@@ -51,13 +60,19 @@ class Elastic:
             logger.info(f"raw index is set to None. Raw documents will not be stored.")
         self._agg_index = self._conf.elastic_agg_index
         self._err_index = self._conf.elastic_err_index
+        self._rollup_index = self._conf.elastic_rollup_index
 
         # YARN indexes
         self._yarn_clust_index = self._conf.yarn_clust_index
         self._yarn_apps_index = self._conf.yarn_apps_index
         self._yarn_scheduler_index = self._conf.yarn_scheduler_index
 
+        # leases of crawler replicas
+        self._lease_index = self._conf.elastic_lease_index
+
         self._limit_of_fields_increment = self._conf.elasticsearch_limit_of_fields_increment
+        # point in time is not available e.g. in OpenSearch, scroll is used instead
+        self._pit_supported = True
 
         logger.debug("Initializing elasticsearch, checking indexes")
         self.log_indexes_stats()
@@ -72,8 +87,7 @@ class Elastic:
             logger.debug("AuthorizationException: {0}".format(ae))
             if (ae.status_code == 403) and (self._conf.auth_type == 'cognito'):
                 logger.debug("Status code of {0} returned, token refresh required".format(ae.status_code))
-                self._es.transport.connection_pool.connections[0].session.auth = auth_config(self._conf)
-                logger.debug("Auth token refreshed")
+                self._http_auth.invalidate()
             return request_func(*args, **kwargs)
 
     def _index_not_empty(self, index):
@@ -140,20 +154,201 @@ class Elastic:
                                 preserve_existing=False,
                                 request_timeout=REQUEST_TIMEOUT)
 
+    def search_pages(self, index, query=None, source=None, sort=None, search_after=None,
+                     slice_id=0, max_slices=1, page_size=PAGE_SIZE, keep_alive='5m'):
+        """Iterates over all hits of the query in pages, using a point in time and search_after.
+
+        The number of hits is not limited and only one page is held in memory.
+        Each page is requested separately, so that the auth token can be refreshed in between.
+        :param index: index to be searched
+        :param query: query, all docs if None
+        :param source: list of fields to be returned, all fields if None
+        :param sort: sort of the hits, index order by default. The point in time adds a tiebreaker.
+        :param search_after: sort values of the last hit read before, to resume reading
+        :param slice_id: id of the slice to be read when the hits are split into max_slices
+        :param page_size: number of hits per request
+        :param keep_alive: how long the point in time is kept between requests
+        :return: generator of lists of hits, the sort values of a hit are in hit['sort']
+        """
+        pit_id = self._open_point_in_time(index, keep_alive)
+        if pit_id is None:
+            yield from self._scroll_pages(index, query, source, sort, search_after,
+                                          slice_id, max_slices, page_size, keep_alive)
+            return
+        try:
+            while True:
+                body = {
+                    'size': page_size,
+                    'query': query or {'match_all': {}},
+                    'pit': {'id': pit_id, 'keep_alive': keep_alive},
+                    'sort': sort or ['_shard_doc']
+                }
+                if source is not None:
+                    body['_source'] = source
+                if max_slices > 1:
+                    body['slice'] = {'id': slice_id, 'max': max_slices}
+                if search_after is not None:
+                    body['search_after'] = search_after
+                res = self.__do_request(self._es.search, body=body, request_timeout=REQUEST_TIMEOUT)
+                pit_id = res.get('pit_id', pit_id)
+                hits = res['hits']['hits']
+                if not hits:
+                    return
+                search_after = hits[-1]['sort']
+                yield hits
+        finally:
+            self.__do_request(self._es.close_point_in_time, body={'id': pit_id})
+
+    def _open_point_in_time(self, index, keep_alive):
+        """Returns id of a new point in time, or None if the cluster does not support it."""
+        if not self._pit_supported:
+            return None
+        try:
+            res = self.__do_request(self._es.open_point_in_time, index=index, keep_alive=keep_alive)
+        except TransportError as e:
+            if e.status_code not in [400, 404, 405]:
+                raise e
+            logger.warning(f"Point in time is not supported ({e.status_code}), using scroll")
+            self._pit_supported = False
+            return None
+        return res['id']
+
+    def _scroll_pages(self, index, query, source, sort, search_after, slice_id, max_slices, page_size, keep_alive):
+        if search_after is not None:
+            # resume after the last hit read before, sorted by a single doc field in this case
+            field = next(iter(sort[0]))
+            query = {'bool': {'filter': [query or {'match_all': {}}, {'range': {field: {'gt': search_after[0]}}}]}}
+        body = {
+            'size': page_size,
+            'query': query or {'match_all': {}},
+            'sort': sort or ['_doc']
+        }
+        if source is not None:
+            body['_source'] = source
+        if max_slices > 1:
+            body['slice'] = {'id': slice_id, 'max': max_slices}
+        res = self.__do_request(self._es.search, index=index, body=body, scroll=keep_alive,
+                                request_timeout=REQUEST_TIMEOUT)
+        scroll_id = res.get('_scroll_id')
+        try:
+            while res['hits']['hits']:
+                yield res['hits']['hits']
+                res = self.__do_request(self._es.scroll, body={'scroll_id': scroll_id, 'scroll': keep_alive},
+                                        request_timeout=REQUEST_TIMEOUT)
+                scroll_id = res.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id is not None:
+                self.__do_request(self._es.clear_scroll, body={'scroll_id': scroll_id}, ignore=[404])
+
+    def search_docs(self, index, query=None, source=None, sort=None, page_size=PAGE_SIZE):
+        """Iterates over the sources of all docs matching the query, see search_pages."""
+        for hits in self.search_pages(index, query=query, source=source, sort=sort, page_size=page_size):
+            for hit in hits:
+                yield hit['_source']
+
+    def _insert_changed_item(self, index, uid, item):
+        """Inserts an item unless the same content was written with the same uid before."""
+        if self._content_hashes is None:
+            self._insert_item(index, uid, item)
+            return
+        digest, size = fingerprint(item)
+        if self._content_hashes.is_unchanged(index, uid, digest, size):
+            logger.debug(f'uid: {uid} unchanged, not written to index {index}')
+            return
+        self._insert_item(index, uid, item)
+        self._content_hashes.put(index, uid, digest)
+
     def save_app(self, app):
         if self._raw_index is not None:
             uid = app.get('id')
-            self._insert_item(self._raw_index, uid, app)
+            self._insert_changed_item(self._raw_index, uid, app)
 
     def save_agg(self, agg):
+        self._insert_changed_item(self._agg_index, self._agg_uid(agg), agg)
+
+    @staticmethod
+    def _agg_uid(agg):
         app_id = agg.get('id')
         attempt_id = agg.get('attempt').get('attemptId', 0)
-        uid = f'{app_id}-{attempt_id}'
-        self._insert_item(self._agg_index, uid, agg)
+        return f'{app_id}-{attempt_id}'
+
+    def save_aggs(self, aggs):
+        """Saves a batch of aggregations in a single bulk request.
+        Aggregations rejected by the bulk request are saved one by one, e.g. to increase the limit of fields."""
+        aggs_by_uid = {self._agg_uid(agg): agg for agg in aggs}
+        digests = {}
+        if self._content_hashes is not None:
+            for uid, agg in list(aggs_by_uid.items()):
+                digest, size = fingerprint(agg)
+                if self._content_hashes.is_unchanged(self._agg_index, uid, digest, size):
+                    del aggs_by_uid[uid]
+                else:
+                    digests[uid] = digest
+            if not aggs_by_uid:
+                return 0
+        actions = ({'_index': self._agg_index, '_id': uid, '_source': agg} for uid, agg in aggs_by_uid.items())
+        success, errors = self.__do_request(bulk, self._es, actions, raise_on_error=False,
+                                            request_timeout=REQUEST_TIMEOUT)
+        for error in errors:
+            uid = error.get('index', {}).get('_id')
+            logger.debug(f'bulk save of {uid} failed, retrying one by one')
+            self._insert_item(self._agg_index, uid, aggs_by_uid[uid])
+        for uid, digest in digests.items():
+            self._content_hashes.put(self._agg_index, uid, digest)
+        return success
+
+    def forget_written(self, app_ids):
+        """Makes the next writes of docs of the apps unconditional, e.g. for apps missing in the indexes."""
+        if self._content_hashes is not None:
+            self._content_hashes.forget_apps(app_ids)
+
+    def get_write_stats(self):
+        """Returns the numbers of written and skipped unchanged docs and the skipped bytes,
+        None if writes are not deduplicated."""
+        if self._content_hashes is None:
+            return None
+        return self._content_hashes.get_stats()
 
     def save_err(self, app):
         self._insert_item(self._err_index, None, app)
 
+    def _prepare_allocation_rollup(self, docs):
+        for uid, doc in docs:
+            item = dict()
+            item['_id'] = uid
+            item['_index'] = self._rollup_index
+            item['_op_type'] = 'update'
+            # concurrent crawlers (e.g. replicas) may update the same bucket
+            item['retry_on_conflict'] = 5
+            apps = doc['apps']
+            # allocation of new apps is added to the stored values, apps already included are skipped
+            item['script'] = {
+                'source': 'boolean changed = false; '
+                          'for (entry in params.apps.entrySet()) { '
+                          '  if (!ctx._source.app_ids.contains(entry.getKey())) { '
+                          '    ctx._source.app_ids.add(entry.getKey()); '
+                          '    ctx._source.core_ms += entry.getValue()[0]; '
+                          '    ctx._source.memory_byte_ms += entry.getValue()[1]; '
+                          '    changed = true; '
+                          '  } '
+                          '} '
+                          'if (!changed) { ctx.op = \'noop\'; return; } '
+                          'ctx._source.cores = (double) ctx._source.core_ms / ctx._source.bucket_ms; '
+                          'ctx._source.memory_bytes = (double) ctx._source.memory_byte_ms / ctx._source.bucket_ms',
+                'lang': 'painless',
+                'params': {'apps': apps}
+            }
+            # the script adds the apps to an empty bucket as well
+            item['scripted_upsert'] = True
+            upsert = {key: value for key, value in doc.items() if key != 'apps'}
+            upsert.update({'core_ms': 0, 'memory_byte_ms': 0, 'cores': 0, 'memory_bytes': 0, 'app_ids': []})
+            item['upsert'] = upsert
+            yield item
+
+    def save_allocation_rollup(self, docs):
+        if self._rollup_index is not None:
+            res = self.__do_request(bulk, self._es, self._prepare_allocation_rollup(docs))
+
     def get_latest_time_ids(self):
         id_set = set()
         if not self._index_not_empty(self._agg_index):
@@ -178,27 +373,19 @@ class Elastic:
             return None, id_set
 
         # get list of ids fot the same date
-        body_id_list = {
-            "query": {
-                "match": {
-                    "attempt.endTime": str_max_end_time
-                }
-            },
-            "_source": ["id"]
+        query_id_list = {
+            "match": {
+                "attempt.endTime": str_max_end_time
+            }
         }
-
-        res_ids = self.__do_request(self._es.search,
-                                    index=self._agg_index,
-                                    body=body_id_list)
-
-        for hit in res_ids['hits']['hits']:
-            id_set.add(hit['_source']['id'])
+        for doc in self.search_docs(self._agg_index, query=query_id_list, source=["id"]):
+            id_set.add(doc['id'])
 
         max_end_time = utc_from_timestamp_ms(timestamp)
 
         return max_end_time, id_set
 
-    def get_processed_ids(self, end_time_min, end_time_max, size=10000):
+    def get_processed_ids(self, end_time_min, end_time_max, size=PAGE_SIZE, time_field='attempt.endTime'):
         """Queries for ids of all apps stored in aggregations
         which completed from end_time_min to end_time_max.
         It is needed to compare against app ids from Spark History
@@ -206,47 +393,76 @@ class Elastic:
 
         end_time_min -- minimum completion time of an app
         end_time_max -- maximum completion time of an app
-        size -- max number of ids to request"""
+        size -- number of ids per request, all ids are returned
+        time_field -- completion time field, by which the apps were listed"""
 
         if not self._index_not_empty(self._agg_index):
-            return []
-
-        query_body = {
-            "query": {
-                "bool": {
-                    "filter": [
-                        {
-                            "range": {
-                                "attempt.endTime": {
-                                    "from": end_time_min,
-                                    "to": end_time_max
-                                }
+            return
+
+        query = {
+            "bool": {
+                "filter": [
+                    {
+                        "range": {
+                            time_field: {
+                                "from": end_time_min,
+                                "to": end_time_max
                             }
                         }
-                    ]
-                }
-            },
-            "sort": [
-                {
-                    "attempt.endTime": {
-                        "order": "desc"
                     }
-                }
-            ],
-            "_source": ["id"],
-            "size": size
+                ]
+            }
         }
+        for doc in self.search_docs(self._agg_index, query=query, source=["id"], page_size=size):
+            yield doc.get("id")
 
-        res = self.__do_request(self._es.search,
-                                index=self._agg_index,
-                                body=query_body)
-        hits = res.get('hits').get('hits')
-        for item in hits:
-            yield item.get("_source").get("id")
+    def get_aggs_processed_since(self, time_min=None, source=None):
+        """Iterates over all aggregations saved since time_min (spot.time_processed).
+
+        :param time_min: minimum processing time (inclusive), all docs if None
+        :param source: list of fields to be returned, all fields if None
+        """
+        if not self._index_not_empty(self._agg_index):
+            return
+        query = None
+        if time_min is not None:
+            query = {'range': {'spot.time_processed': {'gte': time_min}}}
+        yield from self.search_docs(self._agg_index, query=query, source=source)
+
+    def get_raw_pages(self, query=None, slice_id=0, max_slices=1, search_after=None, page_size=200,
+                      keep_alive='5m'):
+        """Iterates over raw docs in pages sorted by app id, using a point in time and search_after.
+
+        :param query: query on raw docs, all docs if None
+        :param slice_id: id of the slice to be read when the docs are split into max_slices
+        :param search_after: sort values of the last doc processed before, to resume reading
+        :return: generator of (list of docs, sort values of the last doc in the page)
+        """
+        if self._raw_index is None or not self._index_not_empty(self._raw_index):
+            return
+        # sorted by a doc field, so that reading can be resumed with a new point in time
+        pages = self.search_pages(self._raw_index,
+                                  query=query,
+                                  sort=[{'id.keyword': 'asc'}],
+                                  search_after=search_after,
+                                  slice_id=slice_id,
+                                  max_slices=max_slices,
+                                  page_size=page_size,
+                                  keep_alive=keep_alive)
+        for hits in pages:
+            yield [hit['_source'] for hit in hits], hits[-1]['sort']
+
+    def get_aggs(self, query=None, source=None, size=PAGE_SIZE):
+        """Iterates over all aggregations matching the query.
+
+        :param source: list of fields to be returned, all fields if None
+        :param size: number of docs per request
+        """
+        yield from self.search_docs(self._agg_index, query=query, source=source, page_size=size)
 
-    def get_set_of_processed_ids(self, end_time_min, end_time_max, size=10000):
+    def get_set_of_processed_ids(self, end_time_min, end_time_max, size=PAGE_SIZE, time_field='attempt.endTime'):
         ids_set = set()
-        for app_id in self.get_processed_ids(end_time_min, end_time_max, size):
+        for app_id in self.get_processed_ids(end_time_min, end_time_max, size, time_field=time_field):
             ids_set.add(app_id)
         return ids_set
 
@@ -308,6 +524,130 @@ class Elastic:
     def save_yarn_scheduler_docs(self, docs):
         res = self.__do_request(bulk, self._es, self._prepare_yarn_scheduler_docs(docs))
 
+    def get_yarn_scheduler_state(self, at_time):
+        """Reconstructs the full scheduler state at the given time from delta-encoded scheduler docs.
+
+        :param at_time: datetime of interest
+        :return: dict {doc_key: doc} as of the latest snapshot at or before at_time
+        """
+        time_filter = {'range': {'spot.snapshot_time': {'lte': at_time}}}
+        body_keyframe = {
+            'size': 0,
+            'query': {'bool': {'filter': [time_filter]}},
+            'aggs': {
+                'max_keyframe': {'max': {'field': 'spot.keyframe_time'}}
+            }
+        }
+        res = self.__do_request(self._es.search,
+                                index=self._yarn_scheduler_index,
+                                body=body_keyframe)
+        max_keyframe = res['aggregations']['max_keyframe']
+        # no scheduler docs at or before at_time: the value is null and there is no value_as_string
+        if max_keyframe.get('value') is None:
+            return {}
+        keyframe_time = max_keyframe['value_as_string']
+
+        query_docs = {
+            'bool': {
+                'filter': [
+                    time_filter,
+                    {'term': {'spot.keyframe_time': keyframe_time}}
+                ]
+            }
+        }
+        return reconstruct_state(self.search_docs(self._yarn_scheduler_index, query=query_docs))
+
+    # LEASES
+    # leases of members of a group (e.g. crawler replicas) expire at the stored time,
+    # leader leases are exclusive and written with optimistic concurrency control (seq_no, primary_term)
+
+    @staticmethod
+    def _lease_uid(group, member):
+        return f'{group}/{member}'
+
+    def renew_lease(self, group, member, lease_seconds):
+        """Creates or extends the lease of a member of a group (e.g. a crawler replica) to lease_seconds from now."""
+        now = datetime.now(tz=timezone.utc)
+        doc = {
+            'group': group,
+            'member': member,
+            'renewed': now,
+            'expires': now + timedelta(seconds=lease_seconds)
+        }
+        self.__do_request(self._es.index,
+                          index=self._lease_index,
+                          id=self._lease_uid(group, member),
+                          body=doc,
+                          refresh='wait_for',  # visible to the other members at their next read
+                          request_timeout=REQUEST_TIMEOUT)
+
+    def get_live_members(self, group):
+        """Returns the members of a group whose leases have not expired."""
+        if not self.__do_request(self._es.indices.exists, index=self._lease_index):
+            return []
+        body = {
+            'size': PAGE_SIZE,
+            '_source': ['member'],
+            'query': {'bool': {'filter': [
+                {'term': {'group.keyword': group}},
+                {'range': {'expires': {'gt': 'now'}}}
+            ]}}
+        }
+        res = self.__do_request(self._es.search, index=self._lease_index, body=body, request_timeout=REQUEST_TIMEOUT)
+        return [hit['_source']['member'] for hit in res['hits']['hits']]
+
+    def release_lease(self, group, member):
+        self.__do_request(self._es.delete,
+                          index=self._lease_index,
+                          id=self._lease_uid(group, member),
+                          refresh='wait_for',
+                          ignore=[404],
+                          request_timeout=REQUEST_TIMEOUT)
+
+    def get_lease(self, uid):
+        """Returns (doc, seq_no, primary_term) of a lease document, None if it does not exist."""
+        res = self.__do_request(self._es.get, index=self._lease_index, id=uid, ignore=[404],
+                                request_timeout=REQUEST_TIMEOUT)
+        if not res.get('found'):
+            return None
+        return res['_source'], res['_seq_no'], res['_primary_term']
+
+    def write_lease(self, uid, doc, seq_no=None, primary_term=None):
+        """Writes a lease document only if it was not changed since it was read as seq_no and primary_term,
+        or only if it does not exist when seq_no is None.
+
+        :return: (seq_no, primary_term) of the written document, None if another writer changed it first
+        """
+        if seq_no is None:
+            condition = {'op_type': 'create'}
+        else:
+            condition = {'if_seq_no': seq_no, 'if_primary_term': primary_term}
+        try:
+            res = self.__do_request(self._es.index,
+                                    index=self._lease_index,
+                                    id=uid,
+                                    body=doc,
+                                    refresh='wait_for',
+                                    request_timeout=REQUEST_TIMEOUT,
+                                    **condition)
+        except ConflictError:
+            return None
+        return res['_seq_no'], res['_primary_term']
+
+    def delete_lease(self, uid, seq_no, primary_term):
+        """Deletes a lease document unless it was changed since it was written as seq_no and primary_term."""
+        try:
+            self.__do_request(self._es.delete,
+                              index=self._lease_index,
+                              id=uid,
+                              if_seq_no=seq_no,
+                              if_primary_term=primary_term,
+                              refresh='wait_for',
+                              ignore=[404],
+                              request_timeout=REQUEST_TIMEOUT)
+        except ConflictError:
+            pass
+
     # STATS QUERIES
 
     def get_indexes_stats(self):
@@ -359,22 +699,18 @@ class Elastic:
         for bucket in buckets:
             yield bucket.get("key"), bucket.get("doc_count")
 
-    def get_by_tag(self, tag, size=10000):
-        body = {
-            "query": {
-                "term": {
-                    "app_specific_data.tag.keyword": tag
-                }
-            },
-            "size": size
+    def get_by_tag(self, tag, source=None, size=PAGE_SIZE):
+        """Iterates over all aggregations of the tag.
+
+        :param source: list of fields to be returned, all fields if None
+        :param size: number of docs per request
+        """
+        query = {
+            "term": {
+                "app_specific_data.tag.keyword": tag
+            }
         }
-        res = self.__do_request(self._es.search,
-                                index=self._agg_index,
-                                body=body)
-        logger.debug(res)
-        hits = res.get('hits').get('hits')
-        for hit in hits:
-            yield hit.get('_source')
+        yield from self.search_docs(self._agg_index, query=query, source=source, page_size=size)
 
     def get_by_id(self, id):
         res = self.__do_request(self._es.get,
@@ -0,0 +1,539 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bz2
+import gzip
+import io
+import json
+import logging
+import os
+import re
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from spot.crawler.aggregator import HistoryAggregator, _remove_keys_dict, _cast_sparkProperties_dict
+from spot.crawler.commons import utc_from_timestamp_ms
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+_in_progress_suffix = '.inprogress'
+_rolling_dir_prefix = 'eventlog_v2_'
+_rolling_events_pattern = re.compile(r'^events_(\d+)_')
+# compression codecs of Spark event logs which cannot be decoded here
+_unsupported_codecs = ['.lz4', '.lzf', '.snappy']
+
+
+def _open_zstd(path):
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError(f"Reading {path} requires the zstandard package")
+    reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True,
+                                                        closefd=True)
+    return io.TextIOWrapper(reader, encoding='utf-8')
+
+
+def open_event_log(path):
+    """Opens a (possibly compressed) event log file as a text stream."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.zstd') or path.endswith('.zst'):
+        return _open_zstd(path)
+    for codec in _unsupported_codecs:
+        if path.endswith(codec):
+            raise ValueError(f"Unsupported event log codec {codec}: {path}. "
+                             f"Use spark.eventLog.compression.codec=zstd or uncompressed event logs")
+    return open(path, 'r', encoding='utf-8')
+
+
+def read_events(paths):
+    """Streams events (decoded JSON lines) from the event log files in the given order."""
+    for path in paths:
+        with open_event_log(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def _ms_to_datetime(timestamp_ms):
+    if timestamp_ms is None or timestamp_ms < 0:
+        return None
+    return utc_from_timestamp_ms(timestamp_ms)
+
+
+def read_header(paths):
+    """Reads events up to SparkListenerApplicationStart.
+
+    :return: dict of app id, name, attempt id, start time, user and Spark version, or None if not found
+    """
+    spark_version = None
+    for event in read_events(paths):
+        event_type = event.get('Event')
+        if event_type == 'SparkListenerLogStart':
+            spark_version = event.get('Spark Version')
+        elif event_type == 'SparkListenerApplicationStart':
+            return {
+                'id': event.get('App ID'),
+                'name': event.get('App Name'),
+                'attemptId': event.get('App Attempt ID'),
+                'startTime': _ms_to_datetime(event.get('Timestamp')),
+                'sparkUser': event.get('User'),
+                'appSparkVersion': spark_version
+            }
+    return None
+
+
+def _new_executor(executor_id):
+    return {
+        'id': executor_id,
+        'isActive': True,
+        'rddBlocks': 0,
+        'memoryUsed': 0,
+        'diskUsed': 0,
+        'totalCores': 0,
+        'maxTasks': 0,
+        'activeTasks': 0,
+        'failedTasks': 0,
+        'completedTasks': 0,
+        'totalTasks': 0,
+        'totalDuration': 0,
+        'totalGCTime': 0,
+        'totalInputBytes': 0,
+        'totalShuffleRead': 0,
+        'totalShuffleWrite': 0,
+        'isBlacklisted': False,
+        'maxMemory': 0
+    }
+
+
+def _new_stage(info):
+    return {
+        'status': 'ACTIVE',
+        'stageId': info.get('Stage ID'),
+        'attemptId': info.get('Stage Attempt ID', 0),
+        'numTasks': info.get('Number of Tasks', 0),
+        'numActiveTasks': 0,
+        'numCompleteTasks': 0,
+        'numFailedTasks': 0,
+        'numKilledTasks': 0,
+        'executorRunTime': 0,
+        'executorCpuTime': 0,
+        'executorDeserializeTime': 0,
+        'executorDeserializeCpuTime': 0,
+        'resultSize': 0,
+        'jvmGcTime': 0,
+        'resultSerializationTime': 0,
+        'peakExecutionMemory': 0,
+        'inputBytes': 0,
+        'inputRecords': 0,
+        'outputBytes': 0,
+        'outputRecords': 0,
+        'shuffleReadBytes': 0,
+        'shuffleReadRecords': 0,
+        'shuffleFetchWaitTime': 0,
+        'shuffleRemoteBytesRead': 0,
+        'shuffleLocalBytesRead': 0,
+        'shuffleWriteBytes': 0,
+        'shuffleWriteRecords': 0,
+        'shuffleWriteTime': 0,
+        'memoryBytesSpilled': 0,
+        'diskBytesSpilled': 0,
+        'name': info.get('Stage Name')
+    }
+
+
+def _update_stage_info(stage, info):
+    submission_time = _ms_to_datetime(info.get('Submission Time'))
+    if submission_time is not None:
+        stage['submissionTime'] = submission_time
+    completion_time = _ms_to_datetime(info.get('Completion Time'))
+    if completion_time is not None:
+        stage['completionTime'] = completion_time
+
+
+def _add_task_metrics(stage, executor, metrics, task_info):
+    input_metrics = metrics.get('Input Metrics', {})
+    output_metrics = metrics.get('Output Metrics', {})
+    shuffle_read = metrics.get('Shuffle Read Metrics', {})
+    shuffle_write = metrics.get('Shuffle Write Metrics', {})
+    shuffle_read_bytes = shuffle_read.get('Remote Bytes Read', 0) + shuffle_read.get('Local Bytes Read', 0)
+
+    stage['executorRunTime'] += metrics.get('Executor Run Time', 0)
+    stage['executorCpuTime'] += metrics.get('Executor CPU Time', 0)
+    stage['executorDeserializeTime'] += metrics.get('Executor Deserialize Time', 0)
+    stage['executorDeserializeCpuTime'] += metrics.get('Executor Deserialize CPU Time', 0)
+    stage['resultSize'] += metrics.get('Result Size', 0)
+    stage['jvmGcTime'] += metrics.get('JVM GC Time', 0)
+    stage['resultSerializationTime'] += metrics.get('Result Serialization Time', 0)
+    stage['peakExecutionMemory'] += metrics.get('Peak Execution Memory', 0)
+    stage['inputBytes'] += input_metrics.get('Bytes Read', 0)
+    stage['inputRecords'] += input_metrics.get('Records Read', 0)
+    stage['outputBytes'] += output_metrics.get('Bytes Written', 0)
+    stage['outputRecords'] += output_metrics.get('Records Written', 0)
+    stage['shuffleReadBytes'] += shuffle_read_bytes
+    stage['shuffleReadRecords'] += shuffle_read.get('Total Records Read', 0)
+    stage['shuffleFetchWaitTime'] += shuffle_read.get('Fetch Wait Time', 0)
+    stage['shuffleRemoteBytesRead'] += shuffle_read.get('Remote Bytes Read', 0)
+    stage['shuffleLocalBytesRead'] += shuffle_read.get('Local Bytes Read', 0)
+    stage['shuffleWriteBytes'] += shuffle_write.get('Shuffle Bytes Written', 0)
+    stage['shuffleWriteRecords'] += shuffle_write.get('Shuffle Records Written', 0)
+    stage['shuffleWriteTime'] += shuffle_write.get('Shuffle Write Time', 0)
+    stage['memoryBytesSpilled'] += metrics.get('Memory Bytes Spilled', 0)
+    stage['diskBytesSpilled'] += metrics.get('Disk Bytes Spilled', 0)
+
+    if executor is not None:
+        executor['totalGCTime'] += metrics.get('JVM GC Time', 0)
+        executor['totalInputBytes'] += input_metrics.get('Bytes Read', 0)
+        executor['totalShuffleRead'] += shuffle_read_bytes
+        executor['totalShuffleWrite'] += shuffle_write.get('Shuffle Bytes Written', 0)
+
+
+def parse_event_log(paths):
+    """Parses event log files of an app attempt into the structure returned by Spark History REST API.
+
+    Only the fields used by Spot are reconstructed. Times are converted to timezone aware datetimes.
+    Stages which were never submitted (skipped) are not included.
+
+    :param paths: event log files of the attempt (more than one for rolling event logs), in order
+    :return: dict with 'attempt', 'allexecutors', 'stages' and 'environment'
+    """
+    attempt = {'completed': True}
+    environment = {'runtime': {}, 'sparkProperties': []}
+    executors = OrderedDict()
+    stages = {}  # (stageId, attemptId) -> stage
+
+    def executor_for(executor_id):
+        if executor_id not in executors:
+            executors[executor_id] = _new_executor(executor_id)
+        return executors[executor_id]
+
+    for event in read_events(paths):
+        event_type = event.get('Event')
+
+        if event_type == 'SparkListenerTaskEnd':
+            stage = stages.get((event.get('Stage ID'), event.get('Stage Attempt ID', 0)))
+            task_info = event.get('Task Info', {})
+            reason = event.get('Task End Reason', {}).get('Reason')
+            executor = executors.get(task_info.get('Executor ID'))
+            if stage is None:
+                continue
+            launch_time = _ms_to_datetime(task_info.get('Launch Time'))
+            if launch_time is not None and ('firstTaskLaunchedTime' not in stage
+                                            or launch_time < stage['firstTaskLaunchedTime']):
+                stage['firstTaskLaunchedTime'] = launch_time
+            if reason == 'Success':
+                stage['numCompleteTasks'] += 1
+            elif reason == 'TaskKilled':
+                stage['numKilledTasks'] += 1
+            else:
+                stage['numFailedTasks'] += 1
+            if executor is not None:
+                executor['totalTasks'] += 1
+                if reason == 'Success':
+                    executor['completedTasks'] += 1
+                else:
+                    executor['failedTasks'] += 1
+                finish = task_info.get('Finish Time', 0)
+                launch = task_info.get('Launch Time', 0)
+                if finish > 0 and launch > 0:
+                    executor['totalDuration'] += finish - launch
+            _add_task_metrics(stage, executor, event.get('Task Metrics') or {}, task_info)
+
+        elif event_type == 'SparkListenerTaskStart':
+            stage = stages.get((event.get('Stage ID'), event.get('Stage Attempt ID', 0)))
+            launch_time = _ms_to_datetime(event.get('Task Info', {}).get('Launch Time'))
+            if stage is not None and launch_time is not None \
+                    and ('firstTaskLaunchedTime' not in stage or launch_time < stage['firstTaskLaunchedTime']):
+                stage['firstTaskLaunchedTime'] = launch_time
+
+        elif event_type == 'SparkListenerStageSubmitted':
+            info = event.get('Stage Info', {})
+            key = (info.get('Stage ID'), info.get('Stage Attempt ID', 0))
+            stage = stages.setdefault(key, _new_stage(info))
+            _update_stage_info(stage, info)
+
+        elif event_type == 'SparkListenerStageCompleted':
+            info = event.get('Stage Info', {})
+            key = (info.get('Stage ID'), info.get('Stage Attempt ID', 0))
+            stage = stages.setdefault(key, _new_stage(info))
+            _update_stage_info(stage, info)
+            if 'Failure Reason' in info:
+                stage['status'] = 'FAILED'
+                stage['failureReason'] = info['Failure Reason']
+            else:
+                stage['status'] = 'COMPLETE'
+
+        elif event_type == 'SparkListenerExecutorAdded':
+            executor = executor_for(event.get('Executor ID'))
+            info = event.get('Executor Info', {})
+            executor['addTime'] = _ms_to_datetime(event.get('Timestamp'))
+            executor['totalCores'] = info.get('Total Cores', 0)
+            executor['maxTasks'] = info.get('Total Cores', 0)
+            executor['hostPort'] = info.get('Host')
+
+        elif event_type == 'SparkListenerExecutorRemoved':
+            executor = executor_for(event.get('Executor ID'))
+            executor['removeTime'] = _ms_to_datetime(event.get('Timestamp'))
+            executor['removeReason'] = event.get('Removed Reason')
+            executor['isActive'] = False
+
+        elif event_type == 'SparkListenerBlockManagerAdded':
+            block_manager = event.get('Block Manager ID', {})
+            executor = executor_for(block_manager.get('Executor ID'))
+            executor['maxMemory'] = event.get('Maximum Memory', 0)
+            if 'addTime' not in executor:
+                executor['addTime'] = _ms_to_datetime(event.get('Timestamp'))
+
+        elif event_type == 'SparkListenerEnvironmentUpdate':
+            jvm = event.get('JVM Information', {})
+            environment['runtime'] = {
+                'javaVersion': jvm.get('Java Version'),
+                'javaHome': jvm.get('Java Home'),
+                'scalaVersion': jvm.get('Scala Version')
+            }
+            environment['sparkProperties'] = list(event.get('Spark Properties', {}).items())
+
+        elif event_type == 'SparkListenerApplicationStart':
+            attempt['startTime'] = _ms_to_datetime(event.get('Timestamp'))
+            attempt['sparkUser'] = event.get('User')
+            if event.get('App Attempt ID') is not None:
+                attempt['attemptId'] = event.get('App Attempt ID')
+
+        elif event_type == 'SparkListenerApplicationEnd':
+            attempt['endTime'] = _ms_to_datetime(event.get('Timestamp'))
+
+        elif event_type == 'SparkListenerLogStart':
+            attempt['appSparkVersion'] = event.get('Spark Version')
+
+    if 'startTime' in attempt and 'endTime' in attempt:
+        attempt['lastUpdated'] = attempt['endTime']
+        attempt['duration'] = round((attempt['endTime'] - attempt['startTime']).total_seconds() * 1000)
+
+    # Spark History lists the latest stages first
+    sorted_stages = [stages[key] for key in sorted(stages.keys(), reverse=True)]
+    return {
+        'attempt': attempt,
+        'allexecutors': list(executors.values()),
+        'stages': sorted_stages,
+        'environment': environment
+    }
+
+
+def _attempt_files(entry):
+    """Returns the list of event log files of a finished attempt or None if the entry is not a finished event log."""
+    if entry.name.startswith('.') or entry.name.endswith(_in_progress_suffix):
+        return None
+    if entry.is_dir():
+        if not entry.name.startswith(_rolling_dir_prefix):
+            return None
+        # rolling event log: finished when the app status file is not in progress
+        names = os.listdir(entry.path)
+        if any(name.startswith('appstatus_') and name.endswith(_in_progress_suffix) for name in names):
+            return None
+        events = []
+        for name in names:
+            match = _rolling_events_pattern.match(name)
+            if match:
+                events.append((int(match.group(1)), os.path.join(entry.path, name)))
+        return [path for _, path in sorted(events)] or None
+    return [entry.path]
+
+
+class EventLogAggregator(HistoryAggregator):
+    """Source of Spark app data which reads finished event logs from a local or mounted directory
+    instead of Spark History REST API.
+
+    Provides the same interface and output as HistoryAggregator, so it can replace it in Crawler.
+    Apps are listed by the modification time of the event log, which is kept in attempt.lastUpdated
+    (as in Spark History) and used to look up processed apps. endTime and duration of the attempt
+    are taken from SparkListenerApplicationEnd when the log is parsed.
+    Event logs of apps passed to prefetch() are parsed ahead in a pool of parse_workers processes,
+    which is shut down by close().
+    """
+    listing_time_field = 'attempt.lastUpdated'
+
+    def __init__(self,
+                 event_log_dir,
+                 parse_workers=1,
+                 remove_keys_dict=_remove_keys_dict,
+                 cast_sparkProperties_dict=_cast_sparkProperties_dict,
+                 last_attempt_only=False):
+        logger.debug(f"Initializing event log aggregator. dir: {event_log_dir} workers: {parse_workers}")
+        # times are parsed from the logs, no Spark History connection is needed
+        self._hist = None
+        self._remove_keys_dict = remove_keys_dict
+        self._time_keys_dict = {}
+        self.cast_sparkProperties_dict = cast_sparkProperties_dict
+        self.last_attempt_only = last_attempt_only
+        self._event_log_dir = event_log_dir
+        self._parse_workers = parse_workers
+        self._headers = {}  # path -> (mtime, header)
+        self._attempt_files = {}  # (app id, attempt id) -> list of files
+        self._pool = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 1 else None
+        self._prefetch_queue = deque()
+        self._futures = {}
+
+    def _scan(self, min_end_date, max_end_date):
+        """Yields (files, end time, header) of finished attempts with end time within the interval."""
+        seen_paths = set()
+        with os.scandir(self._event_log_dir) as entries:
+            for entry in entries:
+                files = _attempt_files(entry)
+                if files is None:
+                    continue
+                seen_paths.add(entry.path)
+                mtime = max(os.stat(path).st_mtime for path in files)
+                end_time = datetime.fromtimestamp(mtime, tz=timezone.utc)
+                if (min_end_date is not None and end_time < min_end_date) \
+                        or (max_end_date is not None and end_time > max_end_date):
+                    continue
+                cached = self._headers.get(entry.path)
+                if cached is not None and cached[0] == mtime:
+                    header = cached[1]
+                else:
+                    try:
+                        header = read_header(files)
+                    except (ValueError, OSError) as e:
+                        logger.warning(f"Failed to read event log {entry.path}: {e}")
+                        header = None
+                    self._headers[entry.path] = (mtime, header)
+                if header is not None:
+                    yield files, end_time, header
+        # forget headers of files which are gone, headers of other intervals are kept for the next steps
+        for path in list(self._headers.keys()):
+            if path not in seen_paths:
+                del self._headers[path]
+
+    def next_app(self,
+                 app_status=None,
+                 min_date=None,
+                 max_date=None,
+                 min_end_date=None,
+                 max_end_date=None,
+                 apps_limit=None):
+        apps = OrderedDict()
+        for files, end_time, header in self._scan(min_end_date, max_end_date):
+            if (min_date is not None and header['startTime'] < min_date) \
+                    or (max_date is not None and header['startTime'] > max_date):
+                continue
+            app = apps.setdefault(header['id'], {'id': header['id'], 'name': header['name'], 'attempts': []})
+            attempt = {
+                'startTime': header['startTime'],
+                'endTime': end_time,
+                'lastUpdated': end_time,
+                'duration': round((end_time - header['startTime']).total_seconds() * 1000),
+                'sparkUser': header['sparkUser'],
+                'completed': True,
+                'appSparkVersion': header['appSparkVersion']
+            }
+            if header['attemptId'] is not None:
+                attempt['attemptId'] = header['attemptId']
+            app['attempts'].append(attempt)
+            self._attempt_files[(header['id'], header['attemptId'])] = files
+
+        logger.debug(f'{len(apps)} apps found in {self._event_log_dir}')
+        counter = 0
+        for app in apps.values():
+            # the latest attempt first, as in Spark History
+            app['attempts'].sort(key=lambda a: a['startTime'], reverse=True)
+        # the oldest app first, as in HistoryAggregator
+        for app in sorted(apps.values(), key=lambda a: a['attempts'][0]['endTime']):
+            if self.last_attempt_only:
+                for attempt in app['attempts'][1:]:
+                    self._attempt_files.pop((app['id'], attempt.get('attemptId')), None)
+                app['attempts'] = app['attempts'][:1]
+            yield app
+            counter += 1
+            if apps_limit is not None and counter >= apps_limit:
+                return
+
+    def _submit_ahead(self):
+        while self._prefetch_queue and len(self._futures) < 2 * self._parse_workers:
+            key = self._prefetch_queue.popleft()
+            files = self._attempt_files.get(key)
+            if files is not None and key not in self._futures:
+                self._futures[key] = self._pool.submit(parse_event_log, files)
+
+    def prefetch(self, apps):
+        """Starts parsing event logs of the apps in the background, in the given order."""
+        if self._pool is None:
+            return
+        for app in apps:
+            for attempt in app.get('attempts'):
+                self._prefetch_queue.append((app.get('id'), attempt.get('attemptId')))
+        self._submit_ahead()
+
+    def _find_files(self, key):
+        """Returns the files of the attempt, listing the directory again if the attempt was not listed before
+        (e.g. an app retried after the crawler restarted)."""
+        files = self._attempt_files.get(key)
+        if files is None:
+            for attempt_files, _, header in self._scan(None, None):
+                if (header['id'], header['attemptId']) == key:
+                    files = attempt_files
+                    break
+        if files is None:
+            raise FileNotFoundError(f"Event log of app {key[0]} attempt {key[1]} not found in {self._event_log_dir}")
+        return files
+
+    def _parse(self, key):
+        future = self._futures.pop(key, None)
+        if future is not None:
+            result = future.result()
+        else:
+            result = parse_event_log(self._find_files(key))
+        # the files are kept until the attempt is parsed, so that a failed app can be processed again
+        self._attempt_files.pop(key, None)
+        if self._pool is not None:
+            self._submit_ahead()
+        return result
+
+    def close(self):
+        """Shuts down the parse workers, cancelling event logs prefetched but not parsed yet."""
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        self._prefetch_queue.clear()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def add_app_data(self, app, stage_status=None):
+        app_id = app.get('id')
+        logger.debug(f'parsing event log: {app_id}')
+        for attempt in app.get('attempts'):
+            parsed = self._parse((app_id, attempt.get('attemptId')))
+            # keep the modification time used for listing, processed apps are looked up by it;
+            # the listing endTime and duration remain only for logs without SparkListenerApplicationEnd
+            parsed['attempt'].pop('lastUpdated', None)
+            attempt.update(parsed['attempt'])
+            for executor in parsed['allexecutors']:
+                self._remove_keys(executor, 'executor')
+            attempt['allexecutors'] = parsed['allexecutors']
+            stages = parsed['stages']
+            if stage_status is not None:
+                stages = [stage for stage in stages if stage['status'] == stage_status.upper()]
+            attempt['stages'] = stages
+
+            environment = parsed['environment']
+            spark_props = self._process_sparkProperties(environment.get('sparkProperties'))
+            self._remove_keys(spark_props, 'sparkProperties')
+            environment['sparkProperties'] = spark_props
+            self._remove_keys(environment.get('runtime'), 'runtime')
+            attempt['environment'] = environment
+        return app
@@ -15,7 +15,10 @@ import pandas as pd
 import numpy as np
 import logging
 
-from spot.crawler.commons import get_last_attempt, bytes_to_hdfs_block, bytes_to_gb
+from spot.crawler.commons import get_last_attempt, bytes_to_hdfs_block, bytes_to_gb, DEFAULT_TOP_N, \
+    ONLINE_AGGREGATION_THRESHOLD
+from spot.crawler.quantile_sketch import sketch_aggregations
+from spot.crawler.online_aggregation import aggregate_online
 
 import spot.utils.setup_logger
 
@@ -23,6 +26,9 @@ logger = logging.getLogger(__name__)
 
 DF = pd.DataFrame
 
+# job names and SQL descriptions are truncated to this length
+_max_description_length = 256
+
 # custom aggregations
 
 
@@ -62,12 +68,13 @@ default_type_aggregations = {
 }
 
 
-def aggregate_by_col_type(df, type_aggregations=default_type_aggregations):
+def aggregate_by_col_type(df, type_aggregations=default_type_aggregations, sketches=False):
     """Apply lists of aggregations to specified column types of DataFrame. Return results as a dict.
 
     If the result of an aggregation is NA, NaN, None or NaT it is omitted in the output dict.
     Keyword arguments:
     type_aggregations -- dict of {type: [list, of, aggregations]}
+    sketches -- add quantiles (p50, p90, p99) and a mergeable quantile sketch of each numeric column
     """
     n = len(df.index)
     result = {'elements_count': n}
@@ -95,6 +102,9 @@ def aggregate_by_col_type(df, type_aggregations=default_type_aggregations):
                     if isinstance(value, np.int64):
                         value = int(value)
                 result[column_name][agg_name] = value
+    if sketches:
+        for column_name, series in df.select_dtypes([np.number]).items():
+            result.setdefault(column_name, {}).update(sketch_aggregations(series))
     return result
 
 
@@ -117,16 +127,23 @@ def add_custom_executor_metrics(attempt, ex):
     return ex
 
 
-def flatten_executors(attempt):
+def _is_driver(ex):
+    return ex['id'] == 'driver'
+
+
+def flatten_executors(attempt, sketches=False, online_threshold=ONLINE_AGGREGATION_THRESHOLD):
     executors = attempt.get('allexecutors')
     driver = {}
     for ex in executors:
         add_custom_executor_metrics(attempt, ex)
-        if ex['id'] == 'driver':
+        if _is_driver(ex):
             driver = ex
-    df = pd.io.json.json_normalize(executors)
-    df_executors = df[df['id'] != 'driver']
-    ex_aggregations = aggregate_by_col_type(df_executors)
+    if online_threshold is not None and len(executors) > online_threshold:
+        ex_aggregations = aggregate_online(executors, sketches=sketches, exclude=_is_driver)
+    else:
+        df = pd.io.json.json_normalize(executors)
+        df_executors = df[df['id'] != 'driver']
+        ex_aggregations = aggregate_by_col_type(df_executors, sketches=sketches)
     result = {
         'driver': driver,
         'executors': ex_aggregations
@@ -162,17 +179,97 @@ def add_custom_stage_metrics(attempt, stage):
         stage['x_average_task_output_bytes'] = stage['outputBytes'] / stage['numCompleteTasks']
 
 
-def flatten_stages(attempt):
+def flatten_stages(attempt, sketches=False, online_threshold=ONLINE_AGGREGATION_THRESHOLD):
     stages = attempt.get('stages')
     for stage in stages:
         add_custom_stage_metrics(attempt, stage)
 
+    if online_threshold is not None and len(stages) > online_threshold:
+        # bounded memory for giant apps
+        return aggregate_online(stages, sketches=sketches)
     df = pd.io.json.json_normalize(stages)
-    aggregations = aggregate_by_col_type(df)
+    aggregations = aggregate_by_col_type(df, sketches=sketches)
+    return aggregations
+
+
+def _stage_totals(stages):
+    """Input bytes and executor run time of each stage id, summed over stage attempts."""
+    totals = {}
+    for stage in stages:
+        stage_totals = totals.setdefault(stage.get('stageId'), [0, 0])
+        stage_totals[0] += stage.get('inputBytes', 0)
+        stage_totals[1] += stage.get('executorRunTime', 0)
+    return totals
+
+
+def _truncate(text):
+    if isinstance(text, str) and len(text) > _max_description_length:
+        return text[:_max_description_length]
+    return text
+
+
+def _aggregate_top(rows, columns, top_n, sketches=False):
+    """Aggregates numeric columns of rows and keeps top_n rows with the highest executor run time."""
+    df = DF(rows, columns=columns)
+    aggregations = aggregate_by_col_type(df, sketches=sketches)
+    rows.sort(key=lambda row: (row['executorRunTime'], row['duration'] or 0), reverse=True)
+    aggregations['top'] = rows[:top_n]
     return aggregations
 
 
-def flatten_app(app):
+def _job_row(job, stage_totals):
+    stage_ids = job.get('stageIds', [])
+    start = job.get('submissionTime')
+    end = job.get('completionTime')
+    return {
+        'jobId': job.get('jobId'),
+        'name': _truncate(job.get('name')),
+        'jobGroup': job.get('jobGroup'),
+        'status': job.get('status'),
+        'duration': (end - start).total_seconds() * 1000 if (start is not None and end is not None) else None,
+        'stages': len(stage_ids),
+        'inputBytes': sum(stage_totals.get(stage_id, [0, 0])[0] for stage_id in stage_ids),
+        'executorRunTime': sum(stage_totals.get(stage_id, [0, 0])[1] for stage_id in stage_ids)
+    }
+
+
+def flatten_jobs(attempt, top_n=DEFAULT_TOP_N, sketches=False):
+    """Aggregates duration, number of stages, input and executor run time of jobs.
+
+    Only top_n most expensive jobs are kept, so that the size of aggregations is bounded.
+    """
+    stage_totals = _stage_totals(attempt.get('stages', []))
+    rows = [_job_row(job, stage_totals) for job in attempt.get('jobs', [])]
+    return _aggregate_top(rows, ['duration', 'stages', 'inputBytes', 'executorRunTime'], top_n, sketches)
+
+
+def flatten_sql(attempt, top_n=DEFAULT_TOP_N, sketches=False):
+    """Aggregates duration, number of jobs and stages, input and executor run time of SQL executions.
+
+    Stages are attributed to executions through their jobs.
+    Only top_n most expensive executions are kept, so that the size of aggregations is bounded.
+    """
+    stage_totals = _stage_totals(attempt.get('stages', []))
+    job_stage_ids = {job.get('jobId'): job.get('stageIds', []) for job in attempt.get('jobs', [])}
+    rows = []
+    for execution in attempt.get('sql', []):
+        job_ids = execution.get('runningJobIds', []) + execution.get('successJobIds', []) \
+            + execution.get('failedJobIds', [])
+        stage_ids = {stage_id for job_id in job_ids for stage_id in job_stage_ids.get(job_id, [])}
+        rows.append({
+            'id': execution.get('id'),
+            'description': _truncate(execution.get('description')),
+            'status': execution.get('status'),
+            'duration': execution.get('duration'),
+            'jobs': len(job_ids),
+            'stages': len(stage_ids),
+            'inputBytes': sum(stage_totals.get(stage_id, [0, 0])[0] for stage_id in stage_ids),
+            'executorRunTime': sum(stage_totals.get(stage_id, [0, 0])[1] for stage_id in stage_ids)
+        })
+    return _aggregate_top(rows, ['duration', 'jobs', 'stages', 'inputBytes', 'executorRunTime'], top_n, sketches)
+
+
+def flatten_app(app, sketches=False, top_n=DEFAULT_TOP_N, online_threshold=ONLINE_AGGREGATION_THRESHOLD):
     attempts = app.get('attempts')
     last_attempt = get_last_attempt(app)
     last_attempt_id = last_attempt.get('attemptId')
@@ -185,21 +282,28 @@ def flatten_app(app):
         else:
             res['isFinalAttempt'] = False
         flat_attempt = attempt.copy()
-        aggs = get_attempt_aggregations(attempt)
+        aggs = get_attempt_aggregations(attempt, sketches=sketches, top_n=top_n, online_threshold=online_threshold)
         flat_attempt['aggs'] = aggs
 
         # remove raw details
         flat_attempt.pop('allexecutors', None)
         flat_attempt.pop('stages', None)
+        flat_attempt.pop('jobs', None)
+        flat_attempt.pop('sql', None)
 
         res['attempt'] = flat_attempt
         yield res
 
 
-def get_attempt_aggregations(attempt):
+def get_attempt_aggregations(attempt, sketches=False, top_n=DEFAULT_TOP_N,
+                             online_threshold=ONLINE_AGGREGATION_THRESHOLD):
     aggs = dict()
-    aggs['allexecutors'] = flatten_executors(attempt)
-    aggs['stages'] = flatten_stages(attempt)
+    aggs['allexecutors'] = flatten_executors(attempt, sketches=sketches, online_threshold=online_threshold)
+    aggs['stages'] = flatten_stages(attempt, sketches=sketches, online_threshold=online_threshold)
+    if 'jobs' in attempt:
+        aggs['jobs'] = flatten_jobs(attempt, top_n=top_n, sketches=sketches)
+    if 'sql' in attempt:
+        aggs['sql'] = flatten_sql(attempt, top_n=top_n, sketches=sketches)
     aggs['summary'] = calculate_summary(attempt, aggs)
     return aggs
 
@@ -251,6 +355,85 @@ def calculate_parallelism(stages):
     return total, intervals_overlap
 
 
+def calculate_concurrency_profile(stages):
+    """Sweep-line analysis of concurrently running stages (between first task launch and completion).
+
+    Returns the time (ms) during which exactly 1, 2 or 3 and more stages were running,
+    gaps without running stages, max and average concurrency, and the critical path:
+    the chain of consecutive non-overlapping stages with the longest total duration
+    (weighted interval scheduling). Time outside the critical path is where the stages overlap,
+    so only there more executors can shorten the run. O(n log n) in the number of stages.
+
+    A stage completed at its launch time does not count as a completion of another stage:
+
+    >>> from datetime import datetime
+    >>> t = datetime(2020, 1, 1)
+    >>> profile = calculate_concurrency_profile([
+    ...     {'firstTaskLaunchedTime': t, 'completionTime': t.replace(second=5)},
+    ...     {'firstTaskLaunchedTime': t.replace(second=10), 'completionTime': t.replace(second=10)}])
+    >>> profile['max_concurrency'], profile['time_at_0'], profile['time_at_1']
+    (1, 5000.0, 5000.0)
+    """
+    starts = []
+    ends = []
+    for stage in stages:
+        if ('firstTaskLaunchedTime' in stage) and ('completionTime' in stage):
+            starts.append(stage['firstTaskLaunchedTime'].timestamp() * 1000)
+            ends.append(stage['completionTime'].timestamp() * 1000)
+    if not starts:
+        return {}
+    starts = np.array(starts)
+    ends = np.maximum(np.array(ends), starts)
+
+    # sweep line: at the same time stage completions go before launches, touching stages do not overlap,
+    # except that a zero-length stage is launched before it completes, so the level never drops below 0.
+    # order of events at the same time: completions, zero-length launches, zero-length completions, launches
+    zero_length = ends == starts
+    times = np.concatenate([starts, ends])
+    deltas = np.concatenate([np.ones(len(starts), dtype=int), -np.ones(len(ends), dtype=int)])
+    ranks = np.concatenate([np.where(zero_length, 1, 3), np.where(zero_length, 2, 0)])
+    order = np.lexsort((ranks, times))
+    times = times[order]
+    levels = np.cumsum(deltas[order])[:-1]
+    durations = np.diff(times)
+    time_at_level = np.bincount(levels, weights=durations)
+    busy_time = durations[levels > 0].sum()
+
+    # critical path: dp over stages sorted by completion
+    by_end = np.argsort(ends, kind='mergesort')
+    sorted_starts = starts[by_end]
+    sorted_ends = ends[by_end]
+    # number of stages completed before each stage is launched
+    previous = np.searchsorted(sorted_ends, sorted_starts, side='right')
+    lengths = sorted_ends - sorted_starts
+    best = np.zeros(len(starts) + 1)
+    best_count = np.zeros(len(starts) + 1, dtype=int)
+    for i in range(len(starts)):
+        with_stage = lengths[i] + best[previous[i]]
+        if with_stage > best[i]:
+            best[i + 1] = with_stage
+            best_count[i + 1] = best_count[previous[i]] + 1
+        else:
+            best[i + 1] = best[i]
+            best_count[i + 1] = best_count[i]
+
+    interval = times[-1] - times[0]
+    profile = {
+        'max_concurrency': int(levels.max()),
+        'time_at_0': float(time_at_level[0]),
+        'time_at_1': float(time_at_level[1]) if len(time_at_level) > 1 else 0.0,
+        'time_at_2': float(time_at_level[2]) if len(time_at_level) > 2 else 0.0,
+        'time_at_3_or_more': float(time_at_level[3:].sum()),
+        'critical_path': float(best[-1]),
+        'critical_path_stages': int(best_count[-1])
+    }
+    if busy_time > 0:
+        profile['average_concurrency'] = float((levels * durations).sum() / busy_time)
+    if interval > 0:
+        profile['critical_path_fraction'] = float(best[-1] / interval)
+    return profile
+
+
 def calculate_summary(attempt, aggs):
     summary = {}
     if aggs['allexecutors']['executors']['elements_count'] > 0 \
@@ -299,7 +482,8 @@ def calculate_summary(attempt, aggs):
             'stages_interval': stages_interval,
             'stages_max_input_blocks': stages_max_input_blocks,
             'executors_total_input_blocks': executors_total_input_blocks,
-            'unused_storage_memory': unused_storage_memory
+            'unused_storage_memory': unused_storage_memory,
+            'concurrency': calculate_concurrency_profile(attempt.get('stages', []))
         }
         if duration != 0:
             speedup = est_seq_time / duration
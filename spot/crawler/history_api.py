@@ -12,18 +12,30 @@
 # limitations under the License.
 
 import logging
+import threading
 import requests
 
+from spot.crawler.circuit_breaker import CircuitBreaker, CircuitOpenError, is_unavailable_error
 import spot.utils.setup_logger
 
 logger = logging.getLogger(__name__)
 
+# number of SQL executions requested at once, Spark History returns 20 by default
+SQL_PAGE_SIZE = 500
+
 
 class SparkHistory:
-    def __init__(self, spark_history_base_url, ssl_path=None):
+    def __init__(self, spark_history_base_url, ssl_path=None, rate_limiter=None, circuit_breaker=None):
+        """
+        rate_limiter -- AdaptiveRateLimiter, can be shared with other clients of the same server
+        circuit_breaker -- CircuitBreaker, stops requests while the server is in a bad state
+        """
         self._spark_history_base_url = spark_history_base_url
         self.verify = ssl_path
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
         self._session = None
+        self._session_lock = threading.Lock()
 
     def _init_session(self):
         logger.debug('starting new Spark History session')
@@ -31,7 +43,10 @@ class SparkHistory:
         if self.verify:
             logger.debug(f"Using cert: {self.verify}")
             self._session.verify = self.verify
-        retries = requests.packages.urllib3.util.retry.Retry(total=10, backoff_factor=1, status_forcelist=[502, 503, 504])
+        # with a rate limiter, failures are backed off by the limiter instead of long retries
+        total_retries = 10 if self.rate_limiter is None else 2
+        retries = requests.packages.urllib3.util.retry.Retry(total=total_retries, backoff_factor=1,
+                                                             status_forcelist=[502, 503, 504])
         adapter = requests.adapters.HTTPAdapter(max_retries=retries)
         self._session.mount(self._spark_history_base_url, adapter)
 
@@ -43,12 +58,62 @@ class SparkHistory:
             return f"{app_id}/{attempt}"
 
     def _get_data(self, path, params={}):
-        if self._session is None:
-            self._init_session()
+        # requests of an app can be sent from several threads
+        with self._session_lock:
+            if self._session is None:
+                self._init_session()
 
         url = f"{self._spark_history_base_url}/{path}"
         logger.debug(f"sending request to {url} with params {params}")
         headers = {'Accept': 'application/json'}
+        if self.circuit_breaker is None:
+            return self._send_limited(url, params, headers)
+
+        self._check_circuit(headers)
+        try:
+            data = self._send_limited(url, params, headers)
+        except Exception as e:
+            if is_unavailable_error(e):
+                self.circuit_breaker.record_failure()
+            raise
+        self.circuit_breaker.record_success()
+        return data
+
+    def _check_circuit(self, headers):
+        """Raises CircuitOpenError while the circuit breaker is open, unless a health probe succeeds."""
+        decision = self.circuit_breaker.allow_request()
+        if decision == CircuitBreaker.ALLOW:
+            return
+        if decision == CircuitBreaker.PROBE:
+            logger.info(f"probing Spark History {self._spark_history_base_url}")
+            try:
+                self._send(f"{self._spark_history_base_url}/applications", {'limit': 1}, headers)
+            except Exception as e:
+                logger.debug(f"probe failed: {e}")
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+                return
+        raise CircuitOpenError(f"Spark History {self._spark_history_base_url} is unavailable, "
+                               f"next probe in {self.circuit_breaker.seconds_to_probe():.0f} s")
+
+    def _send_limited(self, url, params, headers):
+        if self.rate_limiter is None:
+            return self._send(url, params, headers)
+
+        start = self.rate_limiter.acquire()
+        overloaded = True  # unless the response is valid or a client error
+        try:
+            data = self._send(url, params, headers)
+            overloaded = False
+            return data
+        except requests.HTTPError as e:
+            overloaded = e.response is None or e.response.status_code >= 500
+            raise
+        finally:
+            self.rate_limiter.release(start, overloaded=overloaded)
+
+    def _send(self, url, params, headers):
         response = self._session.get(url, params=params, headers=headers)
 
         if response.status_code != requests.codes.ok:
@@ -97,3 +162,33 @@ class SparkHistory:
         params = {'status': status}
         data = self._get_data(path, params)
         return data
+
+    def get_jobs(self, app_id, attempt, status=None):
+        attempt_id = self._merge_attempt_id(app_id, attempt)
+        logger.debug(f"getting jobs for {attempt_id}")
+        path = f"applications/{attempt_id}/jobs"
+        params = {'status': status}
+        data = self._get_data(path, params)
+        return data
+
+    def get_sql(self, app_id, attempt):
+        """SQL executions without plan details (Spark 3.0+).
+
+        Returns an empty list if the endpoint is not available, e.g. in older Spark History versions.
+        """
+        attempt_id = self._merge_attempt_id(app_id, attempt)
+        logger.debug(f"getting SQL executions for {attempt_id}")
+        path = f"applications/{attempt_id}/sql"
+        data = []
+        while True:
+            params = {'details': 'false', 'planDescription': 'false', 'offset': len(data), 'length': SQL_PAGE_SIZE}
+            try:
+                page = self._get_data(path, params)
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code == requests.codes.not_found:
+                    logger.debug(f"SQL executions not available for {attempt_id}")
+                    return data
+                raise
+            data.extend(page)
+            if len(page) < SQL_PAGE_SIZE:
+                return data
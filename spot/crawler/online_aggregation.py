@@ -0,0 +1,259 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import numbers
+from datetime import datetime
+
+from spot.crawler.quantile_sketch import TDigest, DEFAULT_COMPRESSION, DEFAULT_QUANTILES
+
+_MASK64 = (1 << 64) - 1
+# distinct values are counted exactly up to this number, then estimated by HyperLogLog
+EXACT_DISTINCT_LIMIT = 2048
+# values of a column buffered before they are merged into its quantile sketch
+SKETCH_BUFFER_SIZE = 4096
+
+# column kinds, as the column types of aggregate_by_col_type
+_NUMBER = 'number'
+_BOOL = 'bool'
+_DATETIME = 'datetime'
+_OTHER = 'other'
+
+
+def _hash64(value):
+    """64-bit hash of a number (splitmix64 finalizer of the Python hash, equal for 1 and 1.0)."""
+    x = (hash(value) + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+class HyperLogLog:
+    """Estimate of the number of distinct values in 2 ** precision bytes, with about 1.04 / sqrt(2 ** precision)
+    relative error (0.8 % for the default precision)."""
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+        self._value_bits = 64 - precision
+
+    def add(self, value):
+        h = _hash64(value)
+        index = h >> self._value_bits
+        rank = self._value_bits - (h & ((1 << self._value_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros > 0:
+            # small range correction (linear counting)
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class DistinctCounter:
+    """Exact distinct count of a small number of values, HyperLogLog estimate above EXACT_DISTINCT_LIMIT."""
+
+    def __init__(self):
+        self._values = set()
+        self._hll = None
+
+    def add(self, value):
+        if self._hll is not None:
+            self._hll.add(value)
+            return
+        self._values.add(value)
+        if len(self._values) > EXACT_DISTINCT_LIMIT:
+            self._hll = HyperLogLog()
+            for v in self._values:
+                self._hll.add(v)
+            self._values = None
+
+    def count(self):
+        return self._hll.count() if self._hll is not None else len(self._values)
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return _BOOL
+    if isinstance(value, numbers.Number):
+        return _NUMBER
+    if isinstance(value, datetime):
+        return _DATETIME
+    return _OTHER
+
+
+class ColumnAccumulator:
+    """Aggregations of a single column updated one value at a time, in O(1) memory
+    (besides the bounded distinct counter and sketch buffer)."""
+
+    def __init__(self, sketches=False):
+        self.kinds = set()
+        self.missing = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+        self.zeroes = 0
+        self.true_count = 0
+        self.distinct = DistinctCounter()
+        self._sketch = TDigest(DEFAULT_COMPRESSION) if sketches else None
+        self._buffer = []
+
+    def add(self, value):
+        if value is None:
+            self.missing += 1
+            return
+        kind = _kind(value)
+        self.kinds.add(kind)
+        if kind == _OTHER or len(self.kinds) > 1:
+            return  # the column is not aggregated anyway
+        if kind == _NUMBER and value != value:  # NaN
+            return
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if kind == _NUMBER:
+            self.sum += value
+            if value == 0:
+                self.zeroes += 1
+            self.distinct.add(value)
+            if self._sketch is not None:
+                self._buffer.append(value)
+                if len(self._buffer) >= SKETCH_BUFFER_SIZE:
+                    self._flush_sketch()
+        elif kind == _BOOL:
+            self.true_count += value
+
+    def _flush_sketch(self):
+        if self._buffer:
+            self._sketch = self._sketch.merge(TDigest.from_values(self._buffer))
+            self._buffer = []
+
+    @property
+    def kind(self):
+        """Column type as pandas would infer it, None if the column is not aggregated (object dtype)."""
+        if len(self.kinds) != 1:  # only missing values or mixed types
+            return None
+        kind = next(iter(self.kinds))
+        if kind == _OTHER or (kind == _BOOL and self.missing > 0):
+            return None
+        return kind
+
+    def result(self):
+        kind = self.kind
+        if kind == _NUMBER:
+            result = {}
+            if self.count > 0:
+                result['min'] = self.min
+                result['max'] = self.max
+            result['sum'] = self.sum
+            if self.count > 0:
+                result['mean'] = self.sum / self.count
+            result['nunique'] = self.distinct.count()
+            result['count_zeroes'] = self.zeroes
+            result['count_not_null'] = self.count
+            if self._sketch is not None:
+                self._flush_sketch()
+                if self._sketch.means.size > 0:
+                    result.update({name: self._sketch.quantile(q) for name, q in DEFAULT_QUANTILES.items()})
+                    result['sketch'] = self._sketch.to_dict()
+            return result
+        if kind == _DATETIME:
+            return {'min': self.min, 'max': self.max} if self.count > 0 else {}
+        if kind == _BOOL:
+            return {'any': self.true_count > 0, 'all': self.true_count == self.count, 'sum': self.true_count}
+        return None
+
+
+def _flat_items(record, prefix=''):
+    """Yields (column name, value) of a record with nested dicts flattened as by json_normalize."""
+    for key, value in record.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            yield from _flat_items(value, f'{name}.')
+        else:
+            yield name, value
+
+
+class OnlineAggregator:
+    """Aggregates records (dicts) one at a time into the output of flattener.aggregate_by_col_type,
+    without building a DataFrame: memory is proportional to the number of columns, not records.
+
+    Distinct counts above EXACT_DISTINCT_LIMIT are HyperLogLog estimates. Sums are not compensated,
+    so they can differ from pandas in the last digits.
+    """
+
+    def __init__(self, sketches=False):
+        self._sketches = sketches
+        self._columns = {}
+        self.n = 0
+
+    def add(self, record):
+        self.n += 1
+        seen = 0
+        for name, value in _flat_items(record):
+            column = self._columns.get(name)
+            if column is None:
+                # missing in all previous records
+                column = ColumnAccumulator(self._sketches)
+                column.missing = self.n - 1
+                self._columns[name] = column
+            column.add(value)
+            seen += 1
+        if seen < len(self._columns):
+            # columns missing in this record
+            names = {name for name, _ in _flat_items(record)}
+            for name, column in self._columns.items():
+                if name not in names:
+                    column.missing += 1
+
+    def add_excluded(self, record):
+        """Registers the columns of a record which is not aggregated, as a row filtered out of a DataFrame
+        leaves its columns and their types in the DataFrame."""
+        for name, value in _flat_items(record):
+            column = self._columns.get(name)
+            if column is None:
+                column = ColumnAccumulator(self._sketches)
+                column.missing = self.n
+                self._columns[name] = column
+            if value is not None:
+                column.kinds.add(_kind(value))
+
+    def result(self):
+        result = {'elements_count': self.n}
+        if self.n == 0:
+            return result
+        for name, column in self._columns.items():
+            aggregations = column.result()
+            if aggregations is not None:
+                result[name] = aggregations
+        return result
+
+
+def aggregate_online(records, sketches=False, exclude=None):
+    """Aggregates records online. Records for which exclude(record) is true are not aggregated."""
+    aggregator = OnlineAggregator(sketches=sketches)
+    for record in records:
+        if exclude is not None and exclude(record):
+            aggregator.add_excluded(record)
+        else:
+            aggregator.add(record)
+    return aggregator.result()
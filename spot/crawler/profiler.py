@@ -0,0 +1,247 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import heapq
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+REPORT_FILE = 'slowest_apps.json'
+
+
+class NullProfiler:
+    """Profiler interface doing nothing, used when profiling is disabled."""
+
+    def app(self, app_id):
+        return nullcontext()
+
+    def phase(self, name):
+        return nullcontext()
+
+    def write_report(self):
+        pass
+
+
+class _StackSampler(threading.Thread):
+    """Samples the stack of a thread at a fixed interval, counting collapsed stacks (flame graph format)."""
+
+    def __init__(self, thread_id, interval_seconds=0.01):
+        super().__init__(name='profile-sampler', daemon=True)
+        self._thread_id = thread_id
+        self._interval_seconds = interval_seconds
+        self._stop_event = threading.Event()
+        self.stacks = Counter()
+
+    def run(self):
+        while not self._stop_event.wait(self._interval_seconds):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class _AppProfile:
+
+    def __init__(self, app_id):
+        self.app_id = app_id
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.phases = {}  # phase -> {'seconds': ..., 'memory_bytes': ...}
+        self.peak_memory_bytes = None
+        self.profile = None
+        self.sampler = None
+        self.timer = None
+
+    def to_dict(self):
+        result = {'app_id': self.app_id, 'seconds': self.seconds, 'phases': self.phases}
+        if self.peak_memory_bytes is not None:
+            result['peak_memory_bytes'] = self.peak_memory_bytes
+        return result
+
+
+class AppProfiler:
+    """Per-app instrumentation of the Crawler.
+
+    Durations of the phases (fetch, enrich, flatten, save) are measured for every app.
+    Every sample_every-th app is profiled with cProfile (and tracemalloc, if trace_memory is set),
+    the profile is written to directory as {time}_{app id}.prof, readable by pstats or snakeviz.
+    Apps which run over time_budget_seconds without being profiled are sampled from that moment on
+    and their collapsed stacks are written as {time}_{app id}.stacks (e.g. for flamegraph.pl).
+    At most keep_files profiles are kept. write_report saves the slowest and the most memory-hungry apps
+    with their phases to slowest_apps.json in the directory.
+    """
+
+    def __init__(self, directory, sample_every=100, time_budget_seconds=120, keep_files=50, report_size=20,
+                 trace_memory=False):
+        self.directory = directory
+        self.sample_every = sample_every
+        self.time_budget_seconds = time_budget_seconds
+        self.keep_files = keep_files
+        self.report_size = report_size
+        self.trace_memory = trace_memory
+        self.apps = 0
+        self.profiled = 0
+        self.over_budget = 0
+        self._current = None
+        self._slowest = []  # min-heap of (seconds, counter, app profile dict)
+        self._memory_hungry = []  # min-heap of (peak memory, counter, app profile dict)
+        self._report_changed = False
+        self._sampling_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _file_path(self, app_id, extension):
+        timestamp = datetime.now(tz=timezone.utc).strftime('%Y%m%dT%H%M%S')
+        safe_id = re.sub(r'[^\w.-]', '_', str(app_id))
+        return os.path.join(self.directory, f'{timestamp}_{safe_id}.{extension}')
+
+    def _rotate(self):
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.endswith('.prof') or name.endswith('.stacks')]
+        if len(files) <= self.keep_files:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.keep_files]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Failed to remove old profile {path}: {e}")
+
+    def _start_sampling(self, profile, thread_id):
+        with self._sampling_lock:
+            if profile.seconds is not None:  # already finished
+                return
+            logger.info(f"App {profile.app_id} is over the time budget of {self.time_budget_seconds} s, "
+                        f"sampling stacks")
+            profile.sampler = _StackSampler(thread_id)
+            profile.sampler.start()
+
+    @contextmanager
+    def app(self, app_id):
+        self.apps += 1
+        profile = _AppProfile(app_id)
+        self._current = profile
+        sampled = self.sample_every > 0 and self.apps % self.sample_every == 0
+        if sampled:
+            if self.trace_memory:
+                tracemalloc.start()
+            profile.profile = cProfile.Profile()
+            profile.profile.enable()
+        elif self.time_budget_seconds is not None:
+            profile.timer = threading.Timer(self.time_budget_seconds, self._start_sampling,
+                                            args=(profile, threading.get_ident()))
+            profile.timer.daemon = True
+            profile.timer.start()
+        try:
+            yield profile
+        finally:
+            with self._sampling_lock:
+                profile.seconds = time.perf_counter() - profile.start
+            self._current = None
+            self._finish(profile)
+
+    def _finish(self, profile):
+        written = False
+        if profile.timer is not None:
+            profile.timer.cancel()
+        if profile.profile is not None:
+            profile.profile.disable()
+            if self.trace_memory:
+                profile.peak_memory_bytes = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            profile.profile.dump_stats(self._file_path(profile.app_id, 'prof'))
+            self.profiled += 1
+            written = True
+        if profile.sampler is not None:
+            profile.sampler.stop()
+            with open(self._file_path(profile.app_id, 'stacks'), 'w') as f:
+                for stack, count in profile.sampler.stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+            self.over_budget += 1
+            written = True
+        if written:
+            self._rotate()
+
+        entry = profile.to_dict()
+        self._push(self._slowest, profile.seconds, entry)
+        if profile.peak_memory_bytes is not None:
+            self._push(self._memory_hungry, profile.peak_memory_bytes, entry)
+
+    def _push(self, heap, value, entry):
+        item = (value, self.apps, entry)
+        if len(heap) < self.report_size:
+            heapq.heappush(heap, item)
+            self._report_changed = True
+        elif value > heap[0][0]:
+            heapq.heapreplace(heap, item)
+            self._report_changed = True
+
+    @contextmanager
+    def phase(self, name):
+        profile = self._current
+        if profile is None:
+            yield
+            return
+        tracing = tracemalloc.is_tracing()
+        memory_before = tracemalloc.get_traced_memory()[0] if tracing else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phase = profile.phases.setdefault(name, {'seconds': 0.0})
+            phase['seconds'] += time.perf_counter() - start
+            if tracing and tracemalloc.is_tracing():
+                phase['memory_bytes'] = phase.get('memory_bytes', 0) + tracemalloc.get_traced_memory()[0] \
+                    - memory_before
+
+    def write_report(self):
+        if not self._report_changed:
+            return
+        report = {
+            'time': datetime.now(tz=timezone.utc).isoformat(),
+            'apps': self.apps,
+            'profiled': self.profiled,
+            'over_budget': self.over_budget,
+            'slowest': [entry for _, _, entry in sorted(self._slowest, key=lambda item: item[0], reverse=True)],
+            'memory_hungry': [entry for _, _, entry in sorted(self._memory_hungry, key=lambda item: item[0],
+                                                              reverse=True)]
+        }
+        path = os.path.join(self.directory, REPORT_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmp_path, path)
+        self._report_changed = False
+        if report['slowest']:
+            slowest = report['slowest'][0]
+            logger.info(f"Profiling report written to {path}, slowest app: {slowest['app_id']} "
+                        f"{slowest['seconds']:.1f} s {slowest['phases']}")
@@ -0,0 +1,119 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+DEFAULT_COMPRESSION = 100
+# quantiles extracted from a sketch into aggregations
+DEFAULT_QUANTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
+
+
+class TDigest:
+    """Mergeable quantile sketch (merging t-digest).
+
+    Values are summarized by weighted centroids. The arcsine scale function keeps the centroids
+    small near the tails, so that extreme quantiles are accurate.
+    The number of centroids is bounded by half of the compression, regardless of the number of values,
+    so the serialized sketch has a small fixed maximum size.
+    Sketches of different runs can be merged, e.g. into a distribution over all runs of a tag.
+    """
+
+    def __init__(self, compression=DEFAULT_COMPRESSION, means=None, weights=None, min_value=None, max_value=None):
+        self.compression = compression
+        self.means = np.asarray(means if means is not None else [], dtype=float)
+        self.weights = np.asarray(weights if weights is not None else [], dtype=float)
+        self.min = min_value
+        self.max = max_value
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    @classmethod
+    def from_values(cls, values, compression=DEFAULT_COMPRESSION):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        digest = cls(compression)
+        if values.size > 0:
+            digest._compress(values, np.ones(values.size))
+        return digest
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='mergesort')
+        means = means[order]
+        weights = weights[order]
+        total = weights.sum()
+        # position of each centroid in the distribution, mapped by the scale function
+        q = (np.cumsum(weights) - weights / 2) / total
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        clusters = np.floor(k - k[0]).astype(int)
+        new_weights = np.bincount(clusters, weights=weights)
+        new_means = np.bincount(clusters, weights=means * weights)
+        non_empty = new_weights > 0
+        self.weights = new_weights[non_empty]
+        self.means = new_means[non_empty] / self.weights
+        self.min = float(means[0]) if self.min is None else min(self.min, float(means[0]))
+        self.max = float(means[-1]) if self.max is None else max(self.max, float(means[-1]))
+
+    def merge(self, other):
+        """Returns a new sketch summarizing values of both sketches."""
+        result = TDigest(max(self.compression, other.compression))
+        means = np.concatenate([self.means, other.means])
+        if means.size == 0:
+            return result
+        weights = np.concatenate([self.weights, other.weights])
+        result._compress(means, weights)
+        result.min = min(v for v in [self.min, other.min] if v is not None)
+        result.max = max(v for v in [self.max, other.max] if v is not None)
+        return result
+
+    def quantile(self, q):
+        if self.means.size == 0:
+            return None
+        total = self.weights.sum()
+        centers = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate([[0.0], centers, [total]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+        return float(np.interp(q * total, positions, values))
+
+    def to_dict(self):
+        return {
+            'compression': self.compression,
+            'means': self.means.tolist(),
+            'weights': self.weights.tolist(),
+            'min': self.min,
+            'max': self.max
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['compression'], means=d['means'], weights=d['weights'], min_value=d['min'], max_value=d['max'])
+
+
+def merge_sketches(sketch_dicts):
+    """Merges serialized sketches (e.g. of one column in aggregations of all runs of a tag) into one TDigest."""
+    result = TDigest()
+    for d in sketch_dicts:
+        if d is not None:
+            result = result.merge(TDigest.from_dict(d))
+    return result
+
+
+def sketch_aggregations(series, compression=DEFAULT_COMPRESSION, quantiles=DEFAULT_QUANTILES):
+    """Returns quantiles and the serialized sketch of a numeric series, or an empty dict if it has no values."""
+    digest = TDigest.from_values(series.values, compression)
+    if digest.means.size == 0:
+        return {}
+    result = {name: digest.quantile(q) for name, q in quantiles.items()}
+    result['sketch'] = digest.to_dict()
+    return result
@@ -0,0 +1,131 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import time
+
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveRateLimiter:
+    """Client side limit of the request rate and of concurrent requests, shared by all threads of a process.
+
+    Requests take tokens from a token bucket refilled at the current rate and wait while the number
+    of requests in flight reaches the current concurrency limit.
+    Both limits are adjusted by AIMD: they grow additively (by about increase_per_second each second)
+    while the server responds in time, and are cut by decrease_factor on an overload signal,
+    i.e. a 5xx response, a malformed response, a connection error or latency above latency_target_seconds.
+    At most one cut is made per latency_target_seconds, so a burst of failed concurrent requests
+    counts as a single signal.
+    """
+
+    def __init__(self,
+                 max_rate=20.0,
+                 min_rate=0.2,
+                 max_concurrency=5,
+                 latency_target_seconds=5.0,
+                 increase_per_second=1.0,
+                 decrease_factor=0.5,
+                 clock=time.monotonic):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.max_concurrency = max_concurrency
+        self.latency_target_seconds = latency_target_seconds
+        self.increase_per_second = increase_per_second
+        self.decrease_factor = decrease_factor
+        self._clock = clock
+
+        # start in the middle, the first responses show which way to go
+        self.rate = max(min_rate, max_rate / 2)
+        self._concurrency = max(1.0, max_concurrency / 2)
+        self._tokens = 1.0
+        self._refilled = clock()
+        self._last_decrease = None
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.decreases = 0
+
+    @property
+    def concurrency_limit(self):
+        return int(self._concurrency)
+
+    def _refill(self, now):
+        burst = max(1.0, self.rate)
+        self._tokens = min(burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self):
+        """Blocks until a request may be sent. Returns the start time to be passed to release."""
+        waited = False
+        wait_start = self._clock()
+        with self._condition:
+            while True:
+                now = self._clock()
+                self._refill(now)
+                if self._in_flight < self.concurrency_limit and self._tokens >= 1:
+                    break
+                waited = True
+                if self._in_flight >= self.concurrency_limit:
+                    timeout = None  # until a request in flight is released
+                else:
+                    timeout = (1 - self._tokens) / self.rate
+                self._condition.wait(timeout)
+            self._tokens -= 1
+            self._in_flight += 1
+            self.requests += 1
+            now = self._clock()
+            if waited:
+                self.throttled += 1
+                self.throttled_seconds += now - wait_start
+        return now
+
+    def release(self, start, overloaded=False):
+        """Ends a request started by acquire. overloaded: the server failed with 5xx or a malformed response."""
+        with self._condition:
+            now = self._clock()
+            self._in_flight -= 1
+            if overloaded or now - start > self.latency_target_seconds:
+                self._decrease(now)
+            else:
+                # additive increase, spread over the requests sent in a second
+                self.rate = min(self.max_rate, self.rate + self.increase_per_second / max(self.rate, 1.0))
+                self._concurrency = min(float(self.max_concurrency), self._concurrency + 1 / self._concurrency)
+            self._condition.notify_all()
+
+    def _decrease(self, now):
+        if self._last_decrease is not None and now - self._last_decrease < self.latency_target_seconds:
+            return
+        self._last_decrease = now
+        self.decreases += 1
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self._concurrency = max(1.0, self._concurrency * self.decrease_factor)
+        logger.info(f"Spark History overloaded, request rate limited to {self.rate:.2f}/s "
+                    f"and {self.concurrency_limit} concurrent requests")
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                'rate': self.rate,
+                'concurrency_limit': self.concurrency_limit,
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'throttled_seconds': self.throttled_seconds,
+                'decreases': self.decreases
+            }
@@ -0,0 +1,337 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from spot.crawler.aggregator import _time_keys_dict
+from spot.crawler.commons import default_enrich
+from spot.crawler.crawler import menas_aggregator_from_config
+from spot.crawler.crawler_args import datetime_format
+from spot.crawler.elastic import Elastic
+from spot.crawler.flattener import flatten_app, DEFAULT_TOP_N, ONLINE_AGGREGATION_THRESHOLD
+from spot.utils.config import SpotConfig
+from spot.yarn.join_cache import YarnJoinCache
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+# app specific aggregator and settings of a worker process
+_worker_app_specific_obj = None
+_worker_refresh_app_specific = False
+_worker_quantile_sketches = False
+_worker_top_n = DEFAULT_TOP_N
+_worker_online_threshold = ONLINE_AGGREGATION_THRESHOLD
+
+
+def _parse_datetime(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def restore_datetimes(app):
+    """Casts times of a raw doc read from Elasticsearch or an archive back to datetimes."""
+    spot_data = app.get('spot')
+    if spot_data is not None and 'time_processed' in spot_data:
+        spot_data['time_processed'] = _parse_datetime(spot_data['time_processed'])
+    for attempt in app.get('attempts', []):
+        for key in _time_keys_dict['attempt']:
+            if key in attempt:
+                attempt[key] = _parse_datetime(attempt[key])
+        for executor in attempt.get('allexecutors', []):
+            for key in _time_keys_dict['executor']:
+                if key in executor:
+                    executor[key] = _parse_datetime(executor[key])
+        for stage in attempt.get('stages', []):
+            for key in _time_keys_dict['stage']:
+                if key in stage:
+                    stage[key] = _parse_datetime(stage[key])
+        for job in attempt.get('jobs', []):
+            for key in _time_keys_dict['job']:
+                if key in job:
+                    job[key] = _parse_datetime(job[key])
+        for execution in attempt.get('sql', []):
+            for key in _time_keys_dict['sql']:
+                if key in execution:
+                    execution[key] = _parse_datetime(execution[key])
+    return app
+
+
+def reaggregate_app(app, app_specific_obj=None, refresh_app_specific=False, quantile_sketches=False,
+                    top_n=DEFAULT_TOP_N, online_threshold=ONLINE_AGGREGATION_THRESHOLD):
+    """Re-runs enrichment, flattening and post-aggregation of a raw doc, as the Crawler does.
+
+    The app specific data stored in the raw doc (e.g. Enceladus run) are reused,
+    unless refresh_app_specific is set, in which case they are requested again (e.g. from Menas).
+    :return: list of aggregations
+    """
+    app = restore_datetimes(app)
+    matching = app_specific_obj is not None and app_specific_obj.is_matching_app(app)
+    if not matching:
+        app = default_enrich(app)
+    elif refresh_app_specific:
+        app = app_specific_obj.enrich(app)
+    if matching:
+        app = app_specific_obj.aggregate(app)
+
+    aggs = []
+    for agg in flatten_app(app, sketches=quantile_sketches, top_n=top_n, online_threshold=online_threshold):
+        if matching:
+            agg = app_specific_obj.post_aggregate(agg)
+        aggs.append(agg)
+    return aggs
+
+
+def _init_worker(config_path, refresh_app_specific):
+    global _worker_app_specific_obj, _worker_refresh_app_specific, _worker_quantile_sketches, _worker_top_n
+    global _worker_online_threshold
+    conf = SpotConfig(config_path) if config_path else SpotConfig()
+    _worker_app_specific_obj = menas_aggregator_from_config(conf)
+    _worker_refresh_app_specific = refresh_app_specific
+    _worker_quantile_sketches = conf.crawler_quantile_sketches
+    _worker_top_n = conf.crawler_top_n
+    _worker_online_threshold = conf.crawler_online_aggregation_threshold
+
+
+def _reaggregate_worker(app):
+    try:
+        aggs = reaggregate_app(app, _worker_app_specific_obj, _worker_refresh_app_specific, _worker_quantile_sketches,
+                               _worker_top_n, _worker_online_threshold)
+        return app.get('id'), aggs, None
+    except Exception as e:
+        return app.get('id'), [], f'{e.__class__.__name__}: {e}'
+
+
+def _end_time_query(min_end_date, max_end_date):
+    if min_end_date is None and max_end_date is None:
+        return None
+    end_time_range = {}
+    if min_end_date is not None:
+        end_time_range['gte'] = min_end_date
+    if max_end_date is not None:
+        end_time_range['lte'] = max_end_date
+    return {'range': {'attempts.endTime': end_time_range}}
+
+
+def read_archive_pages(path, skip_lines=0, page_size=200):
+    """Iterates over a local archive of raw docs (JSON lines, optionally gzipped) in pages.
+
+    :return: generator of (list of docs, number of lines read so far)
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    page = []
+    line_number = 0
+    with opener(path, 'rt') as f:
+        for line in f:
+            line_number += 1
+            if line_number <= skip_lines or not line.strip():
+                continue
+            page.append(json.loads(line))
+            if len(page) >= page_size:
+                yield page, line_number
+                page = []
+    if page:
+        yield page, line_number
+
+
+class ReaggregationState:
+    """Progress of a re-aggregation, saved to a JSON file after each page, so that it can be resumed.
+
+    For Elasticsearch the sort values of the last processed doc are kept for each slice,
+    for an archive the number of processed lines.
+    """
+
+    def __init__(self, path, source, slices):
+        self.path = path
+        self.source = source
+        self.slices = slices
+        self.search_after = {}  # slice id (str) -> sort values
+        self.finished_slices = []
+        self.archive_lines = 0
+        self.docs = 0
+        self.aggs = 0
+        self.failed = 0
+
+    @classmethod
+    def load(cls, path, source, slices):
+        state = cls(path, source, slices)
+        if path is None or not os.path.exists(path):
+            return state
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('source') != source or data.get('slices') != slices:
+            raise ValueError(f"State {path} was saved for source {data.get('source')} "
+                             f"with {data.get('slices')} slices. Use the same arguments or --restart")
+        state.__dict__.update({key: value for key, value in data.items() if key != 'path'})
+        logger.info(f"Resuming re-aggregation from {path}: {state.docs} docs processed before")
+        return state
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({key: value for key, value in self.__dict__.items() if key != 'path'}, f)
+        os.replace(tmp_path, self.path)
+
+
+class Reaggregator:
+    """Re-aggregates pages of raw docs in a process pool and bulk saves the aggregations."""
+
+    def __init__(self, elastic, state, executor=None, yarn_cache=None, min_end_date=None, max_end_date=None):
+        self._elastic = elastic
+        self._state = state
+        self._executor = executor
+        self._yarn_cache = yarn_cache
+        self._min_end_date = min_end_date
+        self._max_end_date = max_end_date
+        self._start = time.monotonic()
+        self._docs_at_start = state.docs
+
+    def _in_time_range(self, app):
+        # end dates of docs from Elasticsearch are already filtered by the query
+        for attempt in app.get('attempts', []):
+            end_time = _parse_datetime(attempt.get('endTime'))
+            if end_time is None:
+                continue
+            if (self._min_end_date is None or end_time >= self._min_end_date) \
+                    and (self._max_end_date is None or end_time <= self._max_end_date):
+                return True
+        return False
+
+    def _add_yarn_fields(self, aggs):
+        yarn_fields = self._yarn_cache.get_many({agg.get('id') for agg in aggs})
+        for agg in aggs:
+            fields = yarn_fields.get(agg.get('id'))
+            if fields is not None:
+                agg['yarn'] = fields
+
+    def process_page(self, docs, filter_dates=False):
+        if filter_dates:
+            docs = [doc for doc in docs if self._in_time_range(doc)]
+        if self._executor is not None:
+            results = self._executor.map(_reaggregate_worker, docs, chunksize=max(1, len(docs) // 32))
+        else:
+            results = map(_reaggregate_worker, docs)
+        aggs = []
+        for app_id, app_aggs, error in results:
+            if error is not None:
+                logger.warning(f"Failed to re-aggregate app: {app_id} error: {error}")
+                self._state.failed += 1
+            aggs.extend(app_aggs)
+        if aggs:
+            if self._yarn_cache is not None:
+                self._add_yarn_fields(aggs)
+            self._elastic.save_aggs(aggs)
+        self._state.docs += len(docs)
+        self._state.aggs += len(aggs)
+        self.log_stats()
+
+    def log_stats(self):
+        seconds = time.monotonic() - self._start
+        rate = (self._state.docs - self._docs_at_start) / seconds if seconds > 0 else 0
+        logger.info(f"re-aggregated {self._state.docs} raw docs into {self._state.aggs} aggs, "
+                    f"failed: {self._state.failed}, rate: {rate:.1f} docs/s")
+
+    def run_elastic(self, page_size=200):
+        state = self._state
+        query = _end_time_query(self._min_end_date, self._max_end_date)
+        for slice_id in range(state.slices):
+            if slice_id in state.finished_slices:
+                continue
+            logger.info(f"re-aggregating slice {slice_id + 1}/{state.slices}")
+            pages = self._elastic.get_raw_pages(query=query,
+                                                slice_id=slice_id,
+                                                max_slices=state.slices,
+                                                search_after=state.search_after.get(str(slice_id)),
+                                                page_size=page_size)
+            for docs, search_after in pages:
+                self.process_page(docs)
+                state.search_after[str(slice_id)] = search_after
+                state.save()
+            state.finished_slices.append(slice_id)
+            state.save()
+
+    def run_archive(self, path, page_size=200):
+        state = self._state
+        for docs, lines in read_archive_pages(path, skip_lines=state.archive_lines, page_size=page_size):
+            self.process_page(docs, filter_dates=True)
+            state.archive_lines = lines
+            state.save()
+
+
+def _parse_date(s):
+    return datetime.strptime(s, datetime_format).replace(tzinfo=timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-aggregates stored raw docs and overwrites their aggregations')
+    parser.add_argument("--config_path",
+                        help="Absolute path to config.ini configuration file, e.g. '/opt/config.ini'")
+    parser.add_argument("--archive",
+                        help="Local archive of raw docs (JSON lines, optionally .gz) "
+                             "to be read instead of the raw index")
+    parser.add_argument("--state_path", default='reaggregate_state.json',
+                        help="File to save the progress to, for resuming an interrupted run")
+    parser.add_argument("--restart", action='store_true', help="Ignore saved progress and start over")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of aggregation processes")
+    parser.add_argument("--slices", type=int, default=1, help="Number of slices the raw index is read in")
+    parser.add_argument("--page_size", type=int, default=200, help="Number of raw docs per page")
+    parser.add_argument("--min_end_date", type=_parse_date,
+                        help=f"Only apps completed after {datetime_format.replace('%', '%%')}")
+    parser.add_argument("--max_end_date", type=_parse_date,
+                        help=f"Only apps completed before {datetime_format.replace('%', '%%')}")
+    parser.add_argument("--refresh_app_specific", action='store_true',
+                        help="Request app specific data (e.g. from Menas) again instead of using the stored data")
+    args = parser.parse_args()
+
+    conf = SpotConfig(args.config_path) if args.config_path else SpotConfig()
+    source = os.path.abspath(args.archive) if args.archive else conf.elastic_raw_index
+    if args.restart and os.path.exists(args.state_path):
+        os.remove(args.state_path)
+    state = ReaggregationState.load(args.state_path, source, args.slices)
+
+    yarn_cache = None
+    if conf.yarn_join_cache_path is not None:
+        yarn_cache = YarnJoinCache(conf.yarn_join_cache_path, retention_hours=conf.yarn_join_cache_retention_hours)
+    elastic = Elastic(conf)
+
+    executor = None
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers,
+                                       initializer=_init_worker,
+                                       initargs=(args.config_path, args.refresh_app_specific))
+    else:
+        _init_worker(args.config_path, args.refresh_app_specific)
+    try:
+        reaggregator = Reaggregator(elastic, state, executor=executor, yarn_cache=yarn_cache,
+                                    min_end_date=args.min_end_date, max_end_date=args.max_end_date)
+        if args.archive:
+            reaggregator.run_archive(args.archive, page_size=args.page_size)
+        else:
+            reaggregator.run_elastic(page_size=args.page_size)
+        reaggregator.log_stats()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
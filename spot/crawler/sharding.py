@@ -0,0 +1,134 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import hashlib
+import logging
+import threading
+import time
+
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key):
+    """Hash of a string, stable across processes (unlike the built-in hash)."""
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys to members. Each member is placed on the ring at vnodes points,
+    so that adding or removing a member moves only about 1 / (number of members) of the keys."""
+
+    def __init__(self, members, vnodes=128):
+        self.members = sorted(set(members))
+        points = sorted((_hash(f'{member}#{i}'), member) for member in self.members for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._owners[i]
+
+
+class ShardMembership:
+    """Membership of a crawler replica in a group of replicas sharing the apps of one Spark History.
+
+    Each replica keeps a lease document (see Elastic.renew_lease) which expires after lease_seconds
+    and is renewed every lease_seconds / 3 by a background thread (see start), so that processing
+    of long time steps does not let the lease expire. Apps are assigned to the replicas with live leases by consistent
+    hashing of the app id. When a replica dies, its lease expires and its apps are taken over by the others
+    at their next renewal; apps it had not stored are processed in the next pass over the lookback window.
+    During a change of membership two replicas may briefly process the same app. Its raw and agg docs
+    are stored with ids derived from the app id, so the second write overwrites the first one,
+    and the allocation rollup includes each app once per bucket.
+    """
+
+    def __init__(self, lease_obj, group, member, lease_seconds=120, vnodes=128, clock=time.monotonic):
+        self._lease_obj = lease_obj
+        self.group = group
+        self.member = member
+        self.lease_seconds = lease_seconds
+        self._vnodes = vnodes
+        self._clock = clock
+        self._ring = HashRing([member], vnodes)
+        self._next_refresh = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.owned = 0
+        self.skipped = 0
+
+    @property
+    def members(self):
+        return self._ring.members
+
+    def refresh(self):
+        """Renews the lease of this replica and reads the live replicas of the group."""
+        self._lease_obj.renew_lease(self.group, self.member, self.lease_seconds)
+        members = set(self._lease_obj.get_live_members(self.group))
+        members.add(self.member)
+        if sorted(members) != self._ring.members:
+            logger.info(f"Crawler replicas of {self.group}: {sorted(members)}, this replica: {self.member}")
+            self._ring = HashRing(members, self._vnodes)
+        self._next_refresh = self._clock() + self.lease_seconds / 3
+
+    def maybe_refresh(self):
+        """Renews the lease if a third of it has passed since the last renewal."""
+        with self._lock:
+            if self._next_refresh is not None and self._clock() < self._next_refresh:
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                # keep the last known membership, the lease is renewed at the next call
+                logger.warning(f"Failed to renew the lease of crawler replica {self.member}: {e}")
+                self._next_refresh = self._clock() + min(30, self.lease_seconds / 3)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.maybe_refresh()
+            self._stop.wait(max(1, self._next_refresh - self._clock()))
+
+    def start(self):
+        """Joins the group and keeps renewing the lease in a background thread until stop."""
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name='shard-lease', daemon=True)
+        self._thread.start()
+
+    def owns(self, app_id):
+        if self._thread is None:
+            self.maybe_refresh()
+        if self._ring.owner(app_id) == self.member:
+            self.owned += 1
+            return True
+        self.skipped += 1
+        return False
+
+    def stop(self):
+        """Stops the renewal thread and leaves the group."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.leave()
+
+    def leave(self):
+        """Releases the lease, so that the other replicas take over the apps without waiting for its expiry."""
+        try:
+            self._lease_obj.release_lease(self.group, self.member)
+        except Exception as e:
+            logger.warning(f"Failed to release the lease of crawler replica {self.member}: {e}")
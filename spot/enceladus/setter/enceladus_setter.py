@@ -30,8 +30,16 @@ def main():
     if cmd_args.app_type == 'std':
         input_path = get_input_path(dataset_doc['hdfsPath'], cmd_args.info_date, cmd_args.info_version)
         print(input_path)
-        hdfs_util = HDFSutils.HDFSutils()
+        hdfs_util = HDFSutils.HDFSutils(max_workers=conf.setter_hdfs_max_workers,
+                                        cache_path=conf.setter_hdfs_size_cache_path)
         input_bytes, input_blocks = hdfs_util.get_input_size(input_path)
+        # the recommender imports numpy, it is loaded only when a recommendation is made
+        from spot.enceladus.setter.recommendation_service import recommender_from_config
+        recommendation = recommender_from_config(conf).recommend(cmd_args.app_type,
+                                                                 cmd_args.dataset_name,
+                                                                 cmd_args.dataset_version,
+                                                                 input_bytes)
+        print(f"Recommendation: {recommendation}")
     else:
         print('unsupported app type: {}'.format(cmd_args.app_type))
 
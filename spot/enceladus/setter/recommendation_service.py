@@ -0,0 +1,232 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import product
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from spot.regression.features import FEATURE_NAMES, feature_vector
+from spot.regression.store import ModelStore
+from spot.utils.config import SpotConfig
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+# Setter app types to Enceladus classification types
+app_types = {
+    'std': 'standardization',
+    'cnfrm': 'conformance',
+    'standardization': 'standardization',
+    'conformance': 'conformance'
+}
+
+
+class Recommender:
+    """Recommends executors configuration for a dataset run based on per-tag regression models.
+
+    All candidate configurations (executors x cores x memory) are evaluated at once:
+    the candidate with the lowest predicted core cost is selected among the candidates
+    whose predicted duration is within duration_slack of the fastest one.
+    The models are held in memory and swapped atomically when a new version appears in the store.
+    """
+
+    def __init__(self, store, executors_grid, cores_grid, memory_grid, duration_slack=0.2):
+        self._store = store
+        self._candidates = list(product(executors_grid, cores_grid, memory_grid))
+        self._duration_slack = duration_slack
+        # only the input size differs between requests
+        self._input_column = FEATURE_NAMES.index('log_input_gb')
+        self._x = np.array([feature_vector(0, executors, cores, memory)
+                            for executors, cores, memory in self._candidates])
+        self._state = None  # (version, model_set, index of tags by dataset)
+        self.reload()
+
+    @staticmethod
+    def _index_tags(model_set):
+        """Maps (type, dataset, dataset_version) to the tag with the most runs."""
+        index = {}
+        for tag, entry in model_set.tags.items():
+            clfsion = entry['classification']
+            model = entry['models'].get('duration')
+            if model is None:
+                continue
+            key = (clfsion.get('type'), clfsion.get('dataset'), str(clfsion.get('dataset_version')))
+            best = index.get(key)
+            if best is None or model.n > model_set.tags[best]['models']['duration'].n:
+                index[key] = tag
+        return index
+
+    @property
+    def version(self):
+        return self._state[0] if self._state else None
+
+    def reload(self):
+        """Loads the latest models if the version has changed. Returns True if new models were loaded."""
+        version = self._store.latest_version()
+        if version is None or version == self.version:
+            return False
+        model_set = self._store.load(version)
+        self._state = (version, model_set, self._index_tags(model_set))
+        logger.info(f"loaded models version {version}, {len(model_set.tags)} tags")
+        return True
+
+    def _features(self, input_bytes):
+        x = self._x.copy()
+        x[:, self._input_column] = feature_vector(input_bytes, 1, 1, 0)[self._input_column]
+        return x
+
+    def recommend(self, app_type, dataset, dataset_version, input_bytes):
+        """Returns the recommended configuration as a dict, or None if there is no model for the dataset."""
+        if self._state is None:
+            return None
+        version, model_set, index = self._state
+        tag = index.get((app_types.get(app_type, app_type), dataset, str(dataset_version)))
+        if tag is None:
+            return None
+        duration_model = model_set.get_model(tag, 'duration')
+        cost_model = model_set.get_model(tag, 'core_cost')
+
+        x = self._features(input_bytes)
+        durations = duration_model.predict_many(x)
+        if cost_model is not None:
+            costs = cost_model.predict_many(x)
+        else:
+            cores_total = np.array([executors * cores for executors, cores, _ in self._candidates])
+            costs = durations * cores_total
+        acceptable = durations <= durations.min() * (1 + self._duration_slack)
+        best = int(np.argmin(np.where(acceptable, costs, np.inf)))
+        executors, cores, memory = self._candidates[best]
+        return {
+            'tag': tag,
+            'executors': executors,
+            'executor_cores': cores,
+            'executor_memory_bytes': memory,
+            'predicted_duration_ms': float(durations[best]),
+            'predicted_core_cost': float(costs[best]),
+            'model_runs': duration_model.n,
+            'model_version': version
+        }
+
+
+class _Reloader(threading.Thread):
+
+    def __init__(self, recommender, interval_seconds):
+        super().__init__(daemon=True)
+        self._recommender = recommender
+        self._stop_event = threading.Event()
+        self._interval = interval_seconds
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            try:
+                self._recommender.reload()
+            except Exception as e:
+                logger.warning(f"Failed to reload models: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def _make_handler(recommender):
+
+    class RecommendationHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive for repeated calls
+
+        def _respond(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/health':
+                self._respond(200, {'status': 'ok', 'model_version': recommender.version})
+                return
+            if url.path != '/recommend':
+                self._respond(404, {'error': f'unknown path {url.path}'})
+                return
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                result = recommender.recommend(params['app_type'],
+                                               params['dataset'],
+                                               params['dataset_version'],
+                                               int(params['input_bytes']))
+            except (KeyError, ValueError) as e:
+                self._respond(400, {'error': f'required parameters: app_type, dataset, dataset_version, '
+                                             f'input_bytes ({e.__class__.__name__}: {e})'})
+                return
+            if result is None:
+                self._respond(404, {'error': 'no model for the dataset'})
+                return
+            self._respond(200, result)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return RecommendationHandler
+
+
+def recommender_from_config(conf):
+    return Recommender(ModelStore(conf.regression_model_dir),
+                       executors_grid=conf.setter_executors_grid,
+                       cores_grid=conf.setter_cores_grid,
+                       memory_grid=conf.setter_memory_grid,
+                       duration_slack=conf.setter_duration_slack)
+
+
+def serve(recommender, host, port, reload_seconds):
+    reloader = _Reloader(recommender, reload_seconds)
+    reloader.start()
+    server = ThreadingHTTPServer((host, port), _make_handler(recommender))
+    logger.info(f"Recommendation service listening on {host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        reloader.stop()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Executors configuration recommendations for Enceladus runs')
+    parser.add_argument('--config_path', help="Absolute path to config.ini configuration file, e.g. '/opt/config.ini'")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='run HTTP service')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, help='overrides port in config')
+    query_parser = subparsers.add_parser('query', help='print a single recommendation')
+    query_parser.add_argument('app_type', help='Enceladus app type: [std/cnfrm]', type=str)
+    query_parser.add_argument('dataset_name', help='name of the dataset', type=str)
+    query_parser.add_argument('dataset_version', help='version of the dataset', type=int)
+    query_parser.add_argument('input_bytes', help='input size in bytes', type=int)
+    args = parser.parse_args()
+
+    conf = SpotConfig(args.config_path) if args.config_path else SpotConfig()
+    recommender = recommender_from_config(conf)
+    if args.command == 'serve':
+        serve(recommender, args.host, args.port or conf.setter_port, conf.setter_reload_seconds)
+    else:
+        print(json.dumps(recommender.recommend(args.app_type, args.dataset_name,
+                                               args.dataset_version, args.input_bytes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+from spot.crawler.commons import get_attribute, bytes_to_gb
+
+# Features are log-transformed, so that a linear model in the feature space
+# corresponds to a power law: time ~ input^a * executors^b * cores^c * memory^d
+FEATURE_NAMES = [
+    'intercept',
+    'log_input_gb',
+    'log_executors',
+    'log_executor_cores',
+    'log_executor_memory_gb'
+]
+
+TARGET_NAMES = [
+    'duration',
+    'core_cost'
+]
+
+_target_paths = {
+    'duration': ['attempt', 'duration'],
+    'core_cost': ['attempt', 'aggs', 'summary', 'core_cost']
+}
+
+_input_size_keys = {
+    'standardization': 'std_input_data_size',
+    'conformance': 'conform_input_data_size',
+    'standardization&conformance': 'std_input_data_size'
+}
+
+
+def input_bytes(agg):
+    """Input size of the run in bytes.
+    For Enceladus runs it is the size of input in storage as reported in Menas,
+    otherwise the max input of a stage in memory."""
+    enceladus_type = get_attribute(agg, ['app_specific_data', 'classification', 'type'])
+    size_key = _input_size_keys.get(enceladus_type)
+    if size_key is not None:
+        size = get_attribute(agg, ['attempt', 'app_specific_data', 'enceladus_run', 'controlMeasure',
+                                   'metadata', 'additionalInfo', size_key])
+        if isinstance(size, (int, float)):
+            return size
+    return get_attribute(agg, ['attempt', 'aggs', 'stages', 'inputBytes', 'max'])
+
+
+def feature_vector(input_size_bytes, executors, executor_cores, executor_memory_bytes):
+    """Builds a feature vector (ordered as FEATURE_NAMES) from run configuration values."""
+    return [
+        1.0,
+        math.log1p(bytes_to_gb(input_size_bytes)),
+        math.log(max(executors, 1)),
+        math.log(max(executor_cores, 1)),
+        math.log1p(bytes_to_gb(executor_memory_bytes))
+    ]
+
+
+def extract_features(agg):
+    """Returns a feature vector for an aggregation doc or None if required values are missing."""
+    size = input_bytes(agg)
+    executors = get_attribute(agg, ['attempt', 'aggs', 'allexecutors', 'executors', 'elements_count'])
+    props = get_attribute(agg, ['attempt', 'environment', 'sparkProperties']) or {}
+    cores = props.get('spark_executor_cores', 1)
+    memory = props.get('spark_executor_memory')
+    if size is None or not executors or memory is None:
+        return None
+    return feature_vector(size, executors, cores, memory)
+
+
+def extract_targets(agg):
+    """Returns {target_name: value} of the available positive targets."""
+    targets = {}
+    for name in TARGET_NAMES:
+        value = get_attribute(agg, list(_target_paths[name]))
+        if isinstance(value, (int, float)) and value > 0:
+            targets[name] = value
+    return targets
@@ -0,0 +1,104 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+import numpy as np
+
+
+class IncrementalRidge:
+    """Ridge regression fitted from sufficient statistics (X'X, X'y, y'y, n).
+
+    Adding a sample costs O(features^2) and does not require the history of samples.
+    The first feature is assumed to be the intercept, which is not penalized.
+    With log_target=True the model is fitted to log(y) (log-linear model)
+    and predictions are transformed back.
+    """
+
+    def __init__(self, n_features, alpha=1.0, log_target=True):
+        self.n_features = n_features
+        self.alpha = alpha
+        self.log_target = log_target
+        self.xtx = np.zeros((n_features, n_features))
+        self.xty = np.zeros(n_features)
+        self.yty = 0.0
+        self.n = 0
+        self._coef = None
+
+    def _transform(self, y):
+        return math.log(y) if self.log_target else y
+
+    def update(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = self._transform(y)
+        self.xtx += np.outer(x, x)
+        self.xty += x * y
+        self.yty += y * y
+        self.n += 1
+        self._coef = None
+
+    def merge(self, other):
+        """Adds statistics of another model fitted on different samples."""
+        self.xtx += other.xtx
+        self.xty += other.xty
+        self.yty += other.yty
+        self.n += other.n
+        self._coef = None
+
+    @property
+    def coef(self):
+        if self._coef is None:
+            penalty = self.alpha * np.eye(self.n_features)
+            penalty[0, 0] = 0.0
+            self._coef = np.linalg.lstsq(self.xtx + penalty, self.xty, rcond=None)[0]
+        return self._coef
+
+    def predict(self, x):
+        value = float(np.dot(self.coef, np.asarray(x, dtype=float)))
+        return math.exp(value) if self.log_target else value
+
+    def predict_many(self, x_matrix):
+        values = np.asarray(x_matrix, dtype=float) @ self.coef
+        return np.exp(values) if self.log_target else values
+
+    @property
+    def rmse(self):
+        """Root mean squared error on the training samples (in the transformed target space)."""
+        if self.n == 0:
+            return None
+        w = self.coef
+        sse = self.yty - 2 * np.dot(w, self.xty) + w @ self.xtx @ w
+        return math.sqrt(max(sse, 0.0) / self.n)
+
+    def to_dict(self):
+        return {
+            'n_features': self.n_features,
+            'alpha': self.alpha,
+            'log_target': self.log_target,
+            'xtx': self.xtx.tolist(),
+            'xty': self.xty.tolist(),
+            'yty': self.yty,
+            'n': self.n,
+            'coef': self.coef.tolist() if self.n > 0 else None
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        model = cls(d['n_features'], alpha=d['alpha'], log_target=d['log_target'])
+        model.xtx = np.array(d['xtx'], dtype=float)
+        model.xty = np.array(d['xty'], dtype=float)
+        model.yty = d['yty']
+        model.n = d['n']
+        if d.get('coef') is not None:
+            model._coef = np.array(d['coef'], dtype=float)
+        return model
@@ -0,0 +1,157 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import os
+import re
+from datetime import datetime, timezone
+
+from spot.regression.features import FEATURE_NAMES, extract_features, extract_targets
+from spot.regression.model import IncrementalRidge
+from spot.crawler.commons import get_attribute
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+_file_pattern = re.compile(r'^models_v(\d+)\.json$')
+
+
+class ModelSet:
+    """Per-tag models for each target, updated incrementally with aggregation docs."""
+
+    def __init__(self, alpha=1.0, log_target=True, version=0, watermark=None, recent_runs=None):
+        self.alpha = alpha
+        self.log_target = log_target
+        self.version = version
+        # max spot.time_processed of the docs included in the models
+        self.watermark = watermark
+        # run id -> spot.time_processed (ISO) of the docs included shortly before the watermark
+        self.recent_runs = recent_runs or {}
+        self.tags = {}  # tag -> {'classification': dict, 'models': {target: IncrementalRidge}}
+
+    def update(self, agg):
+        """Adds a final attempt aggregation doc to the models of its tag.
+
+        :return: True if the doc was used
+        """
+        if agg.get('isFinalAttempt') is False:
+            return False
+        tag = get_attribute(agg, ['app_specific_data', 'tag'])
+        x = extract_features(agg)
+        targets = extract_targets(agg)
+        if tag is None or x is None or not targets:
+            return False
+        entry = self.tags.setdefault(tag, {
+            'classification': get_attribute(agg, ['app_specific_data', 'classification']) or {},
+            'models': {}
+        })
+        for target, y in targets.items():
+            model = entry['models'].get(target)
+            if model is None:
+                model = IncrementalRidge(len(FEATURE_NAMES), alpha=self.alpha, log_target=self.log_target)
+                entry['models'][target] = model
+            model.update(x, y)
+        return True
+
+    def get_model(self, tag, target):
+        entry = self.tags.get(tag)
+        if entry is None:
+            return None
+        return entry['models'].get(target)
+
+    def to_dict(self):
+        return {
+            'format': FORMAT_VERSION,
+            'version': self.version,
+            'created': datetime.now(tz=timezone.utc).isoformat(),
+            'watermark': self.watermark.isoformat() if self.watermark else None,
+            'recent_runs': self.recent_runs,
+            'alpha': self.alpha,
+            'log_target': self.log_target,
+            'feature_names': FEATURE_NAMES,
+            'tags': {
+                tag: {
+                    'classification': entry['classification'],
+                    'models': {target: model.to_dict() for target, model in entry['models'].items()}
+                } for tag, entry in self.tags.items()
+            }
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get('format') != FORMAT_VERSION or d.get('feature_names') != FEATURE_NAMES:
+            raise ValueError(f"Incompatible models format {d.get('format')} or features {d.get('feature_names')}")
+        watermark = datetime.fromisoformat(d['watermark']) if d.get('watermark') else None
+        model_set = cls(alpha=d['alpha'], log_target=d['log_target'], version=d['version'], watermark=watermark,
+                        recent_runs=d.get('recent_runs'))
+        for tag, entry in d['tags'].items():
+            model_set.tags[tag] = {
+                'classification': entry['classification'],
+                'models': {target: IncrementalRidge.from_dict(m) for target, m in entry['models'].items()}
+            }
+        return model_set
+
+
+class ModelStore:
+    """Directory of versioned model files: models_v<version>.json.
+    Each save writes a new version; only the latest keep_versions files are kept."""
+
+    def __init__(self, path, keep_versions=10):
+        self.path = path
+        self.keep_versions = keep_versions
+
+    def _versions(self):
+        if not os.path.isdir(self.path):
+            return []
+        versions = []
+        for name in os.listdir(self.path):
+            match = _file_pattern.match(name)
+            if match:
+                versions.append(int(match.group(1)))
+        return sorted(versions)
+
+    def _file_path(self, version):
+        return os.path.join(self.path, f'models_v{version:06d}.json')
+
+    def latest_version(self):
+        versions = self._versions()
+        return versions[-1] if versions else None
+
+    def load(self, version=None):
+        """Loads the given or the latest version of models, returns None if there are no models."""
+        if version is None:
+            version = self.latest_version()
+            if version is None:
+                return None
+        with open(self._file_path(version)) as f:
+            model_set = ModelSet.from_dict(json.load(f))
+        logger.debug(f"loaded models version {version} from {self.path}")
+        return model_set
+
+    def save(self, model_set):
+        """Saves the models as a new version, returns the version number."""
+        os.makedirs(self.path, exist_ok=True)
+        model_set.version = (self.latest_version() or 0) + 1
+        file_path = self._file_path(model_set.version)
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(model_set.to_dict(), f, default=str)
+        # readers never see a partially written file
+        os.replace(tmp_path, file_path)
+        logger.info(f"saved models version {model_set.version} to {file_path}")
+
+        for old_version in self._versions()[:-self.keep_versions]:
+            os.remove(self._file_path(old_version))
+        return model_set.version
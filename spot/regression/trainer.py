@@ -0,0 +1,109 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import logging
+from datetime import datetime, timedelta
+
+from spot.crawler.elastic import Elastic
+from spot.regression.store import ModelSet, ModelStore
+from spot.utils.config import SpotConfig
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+# fields of agg docs used by the models
+_source_fields = [
+    'id',
+    'isFinalAttempt',
+    'spot.time_processed',
+    'app_specific_data.tag',
+    'app_specific_data.classification',
+    'attempt.attemptId',
+    'attempt.endTime',
+    'attempt.duration',
+    'attempt.aggs.summary.core_cost',
+    'attempt.aggs.stages.inputBytes.max',
+    'attempt.aggs.allexecutors.executors.elements_count',
+    'attempt.environment.sparkProperties.spark_executor_cores',
+    'attempt.environment.sparkProperties.spark_executor_memory',
+    'attempt.app_specific_data.enceladus_run.controlMeasure.metadata.additionalInfo.std_input_data_size',
+    'attempt.app_specific_data.enceladus_run.controlMeasure.metadata.additionalInfo.conform_input_data_size'
+]
+
+# docs saved up to this long before the watermark are read again, as saves are not visible in the order of
+# their spot.time_processed (clocks of crawler hosts, index refresh); runs already included are skipped by id
+WATERMARK_OVERLAP = timedelta(minutes=15)
+
+
+def _run_id(agg):
+    return f"{agg.get('id')}-{agg.get('attempt', {}).get('attemptId', 0)}"
+
+
+def _time_processed(agg):
+    time_processed = agg.get('spot', {}).get('time_processed') or agg['attempt']['endTime']
+    return datetime.fromisoformat(time_processed)
+
+
+def train(elastic, store, alpha=1.0):
+    """Updates the latest models with agg docs saved since the models watermark
+    and saves them as a new version.
+
+    :return: number of docs added to the models
+    """
+    model_set = store.load()
+    if model_set is None:
+        logger.info(f"No models found in {store.path}, training from scratch")
+        model_set = ModelSet(alpha=alpha)
+
+    counter = 0
+    watermark = model_set.watermark
+    recent = {run_id: datetime.fromisoformat(t) for run_id, t in model_set.recent_runs.items()}
+    time_min = watermark - WATERMARK_OVERLAP if watermark is not None else None
+    for agg in elastic.get_aggs_processed_since(time_min, source=_source_fields):
+        run_id = _run_id(agg)
+        if run_id in recent:
+            continue
+        if model_set.update(agg):
+            counter += 1
+        time_processed = _time_processed(agg)
+        recent[run_id] = time_processed
+        if watermark is None or time_processed > watermark:
+            watermark = time_processed
+
+    if counter > 0:
+        model_set.watermark = watermark
+        model_set.recent_runs = {run_id: t.isoformat() for run_id, t in recent.items()
+                                 if t >= watermark - WATERMARK_OVERLAP}
+        store.save(model_set)
+    logger.info(f"{counter} new runs added to models of {len(model_set.tags)} tags")
+    return counter
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental training of regression models over the agg index')
+    parser.add_argument("--config_path",
+                        help="Absolute path to config.ini configuration file, e.g. '/opt/config.ini'")
+    parser.add_argument("--model_dir",
+                        help="Directory of versioned model files, overrides model_dir in config")
+    args = parser.parse_args()
+
+    conf = SpotConfig(args.config_path) if args.config_path else SpotConfig()
+    model_dir = args.model_dir or conf.regression_model_dir
+    store = ModelStore(model_dir, keep_versions=conf.regression_keep_versions)
+    elastic = Elastic(conf)
+    train(elastic, store, alpha=conf.regression_alpha)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,44 +11,163 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
+import os
+import re
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
 
 hdfs_block_size = 134217728
 
+# e.g. '/data/part-0000.parquet 1234 bytes, replicated: replication=3, 1 block(s):  OK'
+# or (Hadoop 2) '/data/part-0000.parquet 1234 bytes, 1 block(s):  OK'
+_fsck_file_pattern = re.compile(r'^(\S+) (\d+) bytes,.* (\d+) block\(s\)')
+# e.g. '-rw-r--r--   3 user group       1234 2020-07-01 10:00 /data/part-0000.parquet'
+_ls_entry_pattern = re.compile(r'^([d-])\S*\s+\S+\s+\S+\s+\S+\s+(\d+)\s+(\S+ \S+)\s+(\S+)$')
+
+
+def _run(args):
+    process = subprocess.run(args,
+                             check=True,
+                             stdout=subprocess.PIPE,
+                             universal_newlines=True)
+    return process.stdout
+
+
+def _is_data_file(path):
+    filename = path.split('/')[-1]
+    return (len(filename) > 0) and (not filename[0] in ['_', '.'])
+
+
+def _hdfs_path(path):
+    """Path without scheme, authority and trailing slash, as printed by fsck."""
+    return urlparse(path).path.rstrip('/') or '/'
+
+
+def _is_direct_data_file(path, dir_path):
+    """True for a data file directly in dir_path (or dir_path itself being a data file).
+    Files in subdirectories are not read as input, as with 'hdfs dfs -ls <dir>'."""
+    path = _hdfs_path(path)
+    dir_path = _hdfs_path(dir_path)
+    if path == dir_path:
+        return _is_data_file(path)
+    prefix = dir_path.rstrip('/') + '/'
+    if not path.startswith(prefix):
+        return False
+    relative = path[len(prefix):]
+    return '/' not in relative and _is_data_file(relative)
+
+
+def parse_fsck_files(fsck_output, dir_path):
+    """Parses output of 'hdfs fsck <dir_path> -files' into a list of (path, bytes, blocks)
+    of data files directly in dir_path. fsck lists subdirectories recursively, their files are skipped."""
+    files = []
+    for line in fsck_output.split('\n'):
+        match = _fsck_file_pattern.match(line)
+        if match and _is_direct_data_file(match.group(1), dir_path):
+            files.append((match.group(1), int(match.group(2)), int(match.group(3))))
+    return files
+
+
+def parse_ls_entries(ls_output):
+    """Parses output of 'hdfs dfs -ls <path>' into a list of (path, is_dir, bytes, modification time)."""
+    entries = []
+    for line in ls_output.split('\n'):
+        match = _ls_entry_pattern.match(line.strip())
+        if match:
+            entries.append((match.group(4), match.group(1) == 'd', int(match.group(2)), match.group(3)))
+    return entries
+
+
+def listing_fingerprint(entries):
+    """Digest of names, sizes and modification times of the entries of a directory."""
+    data = json.dumps(sorted(entries))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
 
 class HDFSutils:
+    """Sizing of HDFS input directories.
 
-    def __init__(self, hdfs_block_size=hdfs_block_size):
+    Only data files directly in the directory are counted (names starting with '_' or '.' are skipped).
+    The directory is listed by 'hdfs dfs -ls <dir>' and results are cached by path and a fingerprint
+    of the listing (names, sizes and modification times of the files), optionally in a JSON file
+    shared by repeated invocations. On a cache miss, the size and number of blocks of all files
+    are obtained by a single 'hdfs fsck <dir> -files' call. If it fails, the files are checked
+    one by one in a bounded pool of parallel subprocesses.
+    """
+
+    def __init__(self, hdfs_block_size=hdfs_block_size, max_workers=8, cache_path=None):
         self.hdfs_block_size = hdfs_block_size
+        self.max_workers = max_workers
+        self.cache_path = cache_path
+        self._cache = self._load_cache()
+
+    def _load_cache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable HDFS size cache {self.cache_path}: {e}")
+            return {}
+
+    def _save_cache(self):
+        if self.cache_path is None:
+            return
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._cache, f)
+        os.replace(tmp_path, self.cache_path)
+
+    @staticmethod
+    def list_entries(dir_path):
+        return parse_ls_entries(_run(['hdfs', 'dfs', '-ls', dir_path]))
+
+    @staticmethod
+    def _get_file_stats(file):
+        stats = _run(['hdfs', 'fsck', file, '-files']).split('\n')[1].split(' ')
+        return file, int(stats[1]), int(stats[5])
+
+    def _get_files_batched(self, dir_path):
+        return parse_fsck_files(_run(['hdfs', 'fsck', dir_path, '-files']), dir_path)
+
+    def _get_files_parallel(self, file_paths):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self._get_file_stats, file_paths))
 
     def get_input_size(self, dir_path):
         print(f"Checking input dir: {dir_path}")
-        filelist_process = subprocess.run(['hdfs', 'dfs', '-ls', '-C', dir_path],
-                                          check=True,
-                                          stdout=subprocess.PIPE,
-                                          universal_newlines=True)
-        raw_filelist = filelist_process.stdout.split('\n')
-        file_paths = []
-        for path in raw_filelist:
-            filename = path.split('/')[-1]
-            print(filename)
-            if (len(path) > 0) and (not filename[0] in ['_', '.']):
-                file_paths.append(path)
+        data_files = [(path, size, modification_time)
+                      for path, is_dir, size, modification_time in self.list_entries(dir_path)
+                      if not is_dir and _is_direct_data_file(path, dir_path)]
+        fingerprint = listing_fingerprint(data_files)
+        cached = self._cache.get(dir_path)
+        if cached is not None and cached.get('fingerprint') == fingerprint:
+            print(f"Input totals (cached): {cached['bytes']} bytes, {cached['blocks']} HDFS blocks")
+            return cached['bytes'], cached['blocks']
+
+        try:
+            files = self._get_files_batched(dir_path)
+        except subprocess.CalledProcessError as e:
+            print(f"Batched fsck failed ({e}), checking files in parallel")
+            files = self._get_files_parallel([path for path, _, _ in data_files])
 
         size_bytes = 0
         blocks = 0
-        for file in file_paths:
-            hdfs_stats_process = subprocess.run(['hdfs', 'fsck', file, '-files'],
-                                                check=True,
-                                                stdout=subprocess.PIPE,
-                                                universal_newlines=True)
-            stats = hdfs_stats_process.stdout.split('\n')[1].split(' ')
-            file_bytes = int(stats[1])
+        for file, file_bytes, file_blocks in files:
             size_bytes += file_bytes
-            file_blocks = int(stats[5])
             blocks += file_blocks
             print(f"{file_blocks} blocks, {file_bytes} bytes {file}")
 
         print(f"Input totals: {size_bytes} bytes, {blocks} HDFS blocks")
+        self._cache[dir_path] = {
+            'fingerprint': fingerprint,
+            'bytes': size_bytes,
+            'blocks': blocks
+        }
+        self._save_cache()
         return size_bytes, blocks
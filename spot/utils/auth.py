@@ -12,14 +12,207 @@
 # limitations under the License.
 
 import logging
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
-from pycognito.aws_srp import AWSSRP
-from requests_aws4auth import AWS4Auth
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# lifetime assumed for credentials returned without an expiration
+DEFAULT_CREDENTIALS_SECONDS = 3600
+# delay between attempts to refresh credentials after a failure
+REFRESH_RETRY_SECONDS = 30
+
+_providers = {}  # cognito settings -> CognitoCredentialProvider shared in the process
+_providers_lock = threading.Lock()
+
+
+def _get_cognito_credentials(conf):
+    """Logs in to the user pool and returns temporary AWS credentials of the identity pool
+    as a dict with AccessKeyId, SecretKey, SessionToken and Expiration (datetime, if returned)."""
+    # AWS libraries are slow to import, load them only when cognito is configured
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.client import Config
+    from pycognito.aws_srp import AWSSRP
+
+    # Retrieve IdToken based on username & password
+    client = boto3.client('cognito-idp',
+                           config=Config(signature_version=UNSIGNED,
+                                         region_name=conf.cognito_region))
+    aws = AWSSRP(username=conf.oauth_username,
+                 password=conf.oauth_password,
+                 pool_id=conf.user_pool_id,
+                 client_id=conf.client_id,
+                 client_secret=conf.client_secret,
+                 client=client)
+    token = aws.authenticate_user()
+    auth_token = token["AuthenticationResult"]["IdToken"]
+    logger.debug("Auth successful via cognito")
+
+    client = boto3.client('cognito-identity', conf.cognito_region)
+    # Retrieve Identity Pool ID based on IdToken
+    IdRes = client.get_id(AccountId=conf.aws_account_id,
+                          IdentityPoolId=conf.identity_pool_id,
+                          Logins={'cognito-idp.{0}.amazonaws.com/{1}'.format(conf.cognito_region,
+                                                                             conf.user_pool_id): auth_token})
+
+    logger.debug("Identity Pool ID retrieved")
+    # Retrieve Access key and Secret access key for the retrieved Identity Pool ID
+    AccessRes = client.get_credentials_for_identity(
+        IdentityId=IdRes['IdentityId'],
+        Logins={'cognito-idp.{0}.amazonaws.com/{1}'.format(conf.cognito_region, conf.user_pool_id): auth_token},
+                CustomRoleArn="arn:aws:iam::{0}:role/{1}".format(conf.aws_account_id, conf.elasticsearch_role_name))
+    logger.debug("Access tokens retrieved")
+    return AccessRes['Credentials']
+
+
+class CognitoCredentialProvider:
+    """Cached temporary AWS credentials obtained via Cognito, refreshed by a background thread
+    refresh_margin_seconds before they expire.
+
+    If a refresh fails, it is retried every REFRESH_RETRY_SECONDS while the cached credentials are valid.
+    Expired credentials are refreshed synchronously by the caller.
+    Credentials are fetched outside of the lock guarding the cached ones, so requests signed with valid
+    credentials never wait for Cognito.
+    """
+
+    def __init__(self, conf, refresh_margin_seconds=300, fetch_func=_get_cognito_credentials, clock=time.time):
+        self._conf = conf
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self._fetch_func = fetch_func
+        self._clock = clock
+        self._lock = threading.Lock()  # guards the cached credentials
+        self._refresh_lock = threading.Lock()  # only one refresh at a time
+        self._credentials = None
+        self._expires = None
+        self._version = 0  # incremented with each refresh
+        self._wake = threading.Event()
+        self._thread = None
+        self.refreshes = 0
+        self.failed_refreshes = 0
+
+    def _refresh(self):
+        """Fetches new credentials, called with _refresh_lock held."""
+        credentials = self._fetch_func(self._conf)
+        expiration = credentials.get('Expiration')
+        if expiration is not None:
+            expires = expiration.timestamp()
+        else:
+            expires = self._clock() + DEFAULT_CREDENTIALS_SECONDS
+        with self._lock:
+            self._credentials = credentials
+            self._expires = expires
+            self._version += 1
+        self.refreshes += 1
+        logger.debug(f"AWS credentials refreshed, valid for {expires - self._clock():.0f} s")
+
+    def _is_valid(self):
+        return self._credentials is not None and self._clock() < self._expires
+
+    def _current(self):
+        """Returns (version, credentials) if the cached credentials are valid, otherwise None."""
+        with self._lock:
+            if not self._is_valid():
+                return None
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cognito-refresh', daemon=True)
+                self._thread.start()
+            return self._version, self._credentials
+
+    def get_credentials(self):
+        """Returns (version, credentials), refreshing them first if they are missing or expired."""
+        current = self._current()
+        if current is not None:
+            return current
+        with self._refresh_lock:
+            # another caller may have refreshed them meanwhile
+            current = self._current()
+            if current is None:
+                self._refresh()
+                current = self._current()
+        return current
+
+    def invalidate(self, version):
+        """Marks credentials of the given version as rejected, e.g. after a 403 response.
+        They are refreshed by the next get_credentials, unless they were refreshed already."""
+        with self._lock:
+            if version == self._version:
+                self._expires = self._clock()
+        self._wake.set()
+
+    def _seconds_to_refresh(self):
+        with self._lock:
+            return self._expires - self.refresh_margin_seconds - self._clock()
+
+    def _run(self):
+        while True:
+            delay = self._seconds_to_refresh()
+            if delay > 0:
+                self._wake.wait(delay)
+                self._wake.clear()
+                continue
+            failed = False
+            with self._refresh_lock:
+                if self._seconds_to_refresh() <= 0:  # unless refreshed by a caller meanwhile
+                    try:
+                        self._refresh()
+                    except Exception as e:
+                        self.failed_refreshes += 1
+                        logger.warning(f"Failed to refresh AWS credentials, "
+                                       f"retrying in {REFRESH_RETRY_SECONDS} s: {e}")
+                        failed = True
+            if failed:
+                self._wake.wait(REFRESH_RETRY_SECONDS)
+                self._wake.clear()
+
+
+class RefreshableAWS4Auth:
+    """requests auth signing each request with the current credentials of a CognitoCredentialProvider,
+    so that refreshed credentials are used by all sessions sharing the provider."""
+
+    def __init__(self, provider, region, service='es'):
+        self.provider = provider
+        self._region = region
+        self._service = service
+        self._auth = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _current_auth(self):
+        version, credentials = self.provider.get_credentials()
+        with self._lock:
+            if version != self._version:
+                from requests_aws4auth import AWS4Auth
+                self._auth = AWS4Auth(credentials['AccessKeyId'],
+                                      credentials['SecretKey'],
+                                      self._region, self._service,
+                                      session_token=credentials['SessionToken'])
+                self._version = version
+            return self._version, self._auth
+
+    def __call__(self, request):
+        _, auth = self._current_auth()
+        return auth(request)
+
+    def invalidate(self):
+        """Forces a refresh of the credentials used to sign the previous requests."""
+        with self._lock:
+            version = self._version
+        self.provider.invalidate(version)
+
+
+def get_credential_provider(conf):
+    """Returns the CognitoCredentialProvider for the cognito settings of conf, shared by all clients of the process."""
+    key = (conf.cognito_region, conf.user_pool_id, conf.client_id, conf.oauth_username, conf.aws_account_id,
+           conf.identity_pool_id, conf.elasticsearch_role_name)
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            provider = CognitoCredentialProvider(conf, refresh_margin_seconds=conf.auth_refresh_margin_seconds)
+            _providers[key] = provider
+        return provider
+
+
 def auth_config(conf):
     if not conf.auth_type:
         logger.warning("No AuthType found, proceeding without Elasticsearch authentication")
@@ -31,38 +224,7 @@ def auth_config(conf):
 
     if conf.auth_type == "cognito":
         logger.debug("AuthType of 'cognito' found")
-        # Retrieve IdToken based on username & password
-        client = boto3.client('cognito-idp',
-                               config=Config(signature_version=UNSIGNED,
-                                             region_name=conf.cognito_region))
-        aws = AWSSRP(username=conf.oauth_username,
-                     password=conf.oauth_password,
-                     pool_id=conf.user_pool_id,
-                     client_id=conf.client_id,
-                     client_secret=conf.client_secret,
-                     client=client)
-        token = aws.authenticate_user()
-        auth_token = token["AuthenticationResult"]["IdToken"]
-        logger.debug("Auth successful via cognito")
-
-        client = boto3.client('cognito-identity', conf.cognito_region)
-        # Retrieve Identity Pool ID based on IdToken
-        IdRes = client.get_id(AccountId=conf.aws_account_id,
-                              IdentityPoolId=conf.identity_pool_id,
-                              Logins={'cognito-idp.{0}.amazonaws.com/{1}'.format(conf.cognito_region,
-                                                                                 conf.user_pool_id): auth_token})
-
-        logger.debug("Identity Pool ID retrieved")
-        # Retrieve Access key and Secret access key for the retrieved Identity Pool ID
-        AccessRes = client.get_credentials_for_identity(
-            IdentityId=IdRes['IdentityId'],
-            Logins={'cognito-idp.{0}.amazonaws.com/{1}'.format(conf.cognito_region, conf.user_pool_id): auth_token},
-                    CustomRoleArn="arn:aws:iam::{0}:role/{1}".format(conf.aws_account_id, conf.elasticsearch_role_name))
-        logger.debug("Access tokens retrieved")
-        # Configure signing auth
-        credentials = AccessRes['Credentials']
-        http_auth = AWS4Auth(credentials['AccessKeyId'],
-                            credentials['SecretKey'],
-                            conf.elasticsearch_region, 'es',
-                            session_token=credentials['SessionToken'])
+        http_auth = RefreshableAWS4Auth(get_credential_provider(conf), conf.elasticsearch_region, 'es')
+        # authenticate now, so that configuration errors are reported at startup
+        http_auth.provider.get_credentials()
         return http_auth
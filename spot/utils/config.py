@@ -61,6 +61,73 @@ class SpotConfig(Config):
     def history_ssl_path(self):
         return self.get_property('SPARK_HISTORY', 'ssl_path')
 
+    @property
+    def history_fetch_jobs(self):
+        if self.get_boolean('SPARK_HISTORY', 'fetch_jobs'):
+            return True
+        return False
+
+    @property
+    def history_fetch_sql(self):
+        if self.get_boolean('SPARK_HISTORY', 'fetch_sql'):
+            return True
+        return False
+
+    @property
+    def history_max_requests_per_second(self):
+        str_val = self.get_property('SPARK_HISTORY', 'max_requests_per_second')
+        try:
+            return float(str_val)
+        except (TypeError, ValueError):
+            return None
+
+    @property
+    def history_max_concurrent_requests(self):
+        str_val = self.get_property('SPARK_HISTORY', 'max_concurrent_requests')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 5
+
+    @property
+    def history_latency_target_seconds(self):
+        str_val = self.get_property('SPARK_HISTORY', 'latency_target_seconds')
+        try:
+            return float(str_val)
+        except (TypeError, ValueError):
+            return 5.0
+
+    @property
+    def history_circuit_failure_threshold(self):
+        str_val = self.get_property('SPARK_HISTORY', 'circuit_failure_threshold')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 3
+
+    @property
+    def history_circuit_probe_min_seconds(self):
+        str_val = self.get_property('SPARK_HISTORY', 'circuit_probe_min_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 30
+
+    @property
+    def history_circuit_probe_max_seconds(self):
+        str_val = self.get_property('SPARK_HISTORY', 'circuit_probe_max_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 900
+
+    @property
+    def event_log_dir(self):
+        return self.get_property('EVENT_LOGS', 'event_log_dir')
+
+    @property
+    def event_log_parse_workers(self):
+        str_val = self.get_property('EVENT_LOGS', 'parse_workers')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 1
+
     @property
     def crawler_sleep_seconds(self):
         str_val = self.get_property('CRAWLER', 'sleep_seconds')
@@ -102,12 +169,78 @@ class SpotConfig(Config):
             return True
         return False
 
+    @property
+    def crawler_quantile_sketches(self):
+        if self.get_boolean('CRAWLER', 'quantile_sketches'):
+            return True
+        return False
+
+    @property
+    def crawler_top_n(self):
+        str_val = self.get_property('CRAWLER', 'top_n')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 10
+
+    @property
+    def crawler_online_aggregation_threshold(self):
+        str_val = self.get_property('CRAWLER', 'online_aggregation_threshold')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 20000
+
+    @property
+    def dead_letter_path(self):
+        return self.get_property('CRAWLER', 'dead_letter_path')
+
+    @property
+    def content_hash_path(self):
+        return self.get_property('CRAWLER', 'content_hash_path')
+
+    @property
+    def content_hash_retention_hours(self):
+        str_val = self.get_property('CRAWLER', 'content_hash_retention_hours')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 336
+
+    @property
+    def dead_letter_max_attempts(self):
+        str_val = self.get_property('CRAWLER', 'dead_letter_max_attempts')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 5
+
+    @property
+    def dead_letter_backoff_seconds(self):
+        str_val = self.get_property('CRAWLER', 'dead_letter_backoff_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 600
+
     @property
     def crawler_batch(self):
         if self.get_boolean('CRAWLER', 'batch'):
             return True
         return False
 
+    @property
+    def crawler_sharding(self):
+        if self.get_boolean('CRAWLER', 'sharding'):
+            return True
+        return False
+
+    @property
+    def crawler_replica_id(self):
+        return self.get_property('CRAWLER', 'replica_id')
+
+    @property
+    def crawler_lease_seconds(self):
+        str_val = self.get_property('CRAWLER', 'lease_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 120
+
     @property
     def retry_sleep_seconds(self):
         str_val = self.get_property('CRAWLER', 'retry_sleep_seconds')
@@ -152,6 +285,24 @@ class SpotConfig(Config):
     def elastic_err_index(self):
         return self.get_property('SPOT_ELASTICSEARCH', 'err_index')
 
+    @property
+    def elastic_rollup_index(self):
+        return self.get_property('SPOT_ELASTICSEARCH', 'rollup_index')
+
+    @property
+    def elastic_lease_index(self):
+        index = self.get_property('SPOT_ELASTICSEARCH', 'lease_index')
+        if index is None:
+            index = 'spot_lease_default'
+        return index
+
+    @property
+    def rollup_bucket_seconds(self):
+        str_val = self.get_property('CRAWLER', 'rollup_bucket_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 60
+
     @property
     def auth_type(self):
         val = self.get_property('SPOT_ELASTICSEARCH', 'auth_type')
@@ -199,6 +350,13 @@ class SpotConfig(Config):
     def elasticsearch_role_name(self):
         return self.get_property('SPOT_ELASTICSEARCH', 'elasticsearch_role_name')
 
+    @property
+    def auth_refresh_margin_seconds(self):
+        str_val = self.get_property('SPOT_ELASTICSEARCH', 'auth_refresh_margin_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 300
+
     @property
     def elasticsearch_limit_of_fields_increment(self):
         str_val = self.get_property('SPOT_ELASTICSEARCH', 'limit_of_fields_increment')
@@ -250,3 +408,238 @@ class SpotConfig(Config):
             return int(str_val)
         return 60
 
+    @property
+    def yarn_leader_election(self):
+        val = self.get_property('YARN', 'leader_election')
+        if val:
+            return val.lower()
+        return None
+
+    @property
+    def yarn_leader_id(self):
+        return self.get_property('YARN', 'leader_id')
+
+    @property
+    def yarn_leader_lease_seconds(self):
+        str_val = self.get_property('YARN', 'leader_lease_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        # a standby takes over within one yarn_sleep_seconds
+        return max(3, self.yarn_sleep_seconds // 2)
+
+    @property
+    def yarn_leader_lock_path(self):
+        return self.get_property('YARN', 'leader_lock_path')
+
+    @property
+    def yarn_apps_window_seconds(self):
+        str_val = self.get_property('YARN', 'yarn_apps_window_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 3600
+
+    @property
+    def yarn_apps_max_per_window(self):
+        str_val = self.get_property('YARN', 'yarn_apps_max_per_window')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 1000
+
+    @property
+    def yarn_apps_chunk_size(self):
+        str_val = self.get_property('YARN', 'yarn_apps_chunk_size')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 200
+
+    @property
+    def yarn_apps_deselects(self):
+        str_val = self.get_property('YARN', 'yarn_apps_deselects')
+        if str_val is None:
+            return ['resourceRequests']
+        return [field.strip() for field in str_val.split(',') if field.strip()]
+
+    @property
+    def yarn_apps_lookback_hours(self):
+        str_val = self.get_property('YARN', 'yarn_apps_lookback_hours')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 24
+
+    @property
+    def yarn_scheduler_delta(self):
+        if self.get_boolean('YARN', 'yarn_scheduler_delta'):
+            return True
+        return False
+
+    @property
+    def yarn_scheduler_delta_tolerance(self):
+        str_val = self.get_property('YARN', 'yarn_scheduler_delta_tolerance')
+        try:
+            return float(str_val)
+        except (TypeError, ValueError):
+            return 0.01
+
+    @property
+    def yarn_scheduler_keyframe_seconds(self):
+        str_val = self.get_property('YARN', 'yarn_scheduler_keyframe_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 3600
+
+    @property
+    def yarn_join_cache_path(self):
+        return self.get_property('YARN', 'join_cache_path')
+
+    @property
+    def yarn_join_cache_retention_hours(self):
+        str_val = self.get_property('YARN', 'join_cache_retention_hours')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 168
+
+    @property
+    def yarn_join_pending_max(self):
+        str_val = self.get_property('YARN', 'join_pending_max')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 1000
+
+    @property
+    def yarn_join_pending_seconds(self):
+        str_val = self.get_property('YARN', 'join_pending_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 3600
+
+    @property
+    def baselines_path(self):
+        return self.get_property('BASELINES', 'path')
+
+    @property
+    def baselines_ewm_alpha(self):
+        str_val = self.get_property('BASELINES', 'ewm_alpha')
+        try:
+            return float(str_val)
+        except (TypeError, ValueError):
+            return 0.1
+
+    @property
+    def baselines_z_threshold(self):
+        str_val = self.get_property('BASELINES', 'z_threshold')
+        try:
+            return float(str_val)
+        except (TypeError, ValueError):
+            return 3.0
+
+    @property
+    def baselines_min_runs(self):
+        str_val = self.get_property('BASELINES', 'min_runs')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 5
+
+    @property
+    def profiling_dir(self):
+        return self.get_property('PROFILING', 'dir')
+
+    @property
+    def profiling_sample_every(self):
+        str_val = self.get_property('PROFILING', 'sample_every')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 100
+
+    @property
+    def profiling_time_budget_seconds(self):
+        str_val = self.get_property('PROFILING', 'time_budget_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 120
+
+    @property
+    def profiling_keep_files(self):
+        str_val = self.get_property('PROFILING', 'keep_files')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 50
+
+    @property
+    def profiling_trace_memory(self):
+        if self.get_boolean('PROFILING', 'trace_memory'):
+            return True
+        return False
+
+    @property
+    def regression_model_dir(self):
+        model_dir = self.get_property('REGRESSION', 'model_dir')
+        if model_dir is None:
+            model_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../output/models'))
+        return model_dir
+
+    @property
+    def regression_alpha(self):
+        str_val = self.get_property('REGRESSION', 'alpha')
+        try:
+            return float(str_val)
+        except (TypeError, ValueError):
+            return 1.0
+
+    @property
+    def regression_keep_versions(self):
+        str_val = self.get_property('REGRESSION', 'keep_versions')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 10
+
+    def _get_int_list(self, section, key, default):
+        str_val = self.get_property(section, key)
+        if not str_val:
+            return default
+        return [int(value) for value in str_val.split(',') if value.strip()]
+
+    @property
+    def setter_port(self):
+        str_val = self.get_property('SETTER', 'port')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 8085
+
+    @property
+    def setter_reload_seconds(self):
+        str_val = self.get_property('SETTER', 'reload_seconds')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 60
+
+    @property
+    def setter_executors_grid(self):
+        return self._get_int_list('SETTER', 'executors_grid', [2, 4, 8, 16, 32, 64, 128])
+
+    @property
+    def setter_cores_grid(self):
+        return self._get_int_list('SETTER', 'cores_grid', [1, 2, 4])
+
+    @property
+    def setter_memory_grid(self):
+        memory_gb = self._get_int_list('SETTER', 'memory_gb_grid', [2, 4, 8])
+        return [gb * 1024 ** 3 for gb in memory_gb]
+
+    @property
+    def setter_duration_slack(self):
+        str_val = self.get_property('SETTER', 'duration_slack')
+        try:
+            return float(str_val)
+        except (TypeError, ValueError):
+            return 0.2
+
+    @property
+    def setter_hdfs_size_cache_path(self):
+        return self.get_property('SETTER', 'hdfs_size_cache_path')
+
+    @property
+    def setter_hdfs_max_workers(self):
+        str_val = self.get_property('SETTER', 'hdfs_max_workers')
+        if str_val is not None and str_val.isdigit():
+            return int(str_val)
+        return 8
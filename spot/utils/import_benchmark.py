@@ -0,0 +1,122 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# entry points of the batch jobs
+DEFAULT_MODULES = [
+    'spot.crawler.crawler',
+    'spot.yarn.yarn_crawler',
+    'spot.enceladus.setter.enceladus_setter',
+]
+# dependencies which should only be imported when configured or used
+HEAVY_MODULES = [
+    'pandas',
+    'numpy',
+    'boto3',
+    'botocore',
+    'pycognito',
+    'requests_aws4auth',
+    'spot.enceladus.menas_aggregator',
+    'spot.crawler.flattener',
+]
+
+_import_script = """
+import json, sys, time
+print({marker!r}, file=sys.stderr)
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+# separates the imports of the interpreter startup from the imports of the module
+_marker = '-- spot import benchmark --'
+
+
+def _parse_import_times(stderr, module):
+    """Returns (cumulative microseconds, package) of the imports made directly by a module
+    from the output of python -X importtime."""
+    result = []
+    lines = stderr.splitlines()
+    if _marker in lines:
+        lines = lines[lines.index(_marker) + 1:]
+    for line in lines:
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, package = line[len('import time:'):].split('|')
+        # the package is indented by two spaces per level of nesting
+        depth = (len(package) - len(package.lstrip()) - 1) // 2
+        if depth > 1 or package.strip() == module:  # nested imports are counted in their parents
+            continue
+        result.append((int(cumulative), package.strip()))
+    return result
+
+
+def measure(module, runs=5, top=5):
+    """Imports a module in fresh interpreters, returns the median import time,
+    the heavy modules it loads and its slowest direct imports."""
+    times = []
+    loaded = []
+    slowest = []
+    for _ in range(runs):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                                  _import_script.format(module=module, heavy=HEAVY_MODULES, marker=_marker)],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if process.returncode != 0:
+            raise RuntimeError(f"Import of {module} failed: {process.stderr.strip().splitlines()[-1]}")
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        times.append(result['seconds'])
+        loaded = result['loaded']
+        slowest = sorted(_parse_import_times(process.stderr, module), reverse=True)[:top]
+    return {
+        'module': module,
+        'seconds': statistics.median(times),
+        'heavy_modules': loaded,
+        'slowest_imports': [{'module': package, 'seconds': us / 1e6} for us, package in slowest]
+    }
+
+
+def format_report(results):
+    lines = []
+    for result in results:
+        lines.append(f"{result['module']}: {result['seconds']:.3f} s")
+        lines.append(f"  heavy modules loaded: {', '.join(result['heavy_modules']) or 'none'}")
+        for item in result['slowest_imports']:
+            lines.append(f"  {item['seconds']:8.3f} s  {item['module']}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the import time of Spot entry points in fresh interpreters')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES, help="Modules to import")
+    parser.add_argument("--runs", type=int, default=5, help="Number of imports of each module, the median is reported")
+    parser.add_argument("--max_seconds", type=float,
+                        help="Exit with an error if the import of any module takes longer")
+    parser.add_argument("--json", action='store_true', help="Print the report as JSON")
+    args = parser.parse_args()
+
+    results = [measure(module, runs=args.runs) for module in args.modules]
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print(format_report(results))
+    if args.max_seconds is not None and any(result['seconds'] > args.max_seconds for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+_create_table = """
+CREATE TABLE IF NOT EXISTS yarn_apps (
+    app_id TEXT PRIMARY KEY,
+    stored_at REAL NOT NULL,
+    data TEXT NOT NULL
+)"""
+
+# YARN app fields added to Spark aggregations
+_join_fields = [
+    'queue',
+    'user',
+    'finalStatus',
+    'elapsedTime',
+    'memorySeconds',
+    'vcoreSeconds',
+    'preemptedMemorySeconds',
+    'preemptedVcoreSeconds',
+    'numAMContainerPreempted',
+    'applicationType'
+]
+
+
+def yarn_join_fields(app):
+    """Selects the fields of a YARN app which are joined to Spark aggregations."""
+    fields = {key: app[key] for key in _join_fields if key in app}
+    # launchTime is provided by Hadoop 3 and later
+    launch_time = app.get('launchTime')
+    started_time = app.get('startedTime')
+    if launch_time and started_time is not None:
+        started_ms = started_time.timestamp() * 1000 if hasattr(started_time, 'timestamp') else started_time
+        fields['queue_wait_ms'] = max(0, launch_time - started_ms)
+    return fields
+
+
+class YarnJoinCache:
+    """Local store of YARN app fields keyed by application id.
+
+    The cache is an SQLite file shared by the YARN crawler (writer) and the Spark crawler (reader).
+    """
+
+    def __init__(self, path, retention_hours=168):
+        self._path = path
+        self._retention_seconds = retention_hours * 3600
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            logger.debug(f"opening YARN join cache {self._path}")
+            self._conn = sqlite3.connect(self._path, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(_create_table)
+            self._conn.commit()
+        return self._conn
+
+    def put_apps(self, apps):
+        now = time.time()
+        rows = [(app.get('id'), now, json.dumps(yarn_join_fields(app), default=str))
+                for app in apps if app.get('id') is not None]
+        conn = self._connection()
+        conn.executemany('INSERT OR REPLACE INTO yarn_apps (app_id, stored_at, data) VALUES (?, ?, ?)', rows)
+        conn.execute('DELETE FROM yarn_apps WHERE stored_at < ?', (now - self._retention_seconds,))
+        conn.commit()
+        return len(rows)
+
+    def get_many(self, app_ids):
+        """Returns {app_id: yarn_fields} for the ids found in the cache."""
+        app_ids = list(app_ids)
+        result = {}
+        conn = self._connection()
+        # stay below the SQLite limit of query variables
+        for i in range(0, len(app_ids), 500):
+            chunk = app_ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for app_id, data in conn.execute(f'SELECT app_id, data FROM yarn_apps WHERE app_id IN ({placeholders})',
+                                             chunk):
+                result[app_id] = json.loads(data)
+        return result
+
+    def get(self, app_id):
+        return self.get_many([app_id]).get(app_id)
+
+
+def _is_yarn_app_id(app_id):
+    return app_id is not None and app_id.startswith('application_')
+
+
+class YarnJoinBuffer:
+    """Joins Spark aggregations with YARN app fields from the YarnJoinCache.
+
+    Aggregations whose YARN app is not yet in the cache are parked in a bounded pending buffer
+    and re-checked at each flush. When the buffer is full, or an aggregation has been pending
+    for longer than pending_seconds, the aggregation is released without YARN fields.
+    """
+
+    def __init__(self, cache, max_pending=1000, pending_seconds=3600):
+        self._cache = cache
+        self._max_pending = max_pending
+        self._pending_seconds = pending_seconds
+        self._pending = OrderedDict()  # (app_id, attempt_id) -> (parked_at, agg)
+        self.joined = 0
+        self.released_unjoined = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    @staticmethod
+    def _add_fields(agg, fields):
+        agg['yarn'] = fields
+        return agg
+
+    def pending_app_ids(self):
+        return {app_id for app_id, _ in self._pending.keys()}
+
+    def join(self, agg):
+        """Joins the aggregation with YARN fields or parks it.
+
+        :return: list of aggregations ready to be saved
+        """
+        app_id = agg.get('id')
+        if not _is_yarn_app_id(app_id):
+            return [agg]
+        fields = self._cache.get(app_id)
+        if fields is not None:
+            self.joined += 1
+            return [self._add_fields(agg, fields)]
+
+        key = (app_id, agg.get('attempt', {}).get('attemptId'))
+        self._pending[key] = (time.time(), agg)
+        self._pending.move_to_end(key)
+        ready = []
+        while len(self._pending) > self._max_pending:
+            _, (_, oldest) = self._pending.popitem(last=False)
+            logger.warning(f"YARN join buffer full, releasing {oldest.get('id')} without YARN fields")
+            self.released_unjoined += 1
+            ready.append(oldest)
+        return ready
+
+    def pop_ready(self, release_all=False):
+        """Re-checks the pending aggregations against the cache.
+
+        :param release_all: release all pending aggregations, joined or not (e.g. at shutdown)
+        :return: list of aggregations ready to be saved
+        """
+        if not self._pending:
+            return []
+        found = self._cache.get_many(self.pending_app_ids())
+        now = time.time()
+        ready = []
+        for key in list(self._pending.keys()):
+            parked_at, agg = self._pending[key]
+            fields = found.get(key[0])
+            if fields is not None:
+                self.joined += 1
+                ready.append(self._add_fields(agg, fields))
+            elif release_all or now - parked_at > self._pending_seconds:
+                logger.debug(f"releasing {key[0]} without YARN fields")
+                self.released_unjoined += 1
+                ready.append(agg)
+            else:
+                continue
+            del self._pending[key]
+        logger.debug(f"YARN join: {len(ready)} released, {len(self._pending)} pending, "
+                     f"total joined: {self.joined}, released without YARN fields: {self.released_unjoined}")
+        return ready
@@ -0,0 +1,185 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+
+class ElasticLeaderLease:
+    """Exclusive lease stored as a document in Elasticsearch (see Elastic.get_lease and Elastic.write_lease).
+
+    All writes are conditional on the seq_no and primary_term of the document read before, so only one
+    candidate wins a change. Expiry does not rely on synchronized clocks: a candidate takes over the lease
+    when it has seen the same version of the document for ttl_seconds of its own clock,
+    i.e. the holder stopped renewing it.
+    """
+
+    def __init__(self, lease_obj, name, holder, ttl_seconds, clock=time.monotonic):
+        self._lease_obj = lease_obj
+        self.name = name
+        self.holder = holder
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._version = None  # (seq_no, primary_term) of the lease written by this holder
+        self._observed = None  # (seq_no, primary_term, local time) of the lease of another holder
+
+    def _doc(self):
+        return {
+            'name': self.name,
+            'holder': self.holder,
+            'renewed': datetime.now(tz=timezone.utc),
+            'ttl_seconds': self.ttl_seconds
+        }
+
+    def try_acquire(self):
+        """Renews the lease held by this holder or takes over a free or expired one.
+
+        :return: True if this holder holds the lease
+        """
+        if self._version is not None:
+            version = self._lease_obj.write_lease(self.name, self._doc(), *self._version)
+            if version is not None:
+                self._version = version
+                return True
+            logger.warning(f"Lease {self.name} was taken over by another holder")
+            self._version = None
+
+        current = self._lease_obj.get_lease(self.name)
+        if current is None:
+            self._version = self._lease_obj.write_lease(self.name, self._doc())
+            return self._version is not None
+
+        doc, seq_no, primary_term = current
+        if doc.get('holder') != self.holder:
+            now = self._clock()
+            if self._observed is None or self._observed[:2] != (seq_no, primary_term):
+                self._observed = (seq_no, primary_term, now)
+                return False
+            if now - self._observed[2] < self.ttl_seconds:
+                return False
+            logger.info(f"Lease {self.name} of {doc.get('holder')} expired")
+        self._version = self._lease_obj.write_lease(self.name, self._doc(), seq_no, primary_term)
+        return self._version is not None
+
+    def release(self):
+        if self._version is not None:
+            self._lease_obj.delete_lease(self.name, *self._version)
+            self._version = None
+
+
+class FileLeaderLease:
+    """Exclusive lease held as a lock of a local file, a stand-in for ElasticLeaderLease
+    when all candidates run on the same host. The lock is released by the OS when the process dies."""
+
+    def __init__(self, path, holder, ttl_seconds):
+        self.path = path
+        self.holder = holder
+        self.ttl_seconds = ttl_seconds
+        self._file = None
+
+    def try_acquire(self):
+        if self._file is not None:
+            return True
+        f = open(self.path, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.truncate(0)
+        f.write(f'{self.holder}\n')
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class LeaderElector:
+    """Keeps trying to acquire or renew a lease in a background thread every renew_seconds.
+
+    The holder acts as the leader only while its last successful renewal is younger than the ttl of the lease,
+    so a leader which cannot reach the lease store stops before a standby can take over.
+    """
+
+    def __init__(self, lease, renew_seconds=None, clock=time.monotonic):
+        self._lease = lease
+        self.renew_seconds = renew_seconds if renew_seconds is not None else lease.ttl_seconds / 3
+        self._clock = clock
+        self._renewed = None
+        self._leader = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.elections_won = 0
+
+    @property
+    def is_leader(self):
+        return self._leader.is_set() and self._clock() - self._renewed < self._lease.ttl_seconds
+
+    def _tick(self):
+        try:
+            acquired = self._lease.try_acquire()
+        except Exception as e:
+            # the leader keeps acting until the ttl of its last renewal
+            logger.warning(f"Failed to renew the leader lease: {e}")
+            acquired = None
+        if acquired:
+            self._renewed = self._clock()
+            if not self._leader.is_set():
+                self.elections_won += 1
+                logger.info(f"Acquired the leader lease as {self._lease.holder}")
+                self._leader.set()
+        elif self._leader.is_set() and (acquired is not None or not self.is_leader):
+            logger.warning(f"Lost the leader lease, {self._lease.holder} is on standby")
+            self._leader.clear()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._tick()
+            self._stop.wait(self.renew_seconds)
+
+    def start(self):
+        self._tick()
+        self._thread = threading.Thread(target=self._run, name='leader-elector', daemon=True)
+        self._thread.start()
+        if not self.is_leader:
+            logger.info(f"{self._lease.holder} is on standby")
+
+    def wait_for_leadership(self, timeout=None):
+        """Blocks until this holder is the leader or timeout. Returns True if it is the leader."""
+        if not self._leader.wait(timeout):
+            return False
+        if self.is_leader:
+            return True
+        # the lease could not be renewed for a while, the elector gives it up at its next attempt
+        self._stop.wait(timeout)
+        return self.is_leader
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._leader.clear()
+        self._lease.release()
+
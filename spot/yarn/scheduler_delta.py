@@ -0,0 +1,178 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from datetime import datetime, timedelta, timezone
+
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+KEYFRAME = 'keyframe'
+DELTA = 'delta'
+DELETED = 'deleted'
+
+# fields identifying the same scheduler entity across snapshots
+_key_fields = ['queueName', 'username', 'partitionName']
+
+
+def doc_key(doc):
+    """Returns a tuple identifying the scheduler entity (queue, user, partition) described by the doc."""
+    key = [doc.get('spot', {}).get('doc_type')]
+    for field in _key_fields:
+        key.append(doc.get(field))
+    return tuple(key)
+
+
+def _flatten_metrics(doc, prefix='', result=None):
+    if result is None:
+        result = {}
+    for key, value in doc.items():
+        if not prefix and key == 'spot':
+            continue
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            _flatten_metrics(value, prefix=f'{path}.', result=result)
+        else:
+            result[path] = value
+    return result
+
+
+def _value_changed(old, new, tolerance):
+    if isinstance(old, bool) or isinstance(new, bool) \
+            or not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+        return old != new
+    return abs(new - old) > tolerance * max(abs(old), abs(new))
+
+
+def metrics_changed(old_doc, new_doc, tolerance):
+    """Checks whether any metric of the doc moved beyond the relative tolerance.
+    Non-numeric values and the set of metrics are compared exactly."""
+    old = _flatten_metrics(old_doc)
+    new = _flatten_metrics(new_doc)
+    if old.keys() != new.keys():
+        return True
+    for path, value in new.items():
+        if _value_changed(old[path], value, tolerance):
+            return True
+    return False
+
+
+class SchedulerDeltaEncoder:
+    """Filters scheduler docs, so that only the docs with changed metrics are stored.
+
+    Each doc is compared against the last stored doc of the same entity (see doc_key).
+    All docs are stored as a keyframe at the first snapshot and then every keyframe_seconds.
+    Entities which disappeared from the scheduler are stored as 'deleted' docs.
+    Each stored doc gets spot.snapshot (keyframe/delta/deleted), spot.snapshot_time and spot.keyframe_time,
+    so the full state at time T can be reconstructed from the latest keyframe before T
+    and the following deltas (see reconstruct_state).
+
+    The docs returned by encode become the reference for the next snapshot only after commit is called,
+    i.e. they were stored. If they were not, the next snapshot is stored as a keyframe, as a failed write
+    may have stored only some of the docs.
+    """
+
+    def __init__(self, tolerance=0.01, keyframe_seconds=3600):
+        self.tolerance = tolerance
+        self._keyframe_delta = timedelta(seconds=keyframe_seconds)
+        self._keyframe_time = None
+        self._stored = {}  # doc_key -> last stored doc
+        self._pending = None  # (keyframe_time, stored, total docs, written docs) of the last encode, until commit
+        self.total_docs = 0
+        self.written_docs = 0
+
+    def _is_keyframe_due(self, time_now):
+        return (self._keyframe_time is None) or (time_now - self._keyframe_time >= self._keyframe_delta)
+
+    @staticmethod
+    def _mark(doc, snapshot, time_now, keyframe_time):
+        spot = doc.setdefault('spot', {})
+        spot['snapshot'] = snapshot
+        spot['snapshot_time'] = time_now
+        spot['keyframe_time'] = keyframe_time
+        return doc
+
+    def _deleted_doc(self, key, time_now):
+        doc_type = key[0]
+        doc = {field: value for field, value in zip(_key_fields, key[1:]) if value is not None}
+        doc['spot'] = {
+            'time_processed': time_now,
+            'doc_type': doc_type
+        }
+        return self._mark(doc, DELETED, time_now, self._keyframe_time)
+
+    def encode(self, docs, time_now=None):
+        """Returns the list of docs to be stored for the current snapshot of scheduler docs.
+        Call commit after the docs are stored."""
+        if time_now is None:
+            time_now = datetime.now(tz=timezone.utc)
+        result = []
+        seen_keys = set()
+
+        if self._pending is not None:
+            logger.warning("Previous scheduler docs were not stored, writing a keyframe")
+        if self._pending is not None or self._is_keyframe_due(time_now):
+            stored = {}
+            for doc in docs:
+                key = doc_key(doc)
+                stored[key] = doc
+                result.append(self._mark(doc, KEYFRAME, time_now, time_now))
+            self._pending = (time_now, stored, len(result), len(result))
+            logger.debug(f"scheduler keyframe: {len(result)} docs")
+            return result
+
+        stored = dict(self._stored)
+        counter = 0
+        for doc in docs:
+            counter += 1
+            key = doc_key(doc)
+            seen_keys.add(key)
+            previous = stored.get(key)
+            if previous is None or metrics_changed(previous, doc, self.tolerance):
+                stored[key] = doc
+                result.append(self._mark(doc, DELTA, time_now, self._keyframe_time))
+
+        for key in list(stored.keys()):
+            if key not in seen_keys:
+                del stored[key]
+                result.append(self._deleted_doc(key, time_now))
+
+        self._pending = (self._keyframe_time, stored, counter, len(result))
+        logger.debug(f"scheduler delta: {len(result)} of {counter} docs changed")
+        return result
+
+    def commit(self):
+        """Makes the docs returned by the last encode the reference for the next snapshot."""
+        if self._pending is None:
+            return
+        self._keyframe_time, self._stored, total_docs, written_docs = self._pending
+        self._pending = None
+        self.total_docs += total_docs
+        self.written_docs += written_docs
+
+
+def reconstruct_state(docs):
+    """Reconstructs the full scheduler state from a keyframe and the following deltas.
+
+    :param docs: docs sharing the same spot.keyframe_time with spot.snapshot_time up to the time of interest
+    :return: dict {doc_key: doc} of entities present at the latest snapshot_time
+    """
+    state = {}
+    for doc in sorted(docs, key=lambda d: d['spot']['snapshot_time']):
+        key = doc_key(doc)
+        if doc['spot'].get('snapshot') == DELETED:
+            state.pop(key, None)
+        else:
+            state[key] = doc
+    return state
@@ -0,0 +1,140 @@
+# Copyright 2020 ABSA Group Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+import spot.utils.setup_logger
+
+logger = logging.getLogger(__name__)
+
+# YARN treats both finishedTimeBegin and finishedTimeEnd as inclusive
+_resolution = timedelta(milliseconds=1)
+_min_window = timedelta(seconds=1)
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class YarnAppsIngester:
+    """Ingests finished YARN apps in bounded time windows.
+
+    The ingester keeps a local watermark (finish time up to which all apps were stored),
+    so Elasticsearch is queried only once at startup.
+    The interval from the watermark to now is walked in windows of window_seconds.
+    If a window returns max_apps_per_window apps (the limit of the request) it is halved until it fits,
+    so that a single response never exceeds the limit, whatever the backlog. A window of the minimum length
+    still at the limit is fetched again with a doubled limit until it is complete, as the YARN API
+    cannot page, so the watermark never moves past apps which were not returned.
+    Heavy fields (e.g. resourceRequests) are dropped by YARN via deSelects.
+    If a join cache is provided, the stored apps are also added to it for enrichment of Spark aggregations.
+    """
+
+    def __init__(self, yarn, save_obj,
+                 window_seconds=3600,
+                 max_apps_per_window=1000,
+                 chunk_size=200,
+                 deselects=('resourceRequests',),
+                 lookback_hours=24,
+                 join_cache=None):
+        self._yarn = yarn
+        self._save_obj = save_obj
+        self._join_cache = join_cache
+        self._window = timedelta(seconds=window_seconds)
+        self._max_apps = max_apps_per_window
+        self._chunk_size = chunk_size
+        self._deselects = list(deselects) if deselects else None
+        self._lookback = timedelta(hours=lookback_hours)
+        self._watermark = None
+
+    @property
+    def watermark(self):
+        return self._watermark
+
+    def _init_watermark(self, time_now):
+        latest = self._save_obj.get_yarn_latest_finished_time()
+        if latest is None:
+            latest = time_now - self._lookback
+            logger.info(f"No YARN apps stored yet, starting from {latest}")
+        else:
+            logger.info(f"Latest stored YARN app finished at {latest}")
+        self._watermark = latest
+
+    def _fetch_window(self, window_start, window_end):
+        """Returns apps finished within the window, shrinking the window while the response is at the limit.
+
+        :return: tuple (apps, actual window end)
+        """
+        limit = self._max_apps
+        while True:
+            apps = list(self._yarn.get_apps(states=['FINISHED'],
+                                            finishedTimeBegin=window_start,
+                                            finishedTimeEnd=window_end,
+                                            limit=limit,
+                                            deSelects=self._deselects))
+            if len(apps) < limit:
+                return apps, window_end
+            half = (window_end - window_start) / 2
+            if half < _min_window:
+                # the window cannot be split further, fetch it whole
+                limit *= 2
+                logger.warning(f"At least {len(apps)} YARN apps finished from {window_start} to {window_end}, "
+                               f"fetching them with limit {limit}")
+                continue
+            logger.debug(f"YARN apps window {window_start} - {window_end} at the limit, halving")
+            window_end = window_start + half
+
+    def _save(self, apps):
+        counter = 0
+        for chunk in _chunks(apps, self._chunk_size):
+            self._save_obj.save_yarn_apps(chunk)
+            if self._join_cache is not None:
+                self._join_cache.put_apps(chunk)
+            counter += len(chunk)
+        return counter
+
+    def process_new_apps(self):
+        """Stores all YARN apps finished since the watermark.
+
+        :return: number of stored apps
+        """
+        time_now = datetime.now(tz=timezone.utc)
+        if self._watermark is None:
+            self._init_watermark(time_now)
+
+        counter = 0
+        while self._watermark < time_now:
+            window_start = self._watermark
+            window_end = min(window_start + self._window, time_now)
+            apps, window_end = self._fetch_window(window_start, window_end)
+            counter += self._save(apps)
+            if window_end < time_now:
+                self._watermark = window_end + _resolution
+            else:
+                # the last window is still open: new apps may appear with finish times before now,
+                # so the watermark is moved only to the latest seen app (re-fetching it is idempotent)
+                finished_times = [app['finishedTime'] for app in apps if app.get('finishedTime')]
+                if finished_times:
+                    self._watermark = max(self._watermark, max(finished_times))
+                break
+            logger.debug(f"YARN apps stored up to {self._watermark}")
+
+        logger.debug(f"{counter} YARN apps stored, watermark: {self._watermark}")
+        return counter
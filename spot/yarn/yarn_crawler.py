@@ -12,11 +12,17 @@
 # limitations under the License.
 
 import logging
+import os
+import socket
 from datetime import datetime, timezone
 import time
 from urllib.parse import urlparse
 
 from spot.yarn.yarn_wrapper import YarnWrapper
+from spot.yarn.yarn_apps_ingester import YarnAppsIngester
+from spot.yarn.scheduler_delta import SchedulerDeltaEncoder
+from spot.yarn.join_cache import YarnJoinCache
+from spot.yarn.leader_election import ElasticLeaderLease, FileLeaderLease, LeaderElector
 from spot.crawler.elastic import Elastic
 from spot.utils.config import SpotConfig
 import spot.utils.setup_logger
@@ -24,6 +30,22 @@ import spot.utils.setup_logger
 logger = logging.getLogger(__name__)
 
 
+def leader_elector_from_config(conf, elastic, host):
+    if conf.yarn_leader_election is None:
+        return None
+    holder = conf.yarn_leader_id or f"{socket.gethostname()}-{os.getpid()}"
+    ttl_seconds = conf.yarn_leader_lease_seconds
+    if conf.yarn_leader_election == 'elastic':
+        logger.info(f"Leader election via lease in {conf.elastic_lease_index}, lease: {ttl_seconds} s")
+        lease = ElasticLeaderLease(elastic, f"yarn crawler {host}", holder, ttl_seconds)
+    elif conf.yarn_leader_election == 'file':
+        logger.info(f"Leader election via lock of {conf.yarn_leader_lock_path}")
+        lease = FileLeaderLease(conf.yarn_leader_lock_path, holder, ttl_seconds)
+    else:
+        raise ValueError(f"Unknown leader_election {conf.yarn_leader_election}, expected 'elastic' or 'file'")
+    return LeaderElector(lease)
+
+
 def main():
     logger.info(f'Starting YARN crawler')
     conf = SpotConfig()
@@ -32,6 +54,36 @@ def main():
 
     elastic = Elastic(conf)
     yarn = YarnWrapper(conf.yarn_api_base_url)
+    join_cache = None
+    if conf.yarn_join_cache_path is not None:
+        logger.info(f"Filling YARN join cache {conf.yarn_join_cache_path}")
+        join_cache = YarnJoinCache(conf.yarn_join_cache_path,
+                                   retention_hours=conf.yarn_join_cache_retention_hours)
+
+    def _new_apps_ingester():
+        return YarnAppsIngester(yarn, elastic,
+                                window_seconds=conf.yarn_apps_window_seconds,
+                                max_apps_per_window=conf.yarn_apps_max_per_window,
+                                chunk_size=conf.yarn_apps_chunk_size,
+                                deselects=conf.yarn_apps_deselects,
+                                lookback_hours=conf.yarn_apps_lookback_hours,
+                                join_cache=join_cache)
+
+    def _new_scheduler_encoder():
+        if not conf.yarn_scheduler_delta:
+            return None
+        return SchedulerDeltaEncoder(tolerance=conf.yarn_scheduler_delta_tolerance,
+                                     keyframe_seconds=conf.yarn_scheduler_keyframe_seconds)
+
+    if conf.yarn_scheduler_delta:
+        logger.info(f"Scheduler docs are delta-encoded, tolerance: {conf.yarn_scheduler_delta_tolerance}")
+    apps_ingester = _new_apps_ingester()
+    scheduler_encoder = _new_scheduler_encoder()
+
+    elector = leader_elector_from_config(conf, elastic, host)
+    if elector is not None:
+        elector.start()
+    elections_won = 0
 
     def _handle_processing_exception_(e, stage_name):
         error_msg = str(e)
@@ -54,6 +106,15 @@ def main():
             raise e
 
     while True:
+        if elector is not None:
+            if not elector.wait_for_leadership(conf.yarn_sleep_seconds):
+                continue
+            if elector.elections_won != elections_won:
+                # another leader wrote in the meantime, start from the stored state
+                elections_won = elector.elections_won
+                apps_ingester = _new_apps_ingester()
+                scheduler_encoder = _new_scheduler_encoder()
+
         logger.debug(f"Getting data from YARN at {conf.yarn_api_base_url}")
 
         # cluster stats
@@ -66,16 +127,21 @@ def main():
 
         # apps stats
         try:
-            finishedTimeBegin = elastic.get_yarn_latest_finished_time()
-            apps = yarn.get_apps(states=['FINISHED'],finishedTimeBegin=finishedTimeBegin)
-            elastic.save_yarn_apps(apps)
+            apps_ingester.process_new_apps()
         except Exception as e:
             _handle_processing_exception_(e, 'yarn_apps')
 
         # scheduler stats:
         try:
             scheduler_docs = yarn.get_scheduler_docs()
+            if scheduler_encoder is not None:
+                scheduler_docs = scheduler_encoder.encode(scheduler_docs)
             elastic.save_yarn_scheduler_docs(scheduler_docs)
+            if scheduler_encoder is not None:
+                # a failed write is followed by a keyframe
+                scheduler_encoder.commit()
+                logger.debug(f"Scheduler docs written: {scheduler_encoder.written_docs} "
+                             f"of {scheduler_encoder.total_docs}")
         except Exception as e:
             _handle_processing_exception_(e, 'yarn_scheduler_docs')
 
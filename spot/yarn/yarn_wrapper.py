@@ -118,7 +118,9 @@ class YarnWrapper:
                                  name=name,
                                  deSelects=deSelects)
 
-        for app in res['apps']['app']:
+        # YARN responds with {"apps": null} when no apps match
+        apps = res.get('apps') or {}
+        for app in apps.get('app', []):
             yield self._process_app(app)
 
     def get_cluster_stats(self):